@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Fleet Backfill Scheduler
+Fetches history for many devices concurrently and reconciles it into one collector
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from instrumentation import get_logger, setup
+from orin_soil_collector import OrinSoilCollector
+from ttn_storage import StorageClient
+
+DEFAULT_RATE_LIMIT = 5.0
+
+log = get_logger("backfill_scheduler")
+
+
+def load_inventory(path):
+    """
+    Load a device inventory of the form
+    {"applications": {"<app>": {"rate_limit": 5, "devices": ["<dev>", ...]}}}
+    and return (devices, rate_limits) with devices as (app, device) pairs.
+    """
+    with open(path, 'r') as f:
+        inventory = json.load(f)
+
+    devices = []
+    rate_limits = {}
+    for application_id, application in inventory.get("applications", {}).items():
+        rate_limits[application_id] = application.get("rate_limit", DEFAULT_RATE_LIMIT)
+        for device_id in application.get("devices", []):
+            devices.append((application_id, device_id))
+    return devices, rate_limits
+
+
+class RateLimiter:
+    """Thread-safe token bucket: `rate` requests per second, bursts of `burst`; rate 0 is unlimited"""
+
+    def __init__(self, rate, burst=None):
+        if rate < 0:
+            raise ValueError(f"Rate limit must be at least 0 requests/s, got {rate}")
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BackfillScheduler:
+    """
+    Runs one storage fetch per device on a bounded thread pool.
+
+    Workers stream uplinks into a bounded queue which the calling thread
+    drains through collector.compare_and_reconcile, so the collector itself
+    is only ever touched from one thread. Each device resumes from its
+    high-water mark in the collector checkpoint, which advances as its
+    records are stored and is saved with them.
+    Every storage request, resumes included, takes a token from its
+    application's rate limiter. If reconciling fails, the run is cancelled
+    and workers waiting on the full queue give up instead of blocking.
+    """
+
+    def __init__(self, collector, devices, rate_limits=None, max_workers=8, last="12h", queue_size=1024):
+        self.collector = collector
+        self.devices = devices
+        self.max_workers = max_workers
+        self.last = last
+        self.client = StorageClient(pool_size=max_workers)
+        rate_limits = rate_limits or {}
+        self.limiters = {
+            application_id: RateLimiter(rate_limits.get(application_id, DEFAULT_RATE_LIMIT))
+            for application_id, _ in devices
+        }
+        self.results = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+        self.errors = {}
+
+    def throttle(self, application_id):
+        limiter = self.limiters.get(application_id)
+        if limiter is not None:
+            limiter.acquire()
+
+    def put(self, item, timeout=0.5):
+        """Queue an item for the reconciling thread; False once the run is cancelled"""
+        while not self.cancelled.is_set():
+            try:
+                self.results.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_device(self, application_id, device_id, after):
+        """Worker: stream one device's history after its high-water mark into the results queue"""
+        key = f"{application_id}/{device_id}"
+        if self.cancelled.is_set():
+            return
+        try:
+            for uplink in self.client.iter_uplinks(application_id, device_id, last=self.last, after=after,
+                                                   before_request=partial(self.throttle, application_id)):
+                if not self.put(uplink):
+                    return
+            self.put((key, None))
+        except Exception as e:
+            self.put((key, e))
+
+    def drain(self, pending):
+        """Yield uplinks from the workers until every device has reported"""
+        while pending:
+            item = self.results.get()
+            if isinstance(item, tuple):
+                key, error = item
+                pending -= 1
+                if error is not None:
+                    log.error("Backfill failed for %s: %s", key, error)
+                    self.errors[key] = str(error)
+                continue
+            yield item
+
+    def run(self):
+        """Backfill every device in the inventory; returns records added"""
+        log.info("Backfilling %d devices with %d workers", len(self.devices), self.max_workers)
+        started = time.monotonic()
+
+        self.cancelled.clear()
+        self.results = queue.Queue(maxsize=self.results.maxsize)
+        # Read before the workers start; reconciling advances the checkpoint
+        checkpoint = self.collector.checkpoint
+        after = {(app, dev): checkpoint.high_water_mark(dev, app) for app, dev in self.devices}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for application_id, device_id in self.devices:
+                    pool.submit(self.fetch_device, application_id, device_id, after[application_id, device_id])
+                new_count = self.collector.compare_and_reconcile(self.drain(len(self.devices)))
+            finally:
+                # Every worker has reported unless reconciling failed; then release them
+                self.cancelled.set()
+        # Uplinks missed before the high-water marks, one time-bounded request per gap
+        new_count += self.collector.compare_and_reconcile(self.collector.gaps.fetch(self.client, self.throttle))
+
+        self.collector.save_data()
+        log.info("Fleet backfill finished in %.1fs: %d new records, %d failed devices",
+                 time.monotonic() - started, new_count, len(self.errors))
+        return new_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent fleet backfill from the TTN Storage API")
+    parser.add_argument("inventory", help="device inventory JSON file")
+    parser.add_argument("--data-file", default="orin_soil_data.json")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--last", default="12h", help="window for devices without a high-water mark")
+    args = parser.parse_args()
+
+    setup()
+    devices, rate_limits = load_inventory(args.inventory)
+    collector = OrinSoilCollector(args.data_file)
+    try:
+        scheduler = BackfillScheduler(collector, devices, rate_limits, max_workers=args.workers,
+                                      last=args.last)
+        scheduler.run()
+        scheduler.client.close()
+    finally:
+        collector.store.close()
+        collector.detector.close()
+        collector.index.close()
+        collector.checkpoint.save()
+        collector.gaps.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Inference Load Test
+Concurrent clients against inference_server.py, with and without batching
+"""
+
+import argparse
+import http.client
+import json
+import threading
+import time
+
+import numpy as np
+
+from inference_server import BACKENDS, BatchScheduler, InferenceServer, PrefixCache
+from soil_context import SYSTEM_PROMPT, build_prompt
+
+QUESTIONS = [
+    "Is the soil drying out?",
+    "What is the soil temperature trend?",
+    "How is the battery doing?",
+    "Were there any unusual readings this week?",
+    "Should I irrigate today?",
+]
+
+
+def synthetic_context(device):
+    """Sensor context of the size soil_context.py renders for a 400-token budget"""
+    lines = [f"## Sensor", f"Device {device}: 1008 readings from 2025-10-17 18:00 to 2025-10-24 18:00 UTC.",
+             "## Latest", "battery: 3.59 V", "soil temperature: 15.50 °C", "soil moisture: 8.27 %",
+             "## Trends", "soil moisture falling (-1.20 %/24h, 24h range 8.27-9.61)",
+             "## Daily means (newest first)"]
+    for day in range(7):
+        lines.append(f"2025-10-{24 - day} 00:00: battery 3.59, soil temperature {15.5 - day * 0.2:.2f}, "
+                     f"soil moisture {8.3 + day * 1.1:.2f}, soil conductivity 11.00")
+    return "\n".join(lines)
+
+
+def client(address, prompts, max_tokens, results):
+    host, port = address
+    connection = http.client.HTTPConnection(host, port, timeout=120)
+    for prompt in prompts:
+        started = time.perf_counter()
+        connection.request("POST", "/generate", json.dumps({"prompt": prompt, "max_tokens": max_tokens}),
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read1(65536)
+        first = time.perf_counter()
+        response.read()
+        results.append((first - started, time.perf_counter() - started))
+    connection.close()
+
+
+def run(backend, clients, requests_per_client, max_batch, prefix_cache, max_tokens, devices):
+    cache = PrefixCache() if prefix_cache else PrefixCache(max_entries=0)
+    scheduler = BatchScheduler(BACKENDS[backend](), max_batch=max_batch, prefix_cache=cache).start()
+    server = InferenceServer(scheduler, port=0).start()
+    contexts = [synthetic_context(f"sensor-{n}") for n in range(devices)]
+
+    results = []
+    threads = []
+    started = time.perf_counter()
+    for n in range(clients):
+        prompts = [build_prompt(contexts[(n + i) % devices], QUESTIONS[(n + i) % len(QUESTIONS)])
+                   for i in range(requests_per_client)]
+        thread = threading.Thread(target=client, args=(server.server_address[:2], prompts, max_tokens, results))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stats = scheduler.stats()
+    server.stop()
+    scheduler.stop()
+    first = np.array([r[0] for r in results]) * 1000
+    total = np.array([r[1] for r in results]) * 1000
+    return {
+        "requests/s": len(results) / elapsed,
+        "ttft p50": np.percentile(first, 50), "ttft p99": np.percentile(first, 99),
+        "latency p50": np.percentile(total, 50), "latency p99": np.percentile(total, 99),
+        "mean batch": stats["mean_batch"], "prefix reused": stats["prefix_reused_tokens"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the inference server on CPU")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="reference")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=8, help="requests per client")
+    parser.add_argument("--max-tokens", type=int, default=48)
+    parser.add_argument("--devices", type=int, default=4, help="distinct sensor contexts")
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients x {args.requests} requests, {args.backend} backend, "
+          f"prompt ~{len(build_prompt(synthetic_context('sensor-0'), QUESTIONS[0]))} bytes "
+          f"(system prompt {len(SYSTEM_PROMPT)} bytes)")
+    configs = [
+        ("unbatched, no prefix cache", 1, False),
+        ("unbatched, prefix cache", 1, True),
+        ("batched, prefix cache", 16, True),
+    ]
+    print(f"{'':28} {'req/s':>7} {'TTFT p50':>9} {'TTFT p99':>9} {'lat p50':>9} {'lat p99':>9} {'batch':>6}")
+    for label, max_batch, prefix_cache in configs:
+        r = run(args.backend, args.clients, args.requests, max_batch, prefix_cache, args.max_tokens, args.devices)
+        print(f"{label:28} {r['requests/s']:>7.1f} {r['ttft p50']:>7.1f}ms {r['ttft p99']:>7.1f}ms "
+              f"{r['latency p50']:>7.1f}ms {r['latency p99']:>7.1f}ms {r['mean batch']:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
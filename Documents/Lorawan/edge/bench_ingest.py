@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Collector Ingest Benchmark
+Throughput, latency, memory and write volume of the ingest paths, tracked across runs
+"""
+
+import argparse
+import base64
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from replay_server import ReplayServer
+
+APPLICATION_ID = "soil-sensor-saranac"
+FIRST_DEVICE = "lestat-lives"
+START = datetime(2025, 10, 1, tzinfo=timezone.utc)
+SPAN = timedelta(hours=11)   # inside the collectors' last=12h backfill window
+SCENARIOS = ("mqtt", "hybrid", "fleet", "backfill")
+RESULTS_FILE = "results.jsonl"
+BASELINE_RUNS = 5
+# Metric and the direction in which it gets worse
+CHECKED_METRICS = {"msgs_per_s": -1, "callback_p99_ms": 1, "stored_p99_ms": 1,
+                   "max_rss_mb": 1, "disk_bytes_per_msg": 1}
+
+# Parts of the TTN envelope that do not change between uplinks
+VERSION_IDS = {"brand_id": "dragino", "model_id": "lse01", "hardware_version": "_unknown_hw_version_",
+               "firmware_version": "1.1.4", "band_id": "US_902_928"}
+NETWORK_IDS = {"net_id": "000013", "ns_id": "EC656E0000000182", "tenant_id": "ttn",
+               "cluster_id": "nam1", "cluster_address": "nam1.cloud.thethings.network"}
+DATA_RATE = {"lora": {"bandwidth": 125000, "spreading_factor": 7, "coding_rate": "4/5"}}
+
+
+def device_name(n):
+    return FIRST_DEVICE if n == 0 else f"lse01-{n:04d}"
+
+
+def lse01_frame(bat, water, soil_temp, conduct, sensor_flag=1):
+    """Base64 LSE01 frame, the inverse of dragino_codec.decode_bytes"""
+    words = [int(bat * 1000) & 0x3FFF, 3276, int(round(water * 100)),
+             int(round(soil_temp * 100)) & 0xFFFF, conduct]
+    raw = b''.join(w.to_bytes(2, 'big') for w in words) + bytes([sensor_flag << 4])
+    return base64.b64encode(raw).decode('ascii')
+
+
+def timestamp(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f") + "123Z"
+
+
+def synthetic_uplinks(devices, messages, seed=0, undecoded=0.0):
+    """
+    Yield TTN v3 uplink envelopes shaped like soil_data.json records,
+    round-robin over the devices and spread evenly over SPAN. Readings
+    follow a daily cycle plus noise; a share of uplinks (undecoded) comes
+    without decoded_payload so the local codec is exercised too.
+    """
+    rng = random.Random(seed)
+    interval = SPAN / max(math.ceil(messages / devices), 1)
+    for i in range(messages):
+        n, round_number = i % devices, i // devices
+        moment = START + interval * round_number + timedelta(milliseconds=n)
+        received_at = timestamp(moment)
+        phase = 2 * math.pi * (moment.hour * 60 + moment.minute) / 1440
+        bat = round(3.6 - 0.0001 * round_number, 3)
+        water = round(20 + 5 * math.sin(phase + n) + rng.gauss(0, 0.1), 2)
+        soil_temp = round(15 + 4 * math.sin(phase - 1) + rng.gauss(0, 0.05), 2)
+        conduct = max(0, int(40 + 10 * math.sin(phase + n) + rng.gauss(0, 1)))
+        uplink_message = {
+            "f_port": 2, "f_cnt": round_number + 1,
+            "frm_payload": lse01_frame(bat, water, soil_temp, conduct),
+            "decoded_payload": {"Bat": bat, "Hardware_flag": 0, "Interrupt_flag": 0, "Sensor_flag": 1,
+                                "TempC_DS18B20": "327.60", "conduct_SOIL": conduct,
+                                "temp_SOIL": f"{soil_temp:.2f}", "water_SOIL": f"{water:.2f}"},
+            "rx_metadata": [{"gateway_ids": {"gateway_id": "soil-sensor-1", "eui": "A84041FDFE2A7510"},
+                             "time": received_at, "rssi": -25 - rng.randrange(60),
+                             "channel_rssi": -25, "snr": round(rng.uniform(-5, 14), 1),
+                             "channel_index": rng.randrange(8), "received_at": received_at}],
+            "settings": {"data_rate": DATA_RATE, "frequency": "904100000", "time": received_at},
+            "received_at": received_at,
+            "consumed_airtime": "0.061696s",
+            "version_ids": VERSION_IDS,
+            "network_ids": NETWORK_IDS,
+        }
+        if rng.random() < undecoded:
+            del uplink_message["decoded_payload"]
+        yield {
+            "end_device_ids": {"device_id": device_name(n), "application_ids": {"application_id": APPLICATION_ID},
+                               "dev_eui": f"A84041{n:010X}", "dev_addr": f"26{n:06X}"},
+            "received_at": received_at,
+            "uplink_message": uplink_message,
+        }
+
+
+def uplink_topic(uplink):
+    ids = uplink["end_device_ids"]
+    return f"v3/{ids['application_ids']['application_id']}/devices/{ids['device_id']}/up"
+
+
+class LocalBroker:
+    """
+    In-process stand-in for a paho client connected to a broker: connect()
+    runs on_connect, which subscribes as usual, and publish() delivers a
+    real MQTTMessage to on_message when a subscription matches.
+    """
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.userdata = None
+        self.subscriptions = []
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def subscribe(self, topic):
+        # A shared subscription matches like its plain topic filter
+        if topic.startswith("$share/"):
+            topic = topic.split("/", 2)[2]
+        self.subscriptions.append(topic)
+
+    def connect(self):
+        self.on_connect(self, self.userdata, {}, 0)
+
+    def publish(self, topic, payload):
+        if not any(mqtt.topic_matches_sub(sub, topic) for sub in self.subscriptions):
+            return False
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.on_message(self, self.userdata, message)
+        return True
+
+
+class Discard:
+    """stdout sink: the collectors print per record, which is not what is measured"""
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def written_bytes():
+    """Bytes this process has passed to write() so far, where /proc has it"""
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def disk_usage(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+
+def percentiles(seconds):
+    if not seconds:
+        return None, None
+    values = np.asarray(seconds) * 1000
+    return float(np.percentile(values, 50)), float(np.percentile(values, 99))
+
+
+def run_mqtt(scenario, workdir, args):
+    """Publish through the collector's own on_connect/on_message and ingest queue"""
+    from dedup_index import uplink_key
+    from ingest_queue import IngestQueue
+    if scenario == "fleet":
+        import fleet_subscriber as module
+        collector = module.FleetCollector(os.path.join(workdir, "fleet_data"))
+        handle, flush = collector.add_message, collector.save_data
+        topic = f"$share/{args.group}/{module.UPLINK_TOPIC}"
+    else:
+        if scenario == "hybrid":
+            import orin_hybrid as module
+            collector = module.OrinHybridCollector(os.path.join(workdir, "soil_data.json"), args.backend)
+            handle = collector.add_mqtt_message
+        else:
+            import soil_collector as module
+            collector = module.SoilCollector(os.path.join(workdir, "soil_data.json"), args.backend)
+            handle = collector.add_message
+        flush, topic = collector.save_data, None
+
+    enqueued, pending, handled, stored = {}, [], [], []
+
+    def timed_handle(message):
+        started = time.perf_counter()
+        handle(message)
+        handled.append(time.perf_counter() - started)
+        pending.append(uplink_key(message["data"]))
+
+    def timed_flush():
+        flush()
+        now = time.perf_counter()
+        stored.extend(now - enqueued.pop(key) for key in pending)
+        pending.clear()
+
+    ingest = IngestQueue(timed_handle, timed_flush).start()
+    broker = LocalBroker()
+    broker.on_connect = module.on_connect
+    broker.on_message = module.on_message
+    if topic:
+        broker.user_data_set(module.FleetWorker(topic, ingest))
+    else:
+        broker.user_data_set(module.MqttUserdata(ingest, collector.gaps))
+    broker.connect()
+
+    callbacks = []
+    devices = args.devices if scenario == "fleet" else 1
+    delivered = 0
+    started = time.perf_counter()
+    for uplink in synthetic_uplinks(devices, args.messages, args.seed, args.undecoded):
+        payload = json.dumps({"data": uplink}).encode()
+        if args.rate:
+            delay = started + delivered / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        published = time.perf_counter()
+        enqueued[uplink_key(uplink)] = published
+        if broker.publish(uplink_topic(uplink), payload):
+            callbacks.append(time.perf_counter() - published)
+            delivered += 1
+    ingest.stop()
+    elapsed = time.perf_counter() - started
+
+    if scenario == "fleet":
+        collector.close()
+    else:
+        collector.store.close()
+        collector.detector.close()
+        collector.index.close()
+        collector.checkpoint.save()
+    stats = ingest.stats()
+    return {"messages": stats["processed"], "elapsed_s": elapsed, "callback": callbacks,
+            "handle": handled, "stored": stored, "dropped": stats["dropped"], "errors": stats["errors"]}
+
+
+def run_backfill(workdir, args):
+    """Stream from the storage stub through fetch_historical_data/compare_and_reconcile"""
+    import ttn_storage
+    from orin_soil_collector import OrinSoilCollector
+    # The collector streams through the process-wide client at TTN_BASE_URL
+    ttn_storage.TTN_BASE_URL = args.base_url
+    ttn_storage._default_client = None
+
+    collector = OrinSoilCollector(os.path.join(workdir, "soil_data.json"), args.backend)
+    add_new_record = collector.add_new_record
+    handled = []
+
+    def timed_add(api_record):
+        started = time.perf_counter()
+        add_new_record(api_record)
+        handled.append(time.perf_counter() - started)
+
+    collector.add_new_record = timed_add
+    started = time.perf_counter()
+    new_count = collector.compare_and_reconcile(collector.fetch_historical_data())
+    collector.save_data()
+    elapsed = time.perf_counter() - started
+    collector.store.close()
+    collector.detector.close()
+    collector.index.close()
+    collector.checkpoint.save()
+    return {"messages": new_count, "elapsed_s": elapsed, "callback": handled,
+            "handle": handled, "stored": [], "dropped": 0, "errors": 0}
+
+
+def measure(scenario, workdir, args):
+    """Runs in a fresh interpreter so peak RSS belongs to one scenario"""
+    before_disk = disk_usage(workdir)
+    before_written = written_bytes()
+    with contextlib.redirect_stdout(Discard()):
+        if scenario == "backfill":
+            raw = run_backfill(workdir, args)
+        else:
+            raw = run_mqtt(scenario, workdir, args)
+    after_written = written_bytes()
+
+    messages = max(raw["messages"], 1)
+    callback_p50, callback_p99 = percentiles(raw["callback"])
+    handle_p50, handle_p99 = percentiles(raw["handle"])
+    stored_p50, stored_p99 = percentiles(raw["stored"])
+    result = {
+        "messages": raw["messages"],
+        "msgs_per_s": raw["messages"] / raw["elapsed_s"],
+        "callback_p50_ms": callback_p50, "callback_p99_ms": callback_p99,
+        "handle_p50_ms": handle_p50, "handle_p99_ms": handle_p99,
+        "stored_p50_ms": stored_p50, "stored_p99_ms": stored_p99,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "disk_bytes_per_msg": (disk_usage(workdir) - before_disk) / messages,
+        "written_bytes_per_msg": None if before_written is None else (after_written - before_written) / messages,
+        "dropped": raw["dropped"],
+        "errors": raw["errors"],
+    }
+    print(json.dumps(result))
+
+
+def seed_history(template, backend, count):
+    """Stored history the single-device scenarios start from, built once and reused"""
+    from bench_startup import grow
+    data_file = os.path.join(template, "soil_data.json")
+    if not os.path.exists(os.path.join(template, "done")):
+        shutil.rmtree(template, ignore_errors=True)
+        os.makedirs(template)
+        with contextlib.redirect_stdout(Discard()):
+            grow(data_file, backend, 0, count)
+        open(os.path.join(template, "done"), 'w').close()
+
+
+def run_child(scenario, workdir, args, base_url=None):
+    command = [sys.executable, os.path.abspath(__file__), "--measure", scenario, "--workdir", workdir,
+               "--backend", args.backend, "--devices", str(args.devices), "--messages", str(args.messages),
+               "--rate", str(args.rate), "--seed", str(args.seed), "--undecoded", str(args.undecoded),
+               "--group", args.group]
+    if base_url:
+        command += ["--base-url", base_url]
+    output = subprocess.run(command, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def baselines(results_file, runs=BASELINE_RUNS):
+    """
+    Per (scenario, parameters), the median of each metric over the last
+    `runs` recorded results, so one noisy run does not move the baseline.
+    """
+    history = {}
+    if os.path.exists(results_file):
+        with open(results_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    key = (entry["scenario"], json.dumps(entry["params"], sort_keys=True))
+                    history.setdefault(key, []).append(entry)
+    baseline = {}
+    for key, entries in history.items():
+        recent = entries[-runs:]
+        baseline[key] = {"runs": len(recent)}
+        for metric in CHECKED_METRICS:
+            values = [entry[metric] for entry in recent if entry.get(metric) is not None]
+            if values:
+                baseline[key][metric] = float(np.median(values))
+    return baseline
+
+
+def regressions(result, baseline, threshold):
+    """Metrics that got worse than baseline by more than threshold"""
+    found = []
+    for metric, direction in CHECKED_METRICS.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if change * direction > threshold:
+            found.append(f"{metric} {change:+.0%}")
+    return found
+
+
+def format_ms(value):
+    return f"{value:>8.3f}" if value is not None else f"{'-':>8}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark collector ingest and track regressions")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--devices", type=int, default=50, help="devices in the fleet scenario")
+    parser.add_argument("--messages", type=int, default=5000, help="uplinks per scenario")
+    parser.add_argument("--history", type=int, default=0,
+                        help="records already stored before the single-device scenarios start")
+    parser.add_argument("--rate", type=float, default=0.0, help="publish rate in msgs/s (0: as fast as possible)")
+    parser.add_argument("--undecoded", type=float, default=0.0,
+                        help="share of uplinks without decoded_payload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--group", default="edge-ingest", help=argparse.SUPPRESS)
+    parser.add_argument("--dir", default="bench_ingest", help="scratch data and results.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative change that counts as a regression")
+    parser.add_argument("--check", action="store_true", help="exit non-zero if any metric regressed")
+    parser.add_argument("--no-record", action="store_true", help="do not append this run to results.jsonl")
+    parser.add_argument("--measure", metavar="SCENARIO", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.workdir, args)
+        return
+
+    bench_dir = os.path.abspath(args.dir)
+    os.makedirs(bench_dir, exist_ok=True)
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    template = os.path.join(bench_dir, f"history-{args.backend}-{args.history}")
+    if args.history:
+        seed_history(template, args.backend, args.history)
+
+    results_file = os.path.join(bench_dir, RESULTS_FILE)
+    previous = baselines(results_file)
+    revision = git_revision()
+    failed = []
+    print(f"{args.messages} uplinks per scenario, {args.backend} backend, {args.history} stored records, "
+          f"{args.devices} fleet devices, rate {args.rate or 'unlimited'}")
+    print(f"{'scenario':9} {'msgs/s':>9} {'cb p50':>8} {'cb p99':>8} {'store p50':>9} {'store p99':>9} "
+          f"{'RSS MB':>7} {'disk B/msg':>10} {'write B/msg':>11}  vs baseline")
+
+    for scenario in scenarios:
+        workdir = os.path.join(bench_dir, "run", scenario)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if args.history and scenario != "fleet":
+            shutil.copytree(template, workdir)
+        else:
+            os.makedirs(workdir)
+
+        if scenario == "backfill":
+            uplinks = list(synthetic_uplinks(1, args.messages, args.seed, args.undecoded))
+            with ReplayServer(uplinks, chunk_size=64 * 1024) as server:
+                result = run_child(scenario, workdir, args, server.base_url)
+        else:
+            result = run_child(scenario, workdir, args)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+        params = {"backend": args.backend, "messages": args.messages, "history": args.history,
+                  "devices": args.devices if scenario == "fleet" else 1, "rate": args.rate,
+                  "undecoded": args.undecoded}
+        key = (scenario, json.dumps(params, sort_keys=True))
+        comparison = "first run"
+        if key in previous:
+            worse = regressions(result, previous[key], args.threshold)
+            change = result["msgs_per_s"] / previous[key]["msgs_per_s"] - 1
+            comparison = f"{change:+.0%} msgs/s over {previous[key]['runs']} runs"
+            if worse:
+                comparison += "  REGRESSION: " + ", ".join(worse)
+                failed.append(scenario)
+        # Not every platform reports bytes written (/proc/self/io)
+        written = result["written_bytes_per_msg"]
+        written = "n/a" if written is None else round(written)
+        print(f"{scenario:9} {result['msgs_per_s']:>9.0f} {format_ms(result['callback_p50_ms'])} "
+              f"{format_ms(result['callback_p99_ms'])} {format_ms(result['stored_p50_ms'])} "
+              f"{format_ms(result['stored_p99_ms'])} {result['max_rss_mb']:>7.1f} "
+              f"{result['disk_bytes_per_msg']:>10.0f} {written:>11}  {comparison}")
+        if result["dropped"] or result["errors"]:
+            print(f"{'':9} dropped {result['dropped']}, errors {result['errors']}")
+
+        if not args.no_record:
+            entry = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": revision,
+                     "scenario": scenario, "params": params, **result}
+            with open(results_file, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    if args.check and failed:
+        sys.exit(f"Regressed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Collector Startup Benchmark
+Measures collector start time and memory as stored history grows
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from checkpoint import Checkpoint, checkpoint_file_for, open_checkpoint
+from dedup_index import open_dedup_index, uplink_key
+from record_store import open_store
+
+APPLICATION_ID = "soil-sensor-saranac"
+DEVICE_ID = "lestat-lives"
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+# Parts of the TTN envelope that do not change between uplinks
+END_DEVICE_IDS = {"device_id": DEVICE_ID, "application_ids": {"application_id": APPLICATION_ID},
+                  "dev_eui": "A8404187D55BBA3B", "dev_addr": "260C61A2"}
+VERSION_IDS = {"brand_id": "dragino", "model_id": "lse01", "hardware_version": "_unknown_hw_version_",
+               "firmware_version": "1.1.4", "band_id": "US_902_928"}
+NETWORK_IDS = {"net_id": "000013", "ns_id": "EC656E0000000182", "tenant_id": "ttn",
+               "cluster_id": "nam1", "cluster_address": "nam1.cloud.thethings.network"}
+DATA_RATE = {"lora": {"bandwidth": 125000, "spreading_factor": 7, "coding_rate": "4/5"}}
+SENSOR_DATA = {"Bat": 3.594, "Hardware_flag": 0, "Interrupt_flag": 0, "Sensor_flag": 1,
+               "TempC_DS18B20": "327.60", "conduct_SOIL": 11, "temp_SOIL": "15.50", "water_SOIL": "8.27"}
+
+
+def synthetic_record(i):
+    """Collector record for the i-th uplink, one per minute from START"""
+    received_at = (START + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S.000000000Z")
+    uplink = {
+        "end_device_ids": END_DEVICE_IDS,
+        "received_at": received_at,
+        "uplink_message": {
+            "f_port": 2, "f_cnt": i, "frm_payload": "DgoMzAM7Bg4ACxA=",
+            "decoded_payload": SENSOR_DATA,
+            "rx_metadata": [{"gateway_ids": {"gateway_id": "soil-sensor-1"},
+                             "time": received_at, "rssi": -25 - i % 60, "snr": 13.8}],
+            "settings": {"data_rate": DATA_RATE, "frequency": "904100000"},
+            "received_at": received_at,
+            "consumed_airtime": "0.061696s",
+            "version_ids": VERSION_IDS,
+            "network_ids": NETWORK_IDS,
+        },
+    }
+    return {"timestamp": received_at, "device_id": DEVICE_ID,
+            "sensor_data": SENSOR_DATA, "raw_message": {"data": uplink}}
+
+
+def grow(data_file, backend, start, stop):
+    """Append records start..stop-1 the way a collector stores them"""
+    store = open_store(data_file, backend, **({"fsync_every": 100000} if backend == "segments" else {}))
+    index = open_dedup_index(data_file, store)
+    checkpoint = open_checkpoint(data_file, store)
+    for i in range(start, stop):
+        record = synthetic_record(i)
+        store.append(record)
+        index.add(uplink_key(record["raw_message"]["data"]))
+        checkpoint.observe(record)
+        if i % 10000 == 9999:
+            store.flush()
+            index.flush()
+            checkpoint.save()
+    store.close()
+    index.close()
+    checkpoint.save()
+
+
+def measure(data_file, backend, mode):
+    """Runs in a fresh interpreter: start a collector, report time and RSS"""
+    started = time.perf_counter()
+    from soil_collector import SoilCollector
+    imported = time.perf_counter()
+    result = {"import_s": imported - started}
+    if mode == "eager":
+        # What startup cost before checkpoints: parse the whole history
+        records = list(open_store(data_file, backend).iter_records())
+        result["startup_s"] = time.perf_counter() - imported
+        result["records"] = len(records)
+    elif mode == "checkpoint":
+        collector = SoilCollector(data_file, backend)
+        result["startup_s"] = time.perf_counter() - imported
+        result["records"] = collector.checkpoint.count
+        result["high_water_mark"] = collector.high_water_mark()
+        # One lookup against the snapshot to show the index is usable
+        result["lookup_hit"] = collector.data_exists(synthetic_record(0)["raw_message"]["data"])
+        collector.index.close()
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run_child(data_file, backend, mode):
+    command = [sys.executable, os.path.abspath(__file__), "--measure", data_file,
+               "--backend", backend, "--mode", mode]
+    output = subprocess.run(command, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collector startup time and RSS vs. history size")
+    parser.add_argument("--data-file", default="bench_startup/soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma-separated record counts to measure at")
+    parser.add_argument("--eager", action="store_true",
+                        help="also time loading the whole history, as collectors used to")
+    parser.add_argument("--measure", metavar="DATA_FILE", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", default="checkpoint", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(os.path.abspath(args.measure), args.backend, args.mode)
+        return
+
+    data_file = os.path.abspath(args.data_file)
+    os.makedirs(os.path.dirname(data_file), exist_ok=True)
+    baseline = run_child(data_file, args.backend, "imports")
+    print(f"Interpreter + imports: {baseline['import_s']:.3f}s, {baseline['max_rss_mb']:.1f} MB")
+    header = f"{'records':>10} {'generate':>10} {'startup':>9} {'max RSS':>9}"
+    if args.eager:
+        header += f" {'eager load':>11} {'eager RSS':>10}"
+    print(header)
+
+    # Reuse history left by an earlier run instead of regenerating it
+    stored = 0
+    if os.path.exists(checkpoint_file_for(data_file)):
+        previous = Checkpoint(checkpoint_file_for(data_file))
+        previous.load()
+        stored = previous.count
+
+    for size in sorted(int(value) for value in args.sizes.split(',')):
+        started = time.perf_counter()
+        if size > stored:
+            grow(data_file, args.backend, stored, size)
+            stored = size
+        generated = time.perf_counter() - started
+
+        result = run_child(data_file, args.backend, "checkpoint")
+        if result["records"] != stored or not result["lookup_hit"]:
+            raise RuntimeError(f"Unexpected collector state: {result}")
+        line = f"{stored:>10} {generated:>9.1f}s {result['startup_s']:>8.3f}s {result['max_rss_mb']:>6.1f} MB"
+        if args.eager:
+            eager = run_child(data_file, args.backend, "eager")
+            line += f" {eager['startup_s']:>10.3f}s {eager['max_rss_mb']:>7.1f} MB"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Binary Record Format
+Compact, block-compressed storage and archive format for collector records
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+from collections import Counter
+
+from journal import atomic_write_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FILE_MAGIC = b"LRB1"
+BLOCK_MAGIC = b"LRBK"
+FILE_HEADER = struct.Struct("<4sI")           # magic, field dictionary length
+BLOCK_HEADER = struct.Struct("<4sBBIIII")     # magic, serializer, compressor, count,
+                                              # raw size, stored size, crc32 of stored bytes
+SERIALIZERS = {"json": 1, "msgpack": 2}
+COMPRESSORS = {"none": 0, "zlib": 1, "zstd": 2}
+DEFAULT_LEVELS = {"zlib": 6, "zstd": 3}
+SHARED_EXT = 1                                # msgpack ext type: reference to a shared object
+
+# Shape of a collector record carrying a TTN v3 uplink. Its serialized
+# forms are the field dictionary every block is compressed against, so
+# even the small blocks written per MQTT batch do not pay for spelling
+# out the envelope's keys and constant values again.
+TEMPLATE_RECORD = {
+    "timestamp": "2025-10-24T17:40:01.540431990Z",
+    "device_id": "lestat-lives",
+    "sensor_data": {"Bat": 3.594, "Hardware_flag": 0, "Interrupt_flag": 0, "Sensor_flag": 1,
+                    "TempC_DS18B20": "327.60", "conduct_SOIL": 11, "temp_SOIL": "15.50",
+                    "water_SOIL": "8.27"},
+    "raw_message": {"data": {
+        "end_device_ids": {"device_id": "lestat-lives",
+                           "application_ids": {"application_id": "soil-sensor-saranac"},
+                           "dev_eui": "A8404187D55BBA3B", "dev_addr": "260C61A2"},
+        "received_at": "2025-10-24T17:40:01.540431990Z",
+        "uplink_message": {
+            "f_port": 2, "f_cnt": 281, "frm_payload": "DgoMzAM7Bg4ACxA=",
+            "decoded_payload": {"Bat": 3.594, "Hardware_flag": 0, "Interrupt_flag": 0,
+                                "Sensor_flag": 1, "TempC_DS18B20": "327.60", "conduct_SOIL": 11,
+                                "temp_SOIL": "15.50", "water_SOIL": "8.27"},
+            "rx_metadata": [{"gateway_ids": {"gateway_id": "soil-sensor-1", "eui": "A84041FDFE2A7510"},
+                             "time": "2025-10-24T17:40:01.293814Z", "timestamp": 1740052464,
+                             "rssi": -25, "channel_rssi": -25, "snr": 13.8,
+                             "frequency_offset": "-788", "channel_index": 1,
+                             "received_at": "2025-10-24T17:40:01.331278778Z"}],
+            "settings": {"data_rate": {"lora": {"bandwidth": 125000, "spreading_factor": 7,
+                                                "coding_rate": "4/5"}},
+                         "frequency": "904100000", "timestamp": 1740052464,
+                         "time": "2025-10-24T17:40:01.293814Z"},
+            "received_at": "2025-10-24T17:40:01.332818166Z",
+            "consumed_airtime": "0.061696s",
+            "version_ids": {"brand_id": "dragino", "model_id": "lse01",
+                            "hardware_version": "_unknown_hw_version_", "firmware_version": "1.1.4",
+                            "band_id": "US_902_928"},
+            "network_ids": {"net_id": "000013", "ns_id": "EC656E0000000182", "tenant_id": "ttn",
+                            "cluster_id": "nam1", "cluster_address": "nam1.cloud.thethings.network"},
+            "last_battery_percentage": {"f_cnt": 223, "value": 100,
+                                        "received_at": "2025-10-23T22:20:14.077461831Z"},
+        },
+    }},
+}
+
+
+def default_serializer():
+    return "msgpack" if msgpack is not None else "json"
+
+
+def default_compressor():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def field_dictionary():
+    """Compression dictionary built from the template record"""
+    dictionary = json.dumps([TEMPLATE_RECORD], separators=(',', ':')).encode()
+    if msgpack is not None:
+        dictionary += msgpack.packb([TEMPLATE_RECORD], use_bin_type=True)
+    return dictionary
+
+
+def pack_shared(records):
+    """
+    msgpack a block, writing every nested object that occurs more than once
+    in it (end_device_ids, version_ids, network_ids, settings, ...) a
+    single time and referring to it elsewhere. Fewer objects to build is
+    what makes loading faster than json.load. sensor_data is never shared.
+    """
+    nodes = {}
+    counts = Counter()
+    node_of = {}
+
+    def scan(value):
+        # Hash-cons the tree so equal subtrees get the same node number
+        if isinstance(value, dict):
+            key = (dict,) + tuple((k, scan(v)) for k, v in value.items())
+        elif isinstance(value, list):
+            key = (list,) + tuple(scan(v) for v in value)
+        elif value.__class__ is float:
+            return (float, value.hex())  # keeps -0.0 apart from 0.0
+        else:
+            return (value.__class__, value)
+        node = nodes.setdefault(key, len(nodes))
+        counts[node] += 1
+        node_of[id(value)] = node
+        return node
+
+    for record in records:
+        for field, value in record.items():
+            if field != 'sensor_data':
+                scan(value)
+
+    table = []
+    slots = {}
+
+    def build(value):
+        node = node_of.get(id(value))
+        if node is None:
+            return value
+        if node not in slots:
+            if isinstance(value, dict):
+                plain = {k: build(v) for k, v in value.items()}
+            else:
+                plain = [build(v) for v in value]
+            if counts[node] < 2:
+                return plain
+            # Children are added first, so the table can be read in order
+            slots[node] = len(table)
+            table.append(plain)
+        return msgpack.ExtType(SHARED_EXT, slots[node].to_bytes(4, 'little'))
+
+    packed = [{field: value if field == 'sensor_data' else build(value)
+               for field, value in record.items()} for record in records]
+    return (msgpack.packb(len(table))
+            + b''.join(msgpack.packb(entry, use_bin_type=True) for entry in table)
+            + msgpack.packb(packed, use_bin_type=True))
+
+
+def unpack_shared(body):
+    # References are looked up by their raw bytes; converting each one to
+    # an int first cost about a fifth of the load time
+    shared = {}
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(body), 1 << 20),
+                                ext_hook=lambda code, data: shared[data])
+    unpacker.feed(body)
+    for slot in range(unpacker.unpack()):
+        shared[slot.to_bytes(4, 'little')] = unpacker.unpack()
+    return unpacker.unpack()
+
+
+def serialize(records, serializer):
+    """Encode a list of records; returns (serializer actually used, bytes)"""
+    if serializer == "msgpack":
+        try:
+            return serializer, pack_shared(records)
+        except (OverflowError, TypeError, ValueError):
+            pass  # e.g. an integer wider than 64 bits; JSON keeps it exactly
+    return "json", json.dumps(records, separators=(',', ':')).encode()
+
+
+def deserialize(body, serializer_id):
+    if serializer_id == SERIALIZERS["msgpack"]:
+        if msgpack is None:
+            raise RuntimeError("This archive block needs msgpack: pip install msgpack")
+        return unpack_shared(body)
+    return json.loads(body)
+
+
+def compress(body, compressor, level, dictionary):
+    if compressor == "zstd":
+        zdict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return zstandard.ZstdCompressor(level=level, dict_data=zdict).compress(body)
+    if compressor == "zlib":
+        packer = zlib.compressobj(level, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        return packer.compress(body) + packer.flush()
+    return body
+
+
+def decompress(stored, compressor_id, raw_size, dictionary):
+    if compressor_id == COMPRESSORS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("This archive block needs zstandard: pip install zstandard")
+        zdict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(stored, max_output_size=raw_size)
+    if compressor_id == COMPRESSORS["zlib"]:
+        return zlib.decompressobj(zdict=dictionary).decompress(stored)
+    return stored
+
+
+def encode_block(records, dictionary, serializer=None, compressor=None, level=None):
+    """One self-describing block: header followed by the compressed records"""
+    compressor = compressor or default_compressor()
+    if level is None:
+        level = DEFAULT_LEVELS.get(compressor, 0)
+    serializer, body = serialize(records, serializer or default_serializer())
+    stored = compress(body, compressor, level, dictionary)
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, SERIALIZERS[serializer], COMPRESSORS[compressor],
+                               len(records), len(body), len(stored), zlib.crc32(stored))
+    return header + stored
+
+
+def read_file_header(f):
+    """Return the field dictionary, leaving f at the first block"""
+    header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        raise ValueError("Not a binary record file: header missing")
+    magic, length = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC:
+        raise ValueError("Not a binary record file: bad magic")
+    return f.read(length)
+
+
+def iter_blocks(f, dictionary):
+    """
+    Yield (offset, records) for every complete, intact block. Stops at the
+    first torn or corrupt block, which is where a crashed writer left off.
+    """
+    while True:
+        offset = f.tell()
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        magic, serializer_id, compressor_id, count, raw_size, stored_size, crc = \
+            BLOCK_HEADER.unpack(header)
+        if magic != BLOCK_MAGIC:
+            return
+        stored = f.read(stored_size)
+        if len(stored) < stored_size or zlib.crc32(stored) != crc:
+            return
+        records = deserialize(decompress(stored, compressor_id, raw_size, dictionary), serializer_id)
+        yield offset, records
+
+
+def binary_path_for(data_file):
+    """Binary record file used for a given data file"""
+    if data_file.endswith(".lrb"):
+        return data_file
+    return os.path.splitext(data_file)[0] + ".lrb"
+
+
+class BinaryRecordStore:
+    """
+    Records kept as a single file of compressed blocks:
+
+      file header: b"LRB1", dictionary length, field dictionary
+      each block:  b"LRBK", serializer, compressor, record count,
+                   raw size, stored size, crc32, compressed body
+
+    Blocks are msgpack (JSON when msgpack is not installed) compressed with
+    zstd (zlib otherwise) against the field dictionary stored in the file
+    header, so any reader can decode them. Appends are buffered and written
+    as one block every block_records records or on flush(); nothing already
+    written is ever rewritten except by compact(), which merges small blocks.
+
+    Records read from one msgpack block share nested objects that were
+    equal when written, so copy a nested object before mutating it.
+    read_only=True opens an existing file without recovering it; readers
+    already stop at the first torn block.
+    """
+
+    def __init__(self, data_file, block_records=256, serializer=None, compressor=None, level=None,
+                 read_only=False):
+        self.data_file = data_file
+        self.path = binary_path_for(data_file)
+        self.block_records = block_records
+        self.serializer = serializer or default_serializer()
+        self.compressor = compressor or default_compressor()
+        self.level = level
+        self.read_only = read_only
+        self.pending = []
+        self.file = None
+
+        if os.path.exists(self.path) or read_only:
+            with open(self.path, 'rb') as f:
+                self.dictionary = read_file_header(f)
+            if not read_only:
+                self.recover()
+        else:
+            self.dictionary = field_dictionary()
+            self.import_legacy_json()
+
+    def write_new_file(self, path, blocks):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, len(self.dictionary)) + self.dictionary)
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def import_legacy_json(self):
+        """
+        Create the file, seeded from an existing whole-file JSON array. It is
+        written with one atomic replace, so an interrupted import leaves no
+        file behind and runs again on the next open.
+        """
+        from record_store import read_json_records
+
+        records = []
+        if self.data_file.endswith(".json") and os.path.exists(self.data_file):
+            records = read_json_records(self.data_file)
+        blocks = [encode_block(records[i:i + self.block_records], self.dictionary, self.serializer,
+                               self.compressor, self.level)
+                  for i in range(0, len(records), self.block_records)]
+        self.write_new_file(self.path, blocks)
+        if records:
+            print(f"Imported {len(records)} records from {self.data_file} into {self.path}")
+
+    def recover(self):
+        """
+        Truncate a block torn by a crash so appends continue cleanly. Only
+        block headers are walked and only the last block is checksummed,
+        so opening the store does not read the whole history.
+        """
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            read_file_header(f)
+            end = last = f.tell()
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    break
+                magic, _, _, _, _, stored_size, _ = BLOCK_HEADER.unpack(header)
+                if magic != BLOCK_MAGIC or end + BLOCK_HEADER.size + stored_size > size:
+                    break
+                last, end = end, f.seek(stored_size, os.SEEK_CUR)
+            if last < end:
+                f.seek(last)
+                crc = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))[6]
+                if zlib.crc32(f.read(end - last - BLOCK_HEADER.size)) != crc:
+                    end = last
+        if end < size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+            print(f"Truncated torn block at byte {end} of {self.path}")
+
+    def iter_records(self):
+        """Iterate over all stored records, oldest first"""
+        with open(self.path, 'rb') as f:
+            dictionary = read_file_header(f)
+            for _, records in iter_blocks(f, dictionary):
+                yield from records
+        yield from list(self.pending)
+
+    def append(self, record):
+        """Buffer a record; a block is written every block_records records"""
+        self.pending.append(record)
+        if len(self.pending) >= self.block_records:
+            self.write_block()
+
+    def write_block(self):
+        if not self.pending:
+            return
+        if self.read_only:
+            raise ValueError(f"{self.path} is open read-only")
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(encode_block(self.pending, self.dictionary,
+                                     self.serializer, self.compressor, self.level))
+        self.file.flush()
+        self.pending = []
+
+    def flush(self):
+        """Write buffered records as one block and fsync it"""
+        self.write_block()
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def compact(self, key=None):
+        """
+        Rewrite the file in full-size blocks, optionally dropping records
+        whose key(record) was already seen. Returns records dropped.
+        """
+        if self.read_only:
+            raise ValueError(f"{self.path} is open read-only")
+        self.flush()
+        seen = set()
+        dropped = 0
+        blocks = []
+        batch = []
+        for record in self.iter_records():
+            if key is not None:
+                record_key = key(record)
+                if record_key in seen:
+                    dropped += 1
+                    continue
+                seen.add(record_key)
+            batch.append(record)
+            if len(batch) >= self.block_records:
+                blocks.append(encode_block(batch, self.dictionary, self.serializer,
+                                           self.compressor, self.level))
+                batch = []
+        if batch:
+            blocks.append(encode_block(batch, self.dictionary, self.serializer,
+                                       self.compressor, self.level))
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.write_new_file(self.path, blocks)
+        return dropped
+
+    def size_bytes(self):
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def best_time(load, runs=3):
+    """Fastest of a few timed calls of load(), in seconds"""
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def write_json(records, path):
+    """Write records the way the legacy JSON backend does"""
+    atomic_write_json(path, records, indent=2)
+
+
+def main():
+    from record_store import open_store
+
+    parser = argparse.ArgumentParser(description="Convert records to and from the binary format")
+    parser.add_argument("data_file", help="collector data file or .lrb archive")
+    parser.add_argument("--backend", default="segments", help="backend to read data_file from")
+    parser.add_argument("--archive", metavar="OUT", help="write all records to a .lrb archive")
+    parser.add_argument("--restore", metavar="OUT", help="write a .lrb archive back out as JSON")
+    parser.add_argument("--bench", action="store_true",
+                        help="compare load time and size against the JSON file")
+    args = parser.parse_args()
+
+    if args.restore:
+        store = BinaryRecordStore(args.data_file, read_only=True)
+        records = list(store.iter_records())
+        write_json(records, args.restore)
+        print(f"Restored {len(records)} records from {store.path} to {args.restore}")
+        return
+
+    source = open_store(args.data_file, args.backend, read_only=True)
+    records = list(source.iter_records())
+    source.close()
+
+    if args.archive:
+        if os.path.exists(binary_path_for(args.archive)):
+            os.remove(binary_path_for(args.archive))
+        archive = BinaryRecordStore(args.archive)
+        for record in records:
+            archive.append(record)
+        archive.close()
+        size = archive.size_bytes()
+        print(f"Archived {len(records)} records to {archive.path} "
+              f"({size} bytes, {size / max(len(records), 1):.0f} bytes per record)")
+
+    if args.bench:
+        json_path = os.path.splitext(args.data_file)[0] + "_bench.json"
+        binary_path = os.path.splitext(args.data_file)[0] + "_bench.lrb"
+        write_json(records, json_path)
+        if os.path.exists(binary_path):
+            os.remove(binary_path)
+        archive = BinaryRecordStore(binary_path)
+        for record in records:
+            archive.append(record)
+        archive.close()
+
+        def load_json():
+            with open(json_path, 'r') as f:
+                return json.load(f)
+
+        def load_binary():
+            return list(BinaryRecordStore(binary_path, read_only=True).iter_records())
+
+        lossless = load_binary() == records
+        count = len(records)
+        # Only one copy of the records alive while timing, so both loads pay the same GC
+        del records
+        json_seconds = best_time(load_json)
+        binary_seconds = best_time(load_binary)
+
+        print(f"Records: {count}, round trip lossless: {lossless}")
+        print(f"JSON:   {os.path.getsize(json_path):>12} bytes, load {json_seconds:.3f}s")
+        print(f"Binary: {os.path.getsize(binary_path):>12} bytes, load {binary_seconds:.3f}s "
+              f"({archive.serializer} + {archive.compressor}), "
+              f"{json_seconds / binary_seconds:.1f}x faster")
+        os.remove(json_path)
+        os.remove(binary_path)
+
+
+if __name__ == "__main__":
+    main()
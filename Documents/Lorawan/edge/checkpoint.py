@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Collector Checkpoint
+Small startup snapshot of the record count and per-device high-water marks
+"""
+
+import json
+import os
+
+from journal import atomic_write_json
+from record_store import to_ns
+
+
+def device_key(record):
+    """"<application_id>/<device_id>" of a stored collector record"""
+    ids = record.get('raw_message', {}).get('data', {}).get('end_device_ids', {})
+    application_id = ids.get('application_ids', {}).get('application_id') or record.get('application_id')
+    device_id = ids.get('device_id') or record.get('device_id')
+    return f"{application_id}/{device_id}"
+
+
+class Checkpoint:
+    """
+    What a collector needs at startup without reading its history: how many
+    records are stored and the newest received_at per application/device.
+    Kept in <data_file>.checkpoint.json and rewritten on every save. A
+    checkpoint that lags the store after a crash only makes the next
+    backfill re-fetch a few uplinks, which the dedup index then skips.
+    """
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.count = 0
+        self.high_water = {}
+        self.high_water_ns = {}
+        self.dirty = False
+
+    def observe(self, record):
+        """Account for a newly stored record"""
+        self.count += 1
+        self.dirty = True
+        received_at = record.get('raw_message', {}).get('data', {}).get('received_at')
+        if not received_at:
+            return
+        key = device_key(record)
+        ns = to_ns(received_at)
+        if ns > self.high_water_ns.get(key, -1):
+            self.high_water[key] = received_at
+            self.high_water_ns[key] = ns
+
+    def high_water_mark(self, device_id=None, application_id=None):
+        """Newest received_at stored, optionally for one device"""
+        latest = None
+        for key, ns in self.high_water_ns.items():
+            app, device = key.split('/', 1)
+            if device_id and device != device_id:
+                continue
+            if application_id and app != application_id:
+                continue
+            if latest is None or ns > self.high_water_ns[latest]:
+                latest = key
+        return self.high_water[latest] if latest else None
+
+    def load(self):
+        with open(self.checkpoint_file, 'r') as f:
+            state = json.load(f)
+        self.count = state["count"]
+        self.high_water = state["high_water"]
+        self.high_water_ns = {key: to_ns(value) for key, value in self.high_water.items()}
+        self.dirty = False
+
+    def build(self, records):
+        """Rebuild the checkpoint by scanning stored records once"""
+        self.count = 0
+        self.high_water = {}
+        self.high_water_ns = {}
+        for record in records:
+            self.observe(record)
+        self.dirty = True
+        self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        atomic_write_json(self.checkpoint_file, {"count": self.count, "high_water": self.high_water},
+                          indent=2, sort_keys=True)
+        self.dirty = False
+
+
+def checkpoint_file_for(data_file):
+    """Path of the checkpoint stored next to a collector data file"""
+    return os.path.splitext(data_file)[0] + ".checkpoint.json"
+
+
+def open_checkpoint(data_file, store):
+    """Open the checkpoint for a data file, building it once if missing"""
+    checkpoint = Checkpoint(checkpoint_file_for(data_file))
+    try:
+        checkpoint.load()
+    except (OSError, ValueError, KeyError):
+        checkpoint.build(store.iter_records())
+        print(f"Built checkpoint for {checkpoint.count} records")
+    return checkpoint
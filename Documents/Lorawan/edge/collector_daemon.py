@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Collector Daemon
+Real-time MQTT and scheduled incremental backfills in one long-running process
+"""
+
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+import paho.mqtt.client as mqtt
+
+from backfill_scheduler import DEFAULT_RATE_LIMIT, RateLimiter, load_inventory
+from ingest_queue import IngestQueue
+from instrumentation import DEDUP_HITS, REGISTRY, get_logger, setup
+from orin_hybrid import OrinHybridCollector
+from ttn_storage import DEFAULT_APPLICATION, DEFAULT_DEVICE, StorageClient
+
+RECONCILE_BATCH = 256
+COMMANDS = ("status", "reconcile", "flush", "stop")
+
+log = get_logger("collector_daemon")
+BACKFILL_RUNS = REGISTRY.counter("collector_backfill_runs_total", "Incremental backfill cycles, by trigger")
+
+
+class CollectorDaemon:
+    """
+    One process that keeps a collector open and warm: the store, dedup
+    index, checkpoint and a pooled Storage API session stay in memory
+    between cycles.
+
+    MQTT payloads go through an IngestQueue whose writer thread is the
+    only one that touches the collector. The main thread runs the backfill
+    schedule: every `interval` seconds, and on demand, it streams each
+    device's uplinks after its high-water mark and submits them to the
+    writer thread in batches, so a cycle costs one request per device plus
+    the uplinks that are actually new. Uplinks missed before the high-water
+    mark are fetched by the collector's gap tracker, one narrow time window
+    per gap. A reconnect to the broker triggers a cycle that fetches only
+    the disconnected window.
+    """
+
+    def __init__(self, collector, devices, rate_limits=None, interval=900.0, last="12h", client=None):
+        self.collector = collector
+        self.devices = devices
+        self.interval = interval
+        self.last = last
+        self.client = client or StorageClient()
+        rate_limits = rate_limits or {}
+        self.limiters = {
+            application_id: RateLimiter(rate_limits.get(application_id, DEFAULT_RATE_LIMIT))
+            for application_id, _ in devices
+        }
+        self.ingest = IngestQueue(collector.add_mqtt_message, collector.save_data)
+        self.requests = queue.Queue()
+        self.started = time.time()
+        self.next_backfill = time.monotonic()
+        self.backfills = 0
+        self.last_backfill = None
+        self.connected = False
+        self.connections = 0
+
+    def put(self, payload):
+        """MQTT userdata hook: queue a raw payload for the writer thread"""
+        return self.ingest.put(payload)
+
+    def on_writer(self, function):
+        """Run function() on the writer thread; returns a Future of its result"""
+        future = Future()
+
+        def task():
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+        self.ingest.submit(task)
+        return future
+
+    def request_backfill(self, trigger):
+        """Ask the main loop for a backfill cycle; returns a Future of records added"""
+        future = Future()
+        self.requests.put((trigger, future))
+        return future
+
+    def reconcile(self, uplinks, added):
+        """Writer thread: store the uplinks the collector has not seen yet"""
+        for uplink in uplinks:
+            if self.collector.data_exists(uplink):
+                DEDUP_HITS.inc(source="storage")
+                continue
+            self.collector.add_historical_record(uplink)
+            added[0] += 1
+
+    def submit_batches(self, uplinks, added):
+        """Hand uplinks to the writer thread in batches; returns how many"""
+        fetched = 0
+        batch = []
+        try:
+            for uplink in uplinks:
+                batch.append(uplink)
+                if len(batch) >= RECONCILE_BATCH:
+                    self.ingest.submit(partial(self.reconcile, batch, added))
+                    fetched += len(batch)
+                    batch = []
+        finally:
+            if batch:
+                self.ingest.submit(partial(self.reconcile, batch, added))
+                fetched += len(batch)
+        return fetched
+
+    def throttle(self, application_id):
+        limiter = self.limiters.get(application_id)
+        if limiter is not None:
+            limiter.acquire()
+
+    def backfill(self, trigger):
+        """
+        Fetch every device's uplinks since its high-water mark, then the
+        time windows of uplinks the gap tracker knows were missed; returns
+        records added. After a reconnect the disconnected time is one of
+        those windows, so only the gaps are fetched.
+        """
+        started = time.perf_counter()
+        BACKFILL_RUNS.inc(trigger=trigger)
+        added = [0]
+        fetched = 0
+        failed = []
+        devices = () if trigger == "reconnect" else self.devices
+        for application_id, device_id in devices:
+            after = self.collector.checkpoint.high_water.get(f"{application_id}/{device_id}")
+            try:
+                uplinks = self.client.iter_uplinks(application_id, device_id, last=self.last, after=after,
+                                                   before_request=partial(self.throttle, application_id))
+                fetched += self.submit_batches(uplinks, added)
+            except Exception as e:
+                log.error("Backfill failed for %s/%s: %s", application_id, device_id, e)
+                failed.append(f"{application_id}/{device_id}")
+        # Let the writer thread catch up, so uplinks just fetched count as seen
+        self.on_writer(lambda: None).result()
+        gap_fetched = self.submit_batches(self.collector.gaps.fetch(self.client, self.throttle), added)
+        self.on_writer(lambda: None).result()
+
+        elapsed = time.perf_counter() - started
+        self.backfills += 1
+        self.last_backfill = {"trigger": trigger, "finished": time.time(), "seconds": round(elapsed, 3),
+                              "fetched": fetched, "gap_fetched": gap_fetched, "added": added[0],
+                              "failed": failed}
+        log.info("Backfill (%s): %d new of %d fetched uplinks (%d from gaps) in %.2fs",
+                 trigger, added[0], fetched + gap_fetched, gap_fetched, elapsed)
+        return added[0]
+
+    def run(self):
+        """Main loop: scheduled and requested backfills until stop()"""
+        self.ingest.start()
+        while True:
+            timeout = max(0.0, self.next_backfill - time.monotonic())
+            try:
+                pending = [self.requests.get(timeout=timeout)]
+            except queue.Empty:
+                pending = [("schedule", None)]
+            # Requests that piled up during the last cycle share one cycle
+            while not self.requests.empty():
+                pending.append(self.requests.get_nowait())
+            if any(trigger is None for trigger, _ in pending):
+                for _, future in pending:
+                    if future is not None:
+                        future.cancel()
+                break
+
+            futures = [future for _, future in pending if future is not None]
+            try:
+                added = self.backfill(pending[0][0])
+            except Exception as e:
+                log.error("Backfill cycle failed: %s", e)
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(added)
+            self.next_backfill = time.monotonic() + self.interval
+
+    def stop(self):
+        self.requests.put((None, None))
+
+    def close(self):
+        """Drain the ingest queue and make everything durable"""
+        self.ingest.stop()
+        self.collector.store.close()
+        self.collector.detector.close()
+        self.collector.index.close()
+        self.collector.checkpoint.save()
+        self.collector.gaps.save()
+        self.client.close()
+
+    def status(self):
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "records": self.collector.checkpoint.count,
+            "high_water": dict(self.collector.checkpoint.high_water),
+            "gaps": self.collector.gaps.report(),
+            "mqtt_connected": self.connected,
+            "mqtt_connections": self.connections,
+            "queue": self.ingest.stats(),
+            "backfills": self.backfills,
+            "last_backfill": self.last_backfill,
+            "next_backfill_in_s": round(max(0.0, self.next_backfill - time.monotonic()), 1),
+        }
+
+    def command(self, name):
+        """Handle one control socket command; returns a JSON-able reply"""
+        if name == "status":
+            return {"ok": True, **self.status()}
+        if name == "reconcile":
+            started = time.perf_counter()
+            added = self.request_backfill("control").result()
+            return {"ok": True, "added": added, "seconds": round(time.perf_counter() - started, 3)}
+        if name == "flush":
+            self.on_writer(self.collector.save_data).result()
+            return {"ok": True, "records": self.collector.checkpoint.count}
+        if name == "stop":
+            self.stop()
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown command {name!r}, expected one of {', '.join(COMMANDS)}"}
+
+
+class ControlHandler(StreamRequestHandler):
+    """One command per line in, one JSON reply per line out"""
+
+    def handle(self):
+        for line in self.rfile:
+            name = line.decode('utf-8', 'replace').strip()
+            if not name:
+                continue
+            try:
+                reply = self.server.collector_daemon.command(name)
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ControlServer(ThreadingMixIn, UnixStreamServer):
+    """Control socket; only the owning user can connect"""
+
+    daemon_threads = True
+
+    def __init__(self, collector_daemon, path):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ControlHandler)
+        os.chmod(path, 0o600)
+        self.collector_daemon = collector_daemon
+        self.path = path
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="control", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def send_command(path, name, timeout=300):
+    """Client side of the control socket"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(name.encode() + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    return json.loads(reply)
+
+
+def on_connect(client, userdata, flags, rc, properties=None):
+    if rc == 0:
+        client.subscribe(userdata.topic)
+        log.info("Connected to MQTT, subscribed to %s", userdata.topic)
+        userdata.collector_daemon.connected = True
+        userdata.collector_daemon.connections += 1
+        # Uplinks published while we were away are only in TTN storage
+        userdata.collector_daemon.collector.gaps.connected()
+        if userdata.collector_daemon.connections > 1:
+            userdata.collector_daemon.request_backfill("reconnect")
+    else:
+        log.warning("MQTT connection failed: %s", rc)
+
+
+def on_message(client, userdata, msg, properties=None):
+    userdata.collector_daemon.put(msg.payload)
+
+
+def on_disconnect(client, userdata, *args):
+    userdata.collector_daemon.connected = False
+    userdata.collector_daemon.collector.gaps.disconnected()
+    log.warning("Disconnected from MQTT broker")
+
+
+class MqttUserdata:
+    def __init__(self, collector_daemon, topic):
+        self.collector_daemon = collector_daemon
+        self.topic = topic
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-running collector: MQTT plus scheduled incremental backfills")
+    parser.add_argument("--data-file", default="orin_soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--inventory", help="device inventory JSON (see backfill_scheduler.py); default one device")
+    parser.add_argument("--interval", type=float, default=900.0, help="seconds between scheduled backfills")
+    parser.add_argument("--last", default="12h", help="window for devices without a high-water mark")
+    parser.add_argument("--socket", default="collector.sock", help="control socket path")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--username", default="soil-sensor-saranac@ttn")
+    parser.add_argument("--password", default="YOUR_MQTT_PASSWORD")
+    parser.add_argument("--topic", default=f"v3/{DEFAULT_APPLICATION}/devices/{DEFAULT_DEVICE}/up")
+    parser.add_argument("--no-mqtt", action="store_true", help="scheduled backfills only")
+    parser.add_argument("--ctl", metavar="COMMAND", choices=COMMANDS,
+                        help="send a command to a running daemon and print the reply")
+    args = parser.parse_args()
+
+    if args.ctl:
+        print(json.dumps(send_command(args.socket, args.ctl), indent=2))
+        return
+
+    setup()
+    if args.inventory:
+        devices, rate_limits = load_inventory(args.inventory)
+    else:
+        devices, rate_limits = [(DEFAULT_APPLICATION, DEFAULT_DEVICE)], {}
+    collector = OrinHybridCollector(args.data_file, args.backend)
+    daemon = CollectorDaemon(collector, devices, rate_limits, interval=args.interval, last=args.last)
+    control = ControlServer(daemon, args.socket).start()
+    log.info("Collector daemon: %d device(s), backfill every %.0fs, control socket %s",
+             len(devices), args.interval, args.socket)
+
+    client = None
+    if not args.no_mqtt:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.on_disconnect = on_disconnect
+        client.user_data_set(MqttUserdata(daemon, args.topic))
+        client.username_pw_set(args.username, args.password)
+        # Connects (and reconnects) in the background; backfills run regardless
+        client.connect_async(args.host, args.port, 60)
+        client.loop_start()
+
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        log.info("Stopping collector daemon...")
+    finally:
+        if client is not None:
+            client.disconnect()
+            client.loop_stop()
+        control.stop()
+        daemon.close()
+        log.info("Final count: %d records, queue stats %s", collector.checkpoint.count, daemon.ingest.stats())
+
+
+if __name__ == "__main__":
+    main()
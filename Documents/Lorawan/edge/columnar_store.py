@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Columnar Sensor Store
+Typed, memory-mappable per-field arrays for decoded soil sensor readings
+"""
+
+import argparse
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from journal import atomic_write, atomic_write_json
+from record_store import to_ns
+
+# Decoded Dragino fields: (column dtype, how TTN's decoder renders the value)
+SENSOR_FIELDS = {
+    "Bat": ("<f4", "number"),
+    "TempC_DS18B20": ("<f4", "fixed2"),
+    "temp_SOIL": ("<f4", "fixed2"),
+    "water_SOIL": ("<f4", "fixed2"),
+    "conduct_SOIL": ("<i4", "int"),
+    "Sensor_flag": ("u1", "int"),
+    "Hardware_flag": ("u1", "int"),
+    "Interrupt_flag": ("u1", "int"),
+}
+INDEX_COLUMNS = {
+    "time": "<i8",   # received_at, nanoseconds since the epoch (UTC)
+    "f_cnt": "<u4",
+}
+COLUMNS = dict(INDEX_COLUMNS, **{field: dtype for field, (dtype, _) in SENSOR_FIELDS.items()})
+COLD_FILE = "cold.jsonl.gz"
+MANIFEST_FILE = "chunk.json"
+PENDING_FILE = "pending.json"
+DECODED_MARKER = "_decoded_is_sensor_data"
+
+
+def missing_value(dtype):
+    """Placeholder stored when a reading lacks a field"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'u':
+        return np.iinfo(dtype).max
+    return np.iinfo(dtype).min
+
+
+def from_ns(ns):
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc)
+
+
+def encode_value(value, dtype, style):
+    """Return the column value if it renders back exactly, else None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        if style == "int":
+            if not isinstance(value, int):
+                return None
+            info = np.iinfo(np.dtype(dtype))
+            # The top/bottom value is reserved as the "missing" marker
+            if not info.min < value < info.max:
+                return None
+            return value
+        number = np.float32(float(value))
+    except (TypeError, ValueError):
+        return None
+    if style == "fixed2" and isinstance(value, str) and f"{float(number):.2f}" == value:
+        return number
+    if style == "number" and isinstance(value, (int, float)) and float(str(number)) == value:
+        return number
+    return None
+
+
+def decode_value(value, style):
+    """Render a column value the way TTN's decoder does"""
+    if style == "int":
+        return int(value)
+    if style == "fixed2":
+        return f"{float(value):.2f}"
+    return float(str(np.float32(value)))
+
+
+def uplink_of(record):
+    return record.get('raw_message', {}).get('data', {})
+
+
+def split_record(record):
+    """Split a collector record into column values and a cold remainder"""
+    uplink = uplink_of(record)
+    received_at = uplink.get('received_at') or record.get('timestamp')
+    row = {
+        "time": to_ns(received_at),
+        "f_cnt": uplink.get('uplink_message', {}).get('f_cnt', 0),
+    }
+
+    sensor = record.get('sensor_data') or {}
+    # Values the fault detector marked invalid stay out of the columns, so
+    # column readers see them as missing; the cold row keeps them
+    invalid = (record.get('quality') or {}).get('invalid') or {}
+    leftover = {}
+    for field, value in sensor.items():
+        encoded = None
+        if field in SENSOR_FIELDS and field not in invalid:
+            encoded = encode_value(value, *SENSOR_FIELDS[field])
+        if encoded is None:
+            leftover[field] = value
+        else:
+            row[field] = encoded
+
+    cold = dict(record)
+    cold['sensor_data'] = leftover
+    uplink_message = uplink.get('uplink_message', {})
+    if 'decoded_payload' in uplink_message and uplink_message['decoded_payload'] == sensor:
+        # Drop the second copy of the decoded payload; it is rebuilt on read
+        uplink_message = dict(uplink_message)
+        del uplink_message['decoded_payload']
+        cold['raw_message'] = dict(record['raw_message'])
+        cold['raw_message']['data'] = dict(uplink, uplink_message=uplink_message)
+        cold[DECODED_MARKER] = True
+    return row, cold
+
+
+def join_record(row, cold):
+    """Inverse of split_record"""
+    record = dict(cold)
+    sensor = dict(record.get('sensor_data') or {})
+    for field, (dtype, style) in SENSOR_FIELDS.items():
+        value = row[field]
+        if field in sensor or (np.dtype(dtype).kind == 'f' and np.isnan(value)):
+            continue
+        if np.dtype(dtype).kind != 'f' and value == missing_value(dtype):
+            continue
+        sensor[field] = decode_value(value, style)
+    record['sensor_data'] = dict(sorted(sensor.items()))
+
+    if record.pop(DECODED_MARKER, False):
+        uplink = record['raw_message']['data']
+        uplink['uplink_message']['decoded_payload'] = dict(record['sensor_data'])
+    return record
+
+
+class ColumnarStore:
+    """
+    Readings stored as one flat array file per field, per device and per
+    UTC day: <root>/<device_id>/<YYYYMMDD>/<field>.bin. Files hold raw
+    little-endian values, so readers np.memmap just the columns they need.
+    Everything that is not a decoded reading (TTN envelope, rx_metadata,
+    unknown fields) goes to a gzip-compressed cold.jsonl.gz in the same
+    chunk, one line per row.
+
+    Each chunk's chunk.json holds its committed row count and cold file
+    size and is written last, after the columns and the cold member are
+    fsynced; readers never look past it. The chunks a flush is about to
+    write are listed in <root>/pending.json first, so opening the store
+    after a crash cuts just those chunks back to their manifests before
+    anything is appended after the torn rows. read_only=True skips that
+    recovery and refuses writes.
+
+    Works as a record_store backend: append/flush/iter_records/iter_from/close.
+    """
+
+    def __init__(self, data_file, flush_rows=256, read_only=False):
+        self.data_file = data_file
+        self.root = os.path.splitext(data_file)[0] + "_columns"
+        self.flush_rows = flush_rows
+        self.read_only = read_only
+        self.buffers = {}
+        self.buffered = 0
+        if read_only:
+            if not os.path.isdir(self.root):
+                raise FileNotFoundError(f"No columnar store at {self.root}")
+            return
+        os.makedirs(self.root, exist_ok=True)
+        self.recover()
+
+    def chunk_dir(self, device_id, day):
+        return os.path.join(self.root, device_id, day)
+
+    def devices(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def days(self, device_id):
+        directory = os.path.join(self.root, device_id)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.listdir(directory))
+
+    def append(self, record):
+        row, cold = split_record(record)
+        device_id = record.get('device_id') or uplink_of(record).get(
+            'end_device_ids', {}).get('device_id', 'unknown')
+        day = from_ns(row['time']).strftime("%Y%m%d")
+        self.buffers.setdefault((device_id, day), []).append((row, cold))
+        self.buffered += 1
+        if self.buffered >= self.flush_rows:
+            self.flush()
+
+    def manifest(self, directory):
+        """Committed (rows, cold file bytes) of a chunk; (0, 0) before its first commit"""
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0, 0
+        return state["rows"], state["cold_bytes"]
+
+    def truncate_chunk(self, directory):
+        """Cut column and cold bytes past the manifest; returns (rows, cold bytes)"""
+        rows, cold_bytes = self.manifest(directory)
+        for column, dtype in COLUMNS.items():
+            path = os.path.join(directory, f"{column}.bin")
+            size = rows * np.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+        cold_path = os.path.join(directory, COLD_FILE)
+        cold_size = os.path.getsize(cold_path) if os.path.exists(cold_path) else 0
+        if cold_size > cold_bytes:
+            with open(cold_path, 'r+b') as f:
+                f.truncate(cold_bytes)
+                os.fsync(f.fileno())
+        return rows, min(cold_size, cold_bytes)
+
+    def recover(self):
+        """Cut the chunks of a flush interrupted by a crash back to their manifests"""
+        pending_path = os.path.join(self.root, PENDING_FILE)
+        if not os.path.exists(pending_path):
+            return
+        with open(pending_path, 'r') as f:
+            pending = json.load(f)
+        for device_id, day in pending:
+            directory = self.chunk_dir(device_id, day)
+            if os.path.isdir(directory):
+                self.truncate_chunk(directory)
+        os.remove(pending_path)
+        print(f"Recovered {len(pending)} chunks of an interrupted flush in {self.root}")
+
+    def flush(self):
+        """Append buffered rows to their chunk files"""
+        if not self.buffers:
+            return
+        if self.read_only:
+            raise ValueError(f"{self.root} is open read-only")
+        pending_path = os.path.join(self.root, PENDING_FILE)
+        atomic_write_json(pending_path, sorted(self.buffers))
+        for (device_id, day), rows in self.buffers.items():
+            directory = self.chunk_dir(device_id, day)
+            os.makedirs(directory, exist_ok=True)
+            committed, cold_bytes = self.truncate_chunk(directory)
+            for column, dtype in COLUMNS.items():
+                values = np.array(
+                    [row.get(column, missing_value(dtype)) for row, _ in rows], dtype=dtype)
+                with open(os.path.join(directory, f"{column}.bin"), 'ab') as f:
+                    f.write(values.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            # Each flush appends one gzip member; compact() merges them
+            member = gzip.compress(b''.join(
+                json.dumps(cold, separators=(',', ':')).encode() + b'\n' for _, cold in rows))
+            with open(os.path.join(directory, COLD_FILE), 'ab') as f:
+                f.write(member)
+                f.flush()
+                os.fsync(f.fileno())
+            atomic_write_json(os.path.join(directory, MANIFEST_FILE),
+                              {"rows": committed + len(rows), "cold_bytes": cold_bytes + len(member)})
+        self.buffers = {}
+        self.buffered = 0
+        os.remove(pending_path)
+
+    def read_chunk(self, directory, fields):
+        rows, _ = self.manifest(directory)
+        columns = {}
+        for field in fields:
+            path = os.path.join(directory, f"{field}.bin")
+            if rows == 0:
+                columns[field] = np.empty(0, dtype=COLUMNS[field])
+            else:
+                columns[field] = np.memmap(path, dtype=COLUMNS[field], mode='r', shape=(rows,))
+        return columns
+
+    def read(self, device_id, fields=("temp_SOIL", "water_SOIL"), start=None, end=None):
+        """
+        Return {field: ndarray} for one device, optionally limited to
+        start <= time < end (datetimes or ns). Only the requested columns
+        and the day chunks overlapping the range are touched.
+        """
+        if isinstance(start, datetime):
+            start = int(start.timestamp() * 1e9)
+        if isinstance(end, datetime):
+            end = int(end.timestamp() * 1e9)
+        fields = ["time"] + [field for field in fields if field != "time"]
+
+        parts = {field: [] for field in fields}
+        for day in self.days(device_id):
+            day_start = to_ns(f"{day[:4]}-{day[4:6]}-{day[6:]}T00:00:00Z")
+            if end is not None and day_start >= end:
+                continue
+            if start is not None and day_start + 86_400_000_000_000 <= start:
+                continue
+            columns = self.read_chunk(self.chunk_dir(device_id, day), fields)
+            mask = np.ones(len(columns["time"]), dtype=bool)
+            if start is not None:
+                mask &= columns["time"] >= start
+            if end is not None:
+                mask &= columns["time"] < end
+            for field in fields:
+                parts[field].append(np.asarray(columns[field][mask]))
+        return {
+            field: np.concatenate(arrays) if arrays else np.empty(0, dtype=COLUMNS[field])
+            for field, arrays in parts.items()
+        }
+
+    def read_cold(self, device_id, day):
+        """All cold rows of one chunk, in row order"""
+        directory = self.chunk_dir(device_id, day)
+        path = os.path.join(directory, COLD_FILE)
+        if not os.path.exists(path):
+            return []
+        _, cold_bytes = self.manifest(directory)
+        with open(path, 'rb') as f:
+            data = f.read(cold_bytes)
+        return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+    def iter_records(self):
+        """Rebuild full collector records, device by device, day by day"""
+        for device_id in self.devices():
+            for day in self.days(device_id):
+                directory = self.chunk_dir(device_id, day)
+                columns = self.read_chunk(directory, list(COLUMNS))
+                cold_rows = self.read_cold(device_id, day)
+                for i, cold in enumerate(cold_rows[:len(columns["time"])]):
+                    yield join_record({field: columns[field][i] for field in COLUMNS}, cold)
+
+    def iter_from(self, cursor):
+        """
+        Yield (record, cursor after it) for rows committed since cursor
+        {"chunks": {"<device_id>/<day>": rows}} ({} is the beginning).
+        Rows are only ever added at the end of a chunk, so the committed
+        row count of each chunk is a position that later appends, to any
+        day, never invalidate. The cursor dict is updated in place; save
+        it before advancing the iterator if a snapshot is needed.
+        """
+        chunks = dict(cursor.get("chunks", {}))
+        position = {"chunks": chunks}
+        for device_id in self.devices():
+            for day in self.days(device_id):
+                key = f"{device_id}/{day}"
+                directory = self.chunk_dir(device_id, day)
+                done = chunks.get(key, 0)
+                if self.manifest(directory)[0] <= done:
+                    continue
+                columns = self.read_chunk(directory, list(COLUMNS))
+                cold_rows = self.read_cold(device_id, day)
+                for i in range(done, min(len(columns["time"]), len(cold_rows))):
+                    chunks[key] = i + 1
+                    yield join_record({field: columns[field][i] for field in COLUMNS}, cold_rows[i]), position
+
+    def compact(self, key=None):
+        """Merge each chunk's cold gzip members into one, for better ratio"""
+        if self.read_only:
+            raise ValueError(f"{self.root} is open read-only")
+        self.flush()
+        for device_id in self.devices():
+            for day in self.days(device_id):
+                directory = self.chunk_dir(device_id, day)
+                rows, cold_bytes = self.manifest(directory)
+                data = gzip.compress(b''.join(
+                    json.dumps(cold, separators=(',', ':')).encode() + b'\n'
+                    for cold in self.read_cold(device_id, day)))
+                # Only a smaller file is installed: if the manifest update below
+                # is lost, reads and recovery still take the whole file
+                if len(data) >= cold_bytes:
+                    continue
+                atomic_write(os.path.join(directory, COLD_FILE), data)
+                atomic_write_json(os.path.join(directory, MANIFEST_FILE), {"rows": rows, "cold_bytes": len(data)})
+        return 0
+
+    def size_bytes(self):
+        total = 0
+        for directory, _, files in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        return total
+
+    def close(self):
+        self.flush()
+
+
+def main():
+    from record_store import open_store
+
+    parser = argparse.ArgumentParser(description="Convert collector records to the columnar store")
+    parser.add_argument("data_file", help="collector data file, e.g. soil_data.json")
+    parser.add_argument("--backend", default="segments", help="backend to read from")
+    parser.add_argument("--out", help="output data file name (default: <data_file>)")
+    args = parser.parse_args()
+
+    source = open_store(args.data_file, args.backend, read_only=True)
+    target = ColumnarStore(args.out or args.data_file)
+    count = 0
+    for record in source.iter_records():
+        target.append(record)
+        count += 1
+    target.compact()
+    source.close()
+
+    size = target.size_bytes()
+    print(f"Converted {count} records into {target.root}")
+    if count:
+        print(f"Columnar size: {size} bytes ({size / count:.0f} bytes per reading)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Shared pytest fixtures: synthetic uplinks, the records collectors build
+from them and store helpers, and local Storage API and sync servers
+"""
+
+import pytest
+
+from bench_ingest import synthetic_uplinks
+from dragino_codec import sensor_data_for
+from export_sync import SyncServer
+from record_store import open_store
+from replay_server import ReplayServer
+
+DEVICES = 4
+MESSAGES = 200   # 50 uplinks per device, f_cnt 1..50
+
+
+def collector_record(uplink):
+    """The record a collector stores for an uplink"""
+    ids = uplink["end_device_ids"]
+    return {
+        "timestamp": uplink["received_at"],
+        "device_id": ids["device_id"],
+        "application_id": ids["application_ids"]["application_id"],
+        "sensor_data": sensor_data_for(uplink["uplink_message"]),
+        "raw_message": {"data": uplink},
+    }
+
+
+def write_records(data_file, backend, records):
+    store = open_store(data_file, backend)
+    for record in records:
+        store.append(record)
+    store.close()
+
+
+def read_records(data_file, backend):
+    store = open_store(data_file, backend, read_only=True)
+    try:
+        return list(store.iter_records())
+    finally:
+        store.close()
+
+
+def f_cnt(uplink):
+    return uplink["uplink_message"]["f_cnt"]
+
+
+@pytest.fixture
+def uplinks():
+    return list(synthetic_uplinks(DEVICES, MESSAGES))
+
+
+@pytest.fixture
+def replay_server():
+    """Start a ReplayServer over a list of uplinks; stopped after the test"""
+    servers = []
+
+    def start(uplinks, **options):
+        server = ReplayServer(uplinks, **options).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def sync_server(tmp_path):
+    server = SyncServer(tmp_path / "target").start()
+    yield server
+    server.stop()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Uplink Dedup Index
+Persistent hashed index of uplinks already stored by a collector
+"""
+
+import hashlib
+import os
+from array import array
+
+import numpy as np
+
+SNAPSHOT_HEADER = 8       # uint64: journal entries covered by the snapshot
+CHECKPOINT_EVERY = 4096   # unsnapshotted digests that trigger a merge
+
+
+def uplink_key(uplink):
+    """Dedup key of a TTN uplink envelope: (device_id, f_cnt, received_at)"""
+    device_id = uplink.get('end_device_ids', {}).get('device_id', '')
+    # TTN omits zero-valued fields, so the first frame has no f_cnt
+    f_cnt = uplink.get('uplink_message', {}).get('f_cnt', 0)
+    received_at = uplink.get('received_at', '')
+    return (device_id, f_cnt, received_at)
+
+
+def record_key(record):
+    """Dedup key of a stored collector record"""
+    uplink = record.get('raw_message', {}).get('data', {})
+    device_id, f_cnt, received_at = uplink_key(uplink)
+    return (device_id or record.get('device_id', ''), f_cnt, received_at)
+
+
+def key_digest(key):
+    """Hash a dedup key down to a 64-bit integer"""
+    text = "\x1f".join(str(part) for part in key)
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+
+class DedupIndex:
+    """
+    Set of 64-bit key digests. New digests are appended to a journal of
+    little-endian uint64 values (<data_file>.dedup) and held in a small
+    in-memory set. Once that set reaches CHECKPOINT_EVERY digests they are
+    merged into a sorted snapshot (<data_file>.dedup.snap) that is
+    memory-mapped and binary-searched. Opening the index only reads the
+    journal written since the last snapshot, so startup time and memory
+    stay flat no matter how much history is indexed.
+
+    Added digests are written to the journal by flush(), which collectors
+    call after flushing their store, so the index never claims an uplink
+    whose record could still be lost. A crash between the two flushes can
+    only make a later backfill store an uplink again, which compaction
+    with record_key removes.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.snapshot_file = index_file + ".snap"
+        self.snapshot = np.empty(0, dtype='<u8')
+        self.covered = 0  # journal entries already merged into the snapshot
+        self.recent = set()
+        self.unwritten = array('Q')
+        self.file = None
+
+    def __len__(self):
+        return len(self.snapshot) + len(self.recent)
+
+    def __contains__(self, key):
+        return self.has_digest(key_digest(key))
+
+    def has_digest(self, digest):
+        if digest in self.recent:
+            return True
+        digest = np.uint64(digest)
+        position = int(self.snapshot.searchsorted(digest))
+        return position < len(self.snapshot) and self.snapshot[position] == digest
+
+    def load_snapshot(self):
+        self.snapshot = np.empty(0, dtype='<u8')
+        self.covered = 0
+        if not os.path.exists(self.snapshot_file):
+            return
+        size = os.path.getsize(self.snapshot_file)
+        if size < SNAPSHOT_HEADER:
+            return
+        with open(self.snapshot_file, 'rb') as f:
+            self.covered = int.from_bytes(f.read(SNAPSHOT_HEADER), 'little')
+        count = (size - SNAPSHOT_HEADER) // 8
+        if count:
+            self.snapshot = np.memmap(self.snapshot_file, dtype='<u8', mode='r',
+                                      offset=SNAPSHOT_HEADER, shape=(count,))
+
+    def load(self):
+        """Map the snapshot and read the journal entries written after it"""
+        self.load_snapshot()
+        entries = os.path.getsize(self.index_file) // 8
+        if self.covered > entries:
+            # Snapshot belongs to a journal that has since been rebuilt
+            self.snapshot = np.empty(0, dtype='<u8')
+            self.covered = 0
+        digests = array('Q')
+        with open(self.index_file, 'rb') as f:
+            f.seek(self.covered * 8)
+            # Ignore a torn trailing entry from an interrupted write
+            digests.fromfile(f, entries - self.covered)
+        self.recent = set(digests)
+
+    def build(self, records):
+        """Rebuild the index from scratch out of stored records"""
+        self.close()
+        self.snapshot = np.empty(0, dtype='<u8')
+        self.covered = 0
+        self.recent = set()
+        self.unwritten = array('Q')
+        for record in records:
+            self.recent.add(key_digest(record_key(record)))
+        tmp_path = self.index_file + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            array('Q', self.recent).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_file)
+        self.checkpoint()
+
+    def add(self, key):
+        """Insert a key; returns False if it was already present"""
+        digest = key_digest(key)
+        if self.has_digest(digest):
+            return False
+        self.recent.add(digest)
+        self.unwritten.append(digest)
+        return True
+
+    def write(self):
+        """Append digests added since the last flush to the journal and fsync it"""
+        if self.unwritten:
+            if self.file is None:
+                self.file = open(self.index_file, 'ab')
+            self.unwritten.tofile(self.file)
+            self.unwritten = array('Q')
+            self.file.flush()
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def checkpoint(self):
+        """Merge the in-memory digests into a new sorted snapshot"""
+        self.write()
+        covered = os.path.getsize(self.index_file) // 8
+        recent = np.fromiter(self.recent, dtype='<u8', count=len(self.recent))
+        merged = np.union1d(np.asarray(self.snapshot), recent)
+        tmp_path = self.snapshot_file + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(covered.to_bytes(SNAPSHOT_HEADER, 'little'))
+            f.write(merged.astype('<u8').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_file)
+        self.load_snapshot()
+        self.recent = set()
+
+    def flush(self):
+        self.write()
+        if len(self.recent) >= CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def close(self):
+        if self.file is not None or self.unwritten:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def index_file_for(data_file):
+    """Path of the dedup index stored next to a collector data file"""
+    return os.path.splitext(data_file)[0] + ".dedup"
+
+
+def open_dedup_index(data_file, store):
+    """Open the dedup index for a data file, building it once if missing"""
+    index = DedupIndex(index_file_for(data_file))
+    if os.path.exists(index.index_file):
+        index.load()
+        if len(index.recent) >= CHECKPOINT_EVERY:
+            index.checkpoint()
+    else:
+        index.build(store.iter_records())
+        print(f"Built dedup index with {len(index)} keys")
+    return index
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Dragino LSE01 Payload Codec
+Local, vectorized decoder for soil sensor frm_payload bytes
+"""
+
+import argparse
+import base64
+import time
+
+import numpy as np
+
+LSE01_PORT = 2
+LSE01_LENGTH = 11
+REDECODE_BATCH = 100000
+B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+B64_INVALID = 255
+
+# base64 character -> 6-bit value lookup
+B64_TABLE = np.full(256, B64_INVALID, dtype=np.uint8)
+B64_TABLE[np.frombuffer(B64_ALPHABET, dtype=np.uint8)] = np.arange(64, dtype=np.uint8)
+
+
+def b64decode_batch(payloads):
+    """
+    Decode many equal-length, unpadded base64 strings (length a multiple
+    of 4) in one shot. Returns an (n, 3 * length / 4) uint8 array and a
+    mask of rows that were valid base64.
+    """
+    width = len(payloads[0])
+    chars = np.frombuffer("".join(payloads).encode('ascii', 'replace'), dtype=np.uint8).reshape(-1, width)
+    sextets = B64_TABLE[chars]
+    valid = ~(sextets == B64_INVALID).any(axis=1)
+
+    quads = sextets.reshape(len(payloads), width // 4, 4).astype(np.uint8)
+    raw = np.empty((len(payloads), width // 4, 3), dtype=np.uint8)
+    raw[:, :, 0] = (quads[:, :, 0] << 2) | (quads[:, :, 1] >> 4)
+    raw[:, :, 1] = (quads[:, :, 1] << 4) | (quads[:, :, 2] >> 2)
+    raw[:, :, 2] = (quads[:, :, 2] << 6) | quads[:, :, 3]
+    return raw.reshape(len(payloads), -1), valid
+
+
+def decode_bytes(raw):
+    """Decode an (n, 11) uint8 array of LSE01 frames into typed columns"""
+    word = lambda i: (raw[:, i].astype(np.int32) << 8) | raw[:, i + 1]
+    ds18b20 = word(2)
+    ds18b20 = np.where(ds18b20 & 0x8000, ds18b20 - 0x10000, ds18b20)
+    soil_temp = word(6)
+    # Same quirk as Dragino's reference decoder: negatives use value - 0xFFFF
+    soil_temp = np.where(soil_temp & 0x8000, soil_temp - 0xFFFF, soil_temp)
+    flags = raw[:, 10]
+    return {
+        "Bat": (word(0) & 0x3FFF) / 1000,
+        "TempC_DS18B20": ds18b20 / 10,
+        "water_SOIL": word(4) / 100,
+        "temp_SOIL": soil_temp / 100,
+        "conduct_SOIL": word(8),
+        "Interrupt_flag": flags & 0x01,
+        "Sensor_flag": (flags >> 4) & 0x01,
+        "Hardware_flag": (flags >> 7) & 0x01,
+    }
+
+
+def decode_batch(payloads):
+    """
+    Decode a list of base64 frm_payload strings. Returns a dict of typed
+    numpy arrays (one entry per payload) plus a "valid" mask; payloads
+    that are not 11-byte LSE01 frames are marked invalid.
+    """
+    count = len(payloads)
+    columns = {
+        "Bat": np.full(count, np.nan),
+        "TempC_DS18B20": np.full(count, np.nan),
+        "water_SOIL": np.full(count, np.nan),
+        "temp_SOIL": np.full(count, np.nan),
+        "conduct_SOIL": np.zeros(count, dtype=np.int32),
+        "Interrupt_flag": np.zeros(count, dtype=np.uint8),
+        "Sensor_flag": np.zeros(count, dtype=np.uint8),
+        "Hardware_flag": np.zeros(count, dtype=np.uint8),
+        "valid": np.zeros(count, dtype=bool),
+    }
+    # 11 bytes encode to 15 base64 characters plus one '='; anything else
+    # is another format. The padding is swapped for 'A' (zero bits) so every
+    # row decodes as 12 bytes, of which the first 11 are the frame.
+    rows = np.array([i for i, p in enumerate(payloads)
+                     if isinstance(p, str) and len(p) == 16 and p[15] == '=' and p[14] != '='],
+                    dtype=np.int64)
+    if len(rows) == 0:
+        return columns
+
+    raw, valid = b64decode_batch([payloads[i][:15] + 'A' for i in rows])
+    rows, raw = rows[valid], raw[valid, :LSE01_LENGTH]
+    for name, values in decode_bytes(raw).items():
+        columns[name][rows] = values
+    columns["valid"][rows] = True
+    return columns
+
+
+def decoded_payload(columns, i):
+    """Render row i the way TTN's LSE01 decoder formats decoded_payload"""
+    return {
+        "Bat": round(float(columns["Bat"][i]), 3),
+        "Hardware_flag": int(columns["Hardware_flag"][i]),
+        "Interrupt_flag": int(columns["Interrupt_flag"][i]),
+        "Sensor_flag": int(columns["Sensor_flag"][i]),
+        "TempC_DS18B20": f"{columns['TempC_DS18B20'][i]:.2f}",
+        "conduct_SOIL": int(columns["conduct_SOIL"][i]),
+        "temp_SOIL": f"{columns['temp_SOIL'][i]:.2f}",
+        "water_SOIL": f"{columns['water_SOIL'][i]:.2f}",
+    }
+
+
+def decode_payload(frm_payload):
+    """Decode a single base64 frm_payload; {} if it is not an LSE01 frame"""
+    try:
+        raw = base64.b64decode(frm_payload, validate=True)
+    except (ValueError, TypeError):
+        return {}
+    if len(raw) != LSE01_LENGTH:
+        return {}
+    columns = decode_bytes(np.frombuffer(raw, dtype=np.uint8).reshape(1, -1))
+    return decoded_payload(columns, 0)
+
+
+def sensor_data_for(uplink_message):
+    """TTN's decoded_payload, or a local decode when the server sent none"""
+    decoded = uplink_message.get("decoded_payload")
+    if decoded:
+        return decoded
+    if uplink_message.get("f_port") != LSE01_PORT:
+        return {}
+    return decode_payload(uplink_message.get("frm_payload", ""))
+
+
+def redecode_records(records, force=False):
+    """
+    Batch re-decode stored records from their frm_payload. Fills records
+    whose sensor_data is empty, or every record when force=True (e.g. after
+    a codec fix). Returns how many records were updated.
+    """
+    targets = []
+    for record in records:
+        uplink_message = record.get('raw_message', {}).get('data', {}).get('uplink_message', {})
+        if uplink_message.get('f_port') == LSE01_PORT and (force or not record.get('sensor_data')):
+            targets.append((record, uplink_message.get('frm_payload', '')))
+    if not targets:
+        return 0
+
+    columns = decode_batch([payload for _, payload in targets])
+    updated = 0
+    for i, (record, _) in enumerate(targets):
+        if columns["valid"][i]:
+            record['sensor_data'] = decoded_payload(columns, i)
+            updated += 1
+    return updated
+
+
+def main():
+    from record_store import open_store
+
+    parser = argparse.ArgumentParser(description="Verify, re-decode or benchmark the local LSE01 decoder")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--bench", type=int, default=0, help="decode N synthetic payloads and report rate")
+    parser.add_argument("--redecode", metavar="OUT", help="write records re-decoded from frm_payload to OUT")
+    parser.add_argument("--force", action="store_true", help="with --redecode, replace existing sensor_data too")
+    args = parser.parse_args()
+
+    if args.bench:
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 256, size=(args.bench, LSE01_LENGTH), dtype=np.uint8)
+        payloads = [base64.b64encode(frame.tobytes()).decode() for frame in frames]
+        started = time.perf_counter()
+        decode_batch(payloads)
+        elapsed = time.perf_counter() - started
+        print(f"Decoded {args.bench} payloads in {elapsed:.3f}s "
+              f"({args.bench / elapsed * 60 / 1e6:.1f}M records/min)")
+        return
+
+    store = open_store(args.data_file, args.backend, read_only=True)
+    if args.redecode:
+        target = open_store(args.redecode, args.backend)
+        count = updated = 0
+        batch = []
+        for record in store.iter_records():
+            batch.append(record)
+            if len(batch) >= REDECODE_BATCH:
+                updated += redecode_records(batch, force=args.force)
+                count += len(batch)
+                for item in batch:
+                    target.append(item)
+                batch = []
+        updated += redecode_records(batch, force=args.force)
+        count += len(batch)
+        for item in batch:
+            target.append(item)
+        target.close()
+        store.close()
+        print(f"Re-decoded {updated} of {count} records into {args.redecode}")
+        return
+
+    checked = mismatched = 0
+    for record in store.iter_records():
+        uplink_message = record.get('raw_message', {}).get('data', {}).get('uplink_message', {})
+        expected = uplink_message.get('decoded_payload')
+        if not expected or uplink_message.get('f_port') != LSE01_PORT:
+            continue
+        checked += 1
+        local = decode_payload(uplink_message.get('frm_payload', ''))
+        if local != expected:
+            mismatched += 1
+            print(f"Mismatch at {record.get('timestamp')}: TTN {expected} local {local}")
+    store.close()
+    print(f"Checked {checked} records against TTN decoded_payload, {mismatched} mismatches")
+
+if __name__ == "__main__":
+    main()
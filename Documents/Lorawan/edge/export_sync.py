@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+"""
+Export and Sync
+Incremental exports of a collector store to partitioned CSV, Parquet or Arrow files, and delta uploads of them
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import requests
+
+from checkpoint import device_key
+from instrumentation import REGISTRY, get_logger
+from journal import atomic_write_json
+from record_store import iter_from, open_store, record_time, to_ns, valid_readings
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Column and type of every exported row
+EXPORT_FIELDS = (
+    ("received_at", "timestamp"),
+    ("application_id", "string"),
+    ("device_id", "string"),
+    ("f_cnt", "int"),
+    ("Bat", "float"),
+    ("TempC_DS18B20", "float"),
+    ("temp_SOIL", "float"),
+    ("water_SOIL", "float"),
+    ("conduct_SOIL", "float"),
+    ("Sensor_flag", "int"),
+    ("Hardware_flag", "int"),
+    ("Interrupt_flag", "int"),
+    ("rssi", "float"),
+    ("snr", "float"),
+    ("quality", "string"),
+)
+FORMATS = ("csv", "parquet", "arrow")
+SUFFIXES = {"csv": ".csv.gz", "parquet": ".parquet", "arrow": ".arrow"}
+BATCH_ROWS = 4096        # rows buffered per partition before a compressed block is written
+MAX_BUFFERED = 65536     # rows buffered across all partitions before the largest buffers are written
+MAX_OPEN = 64            # Parquet/Arrow part files open at a time
+COMMIT_ROWS = 100000     # rows between checkpoints during a long export
+UPLOAD_CHUNK = 1024 * 1024
+MANIFEST = "_export.json"
+SYNC_STATE = "_sync.json"
+
+log = get_logger("export_sync")
+ROWS_EXPORTED = REGISTRY.counter("collector_export_rows_total", "Records written to export partitions")
+BYTES_SYNCED = REGISTRY.counter("collector_sync_bytes_total", "Export bytes acknowledged by the sync target")
+
+
+def to_number(value, kind):
+    try:
+        return int(value) if kind == "int" else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def export_row(record):
+    """One flat row of EXPORT_FIELDS, plus the record's time in ns"""
+    uplink = record.get('raw_message', {}).get('data', {})
+    message = uplink.get('uplink_message', {})
+    sensor = valid_readings(record)
+    metadata = (message.get('rx_metadata') or [{}])[0]
+    application_id, device_id = device_key(record).split('/', 1)
+    ns = record_time(record)
+    row = {
+        "received_at": uplink.get('received_at') or record.get('timestamp'),
+        "application_id": application_id,
+        "device_id": device_id,
+        # TTN omits zero-valued fields, so the first frame has no f_cnt
+        "f_cnt": message.get('f_cnt', 0) if message else None,
+        "rssi": to_number(metadata.get('rssi'), "float"),
+        "snr": to_number(metadata.get('snr'), "float"),
+        "quality": ",".join((record.get('quality') or {}).get('flags', [])) or None,
+    }
+    for field, kind in EXPORT_FIELDS:
+        if field not in row:
+            row[field] = to_number(sensor.get(field), kind)
+    return row, ns
+
+
+def partition_for(row, ns):
+    """Hive-style partition path: application=/device=/date="""
+    date = datetime.fromtimestamp(ns // 1_000_000_000, tz=timezone.utc).strftime("%Y-%m-%d")
+    return f"application={row['application_id']}/device={row['device_id']}/date={date}"
+
+
+def iter_store_from(data_file, backend, cursor):
+    """
+    (record, cursor after it) for the records stored after cursor. Segment
+    logs and columnar stores are resumed from their own positions (byte
+    offsets, committed chunk rows); the other backends skip by count.
+    A missing store raises FileNotFoundError; a cursor the store no longer
+    has (segments compacted since) raises ValueError.
+    """
+    store = open_store(data_file, backend, read_only=True)
+    try:
+        yield from iter_from(store, cursor)
+    except ValueError as e:
+        raise ValueError(f"{e}. The export no longer matches {data_file}; "
+                         f"run again with --full to export it from the start") from e
+    finally:
+        store.close()
+
+
+def file_crc(path, size):
+    """CRC32 of the first size bytes of a file"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while size > 0:
+            data = f.read(min(UPLOAD_CHUNK, size))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size -= len(data)
+    return crc
+
+
+class CsvPartition:
+    """
+    One partition's data.csv.gz. Every block of rows is appended as its own
+    gzip member, which gzip readers decode as one stream, so a partition
+    grows in place and a sync only has to send the new members.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def write(self):
+        if not self.rows:
+            return
+        text = io.StringIO()
+        writer = csv.DictWriter(text, [field for field, _ in EXPORT_FIELDS], lineterminator='\n')
+        if not os.path.exists(self.path):
+            writer.writeheader()
+        writer.writerows(self.rows)
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(text.getvalue().encode(), compresslevel=6))
+            f.flush()
+            os.fsync(f.fileno())
+        self.rows = []
+
+    def close(self):
+        self.write()
+        return [self.path]
+
+
+class ArrowPartition:
+    """
+    One partition's part file for this run, written through a .tmp name as
+    zstd-compressed Parquet row groups or Arrow IPC record batches, one per
+    block. Closed files are renamed into place and never change again.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.rows = []
+        self.writer = None
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def write(self):
+        if not self.rows:
+            return
+        columns = {}
+        for field, kind in EXPORT_FIELDS:
+            values = [row[field] for row in self.rows]
+            if kind == "timestamp":
+                values = [to_ns(value) for value in values]
+            columns[field] = pyarrow.array(values, type=ARROW_TYPES[kind])
+        table = pyarrow.table(columns, schema=ARROW_SCHEMA)
+        if self.writer is None:
+            if self.fmt == "parquet":
+                self.writer = pyarrow.parquet.ParquetWriter(self.path + ".tmp", ARROW_SCHEMA, compression="zstd")
+            else:
+                options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+                self.writer = pyarrow.ipc.new_file(self.path + ".tmp", ARROW_SCHEMA, options=options)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.write()
+        if self.writer is None:
+            return []
+        self.writer.close()
+        with open(self.path + ".tmp", 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        return [self.path]
+
+
+if pyarrow is not None:
+    ARROW_TYPES = {"timestamp": pyarrow.timestamp("ns", tz="UTC"), "string": pyarrow.string(),
+                   "int": pyarrow.int64(), "float": pyarrow.float64()}
+    ARROW_SCHEMA = pyarrow.schema([(field, ARROW_TYPES[kind]) for field, kind in EXPORT_FIELDS])
+
+
+class Exporter:
+    """
+    Incremental export of one collector store into out_dir. The manifest,
+    out_dir/_export.json, holds the cursor just past the last exported
+    record and the committed size of every exported file. A run streams the
+    records after the cursor and buffers rows per partition. A partition's
+    block is written once it holds batch_rows rows, and when max_buffered
+    rows are buffered in all, the largest buffers are written, so memory
+    is bounded however many partitions a fleet spreads its rows over. At
+    most max_open Parquet/Arrow part files are open at a time. The run
+    commits every commit_rows rows and at the end: blocks are written and
+    fsynced first, then the manifest is replaced. On start, bytes and files
+    that no commit accounted for (a run that crashed part way) are removed,
+    so each record is exported once.
+
+    Files live under epoch=<n>/. full=True starts the export over in the
+    next epoch, so rebuilt files never reuse a name a sync target already
+    holds bytes for.
+    """
+
+    def __init__(self, data_file, out_dir, backend="segments", fmt="csv", batch_rows=BATCH_ROWS,
+                 max_buffered=MAX_BUFFERED, max_open=MAX_OPEN, commit_rows=COMMIT_ROWS, full=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        if fmt != "csv" and pyarrow is None:
+            raise RuntimeError(f"{fmt} export needs pyarrow (pip install pyarrow)")
+        self.data_file = data_file
+        self.out_dir = out_dir
+        self.backend = backend
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.max_buffered = max_buffered
+        self.max_open = max_open
+        self.commit_rows = commit_rows
+        self.manifest_file = os.path.join(out_dir, MANIFEST)
+        self.partitions = {}
+        self.open = {}       # partitions with an open part file, least recently written first
+        self.buffered = 0
+        self.parts = 0
+        self.full = full
+        epoch = 1
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+            epoch = manifest["epoch"] + 1
+            if not full:
+                if manifest["format"] != fmt or manifest["backend"] != backend:
+                    raise ValueError(f"{out_dir} holds a {manifest['format']} export of a "
+                                     f"{manifest['backend']} store; run again with --full to replace it")
+                self.manifest = manifest
+                return
+        self.manifest = {"source": os.path.abspath(data_file), "backend": backend, "format": fmt,
+                         "cursor": {}, "exported": 0, "epoch": epoch, "run": 0, "files": {}}
+
+    def recover(self):
+        """Cut files back to their committed size and drop uncommitted ones"""
+        files = self.manifest["files"]
+        for root, _, names in os.walk(self.out_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.out_dir)
+                if relative in (MANIFEST, SYNC_STATE):
+                    continue
+                committed = files.get(relative)
+                if committed is None:
+                    os.remove(path)
+                elif os.path.getsize(path) > committed:
+                    with open(path, 'r+b') as f:
+                        f.truncate(committed)
+                        os.fsync(f.fileno())
+
+    def partition(self, name):
+        writer = self.partitions.get(name)
+        if writer is None:
+            directory = os.path.join(self.out_dir, f"epoch={self.manifest['epoch']}", name)
+            os.makedirs(directory, exist_ok=True)
+            if self.fmt == "csv":
+                writer = CsvPartition(os.path.join(directory, "data.csv.gz"))
+            else:
+                self.parts += 1
+                part = f"part-{self.manifest['run']:06d}-{self.parts:04d}{SUFFIXES[self.fmt]}"
+                writer = ArrowPartition(os.path.join(directory, part), self.fmt)
+            self.partitions[name] = writer
+        return writer
+
+    def add(self, name, row):
+        writer = self.partition(name)
+        writer.add(row)
+        self.buffered += 1
+        if len(writer.rows) >= self.batch_rows:
+            self.write(name)
+        elif self.buffered > self.max_buffered:
+            # Bound memory by rows, not partitions: write the largest buffers first
+            for largest in sorted(self.partitions, key=lambda key: len(self.partitions[key].rows), reverse=True):
+                if self.buffered <= self.max_buffered // 2:
+                    break
+                self.write(largest)
+
+    def write(self, name):
+        writer = self.partitions[name]
+        if self.fmt != "csv":
+            if name not in self.open and len(self.open) >= self.max_open:
+                # Bound open files: finish the part file written longest ago
+                self.close_partition(next(iter(self.open)))
+            self.open.pop(name, None)
+            # Insertion order doubles as least-recently-written order
+            self.open[name] = writer
+        self.buffered -= len(writer.rows)
+        writer.write()
+
+    def close_partition(self, name):
+        writer = self.partitions.pop(name)
+        self.open.pop(name, None)
+        self.buffered -= len(writer.rows)
+        self.closed.extend(writer.close())
+
+    def commit(self, cursor, exported):
+        for name in list(self.partitions):
+            self.close_partition(name)
+        for path in self.closed:
+            self.manifest["files"][os.path.relpath(path, self.out_dir)] = os.path.getsize(path)
+        self.closed = []
+        self.manifest["cursor"] = cursor
+        self.manifest["exported"] += exported
+        atomic_write_json(self.manifest_file, self.manifest, indent=2, sort_keys=True)
+
+    def run(self):
+        """Export the records after the cursor; returns how many"""
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.full:
+            # Start the new epoch before recover() removes the old one's files
+            atomic_write_json(self.manifest_file, self.manifest, indent=2, sort_keys=True)
+            self.full = False
+        self.recover()
+        self.manifest["run"] += 1
+        self.closed = []
+        cursor = self.manifest["cursor"]
+        records = iter_store_from(self.data_file, self.backend, cursor)
+
+        exported = total = 0
+        for record, cursor in records:
+            row, ns = export_row(record)
+            self.add(partition_for(row, ns), row)
+            exported += 1
+            if exported >= self.commit_rows:
+                self.commit(cursor, exported)
+                total += exported
+                exported = 0
+        self.commit(cursor, exported)
+        total += exported
+        ROWS_EXPORTED.inc(total)
+        return total
+
+
+class DirectoryTarget:
+    """Sync target that is a directory, e.g. a mounted disk or bucket"""
+
+    def __init__(self, root):
+        self.root = root
+        self.name = os.path.abspath(root)
+
+    def committed(self, name):
+        """Size and CRC32 of what the target holds of a file"""
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return 0, 0
+        size = os.path.getsize(path)
+        return size, file_crc(path, size)
+
+    def append(self, name, offset, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size != offset:
+                return size
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def close(self):
+        pass
+
+
+class HttpTarget:
+    """Sync target speaking the SyncServer protocol (HEAD for size and CRC, PUT ?offset= to append)"""
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.name = self.base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def url(self, name):
+        return f"{self.base_url}/{quote(name)}"
+
+    def committed(self, name):
+        response = self.session.head(self.url(name), timeout=self.timeout)
+        if response.status_code == 404:
+            return 0, 0
+        response.raise_for_status()
+        return int(response.headers["X-Committed-Size"]), int(response.headers["X-Committed-Crc32"])
+
+    def append(self, name, offset, data):
+        response = self.session.put(self.url(name), params={"offset": offset}, data=data, timeout=self.timeout)
+        if response.status_code not in (200, 409):
+            response.raise_for_status()
+        return int(response.headers["X-Committed-Size"])
+
+    def close(self):
+        self.session.close()
+
+
+def open_target(target):
+    if target.startswith(("http://", "https://")):
+        return HttpTarget(target)
+    return DirectoryTarget(target)
+
+
+def verified_offset(out_dir, target, name, size):
+    """
+    How many bytes of an exported file the target holds, if they are the
+    export's own first bytes by CRC32; None (and an error logged) if not.
+    """
+    committed, crc = target.committed(name)
+    if committed > size or file_crc(os.path.join(out_dir, name), committed) != crc:
+        log.error("%s has %d bytes of %s that do not match the export; skipping", target.name, committed, name)
+        return None
+    return committed
+
+
+def sync(out_dir, target, chunk_size=UPLOAD_CHUNK):
+    """
+    Upload the committed part of every exported file that the target does
+    not have yet, from the last offset it acknowledged. Acknowledged
+    offsets are kept per target in out_dir/_sync.json. For a file the
+    state does not know, or when the target's size is not the one expected,
+    the target's bytes are checked against the export by CRC before going
+    on from them; a lost state file costs a check per file, not a full
+    upload. Returns bytes sent.
+    """
+    with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+        files = json.load(f)["files"]
+    state_file = os.path.join(out_dir, SYNC_STATE)
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    # Files of an earlier epoch are no longer exported
+    acked = {name: offset for name, offset in state.get(target.name, {}).items() if name in files}
+    state[target.name] = acked
+    sent = 0
+    try:
+        for name, size in sorted(files.items()):
+            offset = acked.get(name)
+            if offset is None:
+                offset = verified_offset(out_dir, target, name, size)
+            if offset is None:
+                continue
+            if offset == size:
+                acked[name] = size
+                continue
+            with open(os.path.join(out_dir, name), 'rb') as f:
+                f.seek(offset)
+                while offset < size:
+                    data = f.read(min(chunk_size, size - offset))
+                    committed = target.append(name, offset, data)
+                    if committed != offset + len(data):
+                        # Someone else wrote to the file: go on only from bytes that match
+                        offset = verified_offset(out_dir, target, name, size)
+                        if offset is None:
+                            break
+                        f.seek(offset)
+                        continue
+                    sent += len(data)
+                    BYTES_SYNCED.inc(len(data))
+                    offset = committed
+            if offset is not None:
+                acked[name] = offset
+                atomic_write_json(state_file, state, indent=2, sort_keys=True)
+    finally:
+        atomic_write_json(state_file, state, indent=2, sort_keys=True)
+    return sent
+
+
+class SyncHandler(BaseHTTPRequestHandler):
+    def path_for(self):
+        name = unquote(urlsplit(self.path).path).lstrip('/')
+        path = os.path.normpath(os.path.join(self.server.root, name))
+        if not name or not path.startswith(os.path.abspath(self.server.root) + os.sep):
+            self.send_error(400, "bad path")
+            return None
+        return path
+
+    def reply(self, status, size, body=b"", crc=None):
+        self.send_response(status)
+        self.send_header("X-Committed-Size", str(size))
+        if crc is not None:
+            self.send_header("X-Committed-Crc32", str(crc))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        path = self.path_for()
+        if path is None:
+            return
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        with self.server.lock:
+            size = os.path.getsize(path)
+            crc = file_crc(path, size)
+        self.reply(200, size, crc=crc)
+
+    def do_GET(self):
+        path = self.path_for()
+        if path is None:
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            self.reply(200, os.path.getsize(path), f.read())
+
+    def do_PUT(self):
+        path = self.path_for()
+        if path is None:
+            return
+        offset = int(parse_qs(urlsplit(self.path).query).get("offset", ["0"])[0])
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                size = f.seek(0, os.SEEK_END)
+                if size != offset:
+                    self.reply(409, size)
+                    return
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+        self.server.received += len(data)
+        self.reply(200, size)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class SyncServer(ThreadingHTTPServer):
+    """Local stand-in for an object store: append-only files under root"""
+
+    daemon_threads = True
+
+    def __init__(self, root, host="127.0.0.1", port=0, verbose=False):
+        super().__init__((host, port), SyncHandler)
+        self.root = os.path.abspath(root)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.received = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread, for use as a test fixture"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental export of a collector store, and delta sync")
+    parser.add_argument("data_file", nargs="?", default="orin_soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--out", help="export directory (default <data_file>_export)")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--full", action="store_true", help="start the export over under new file names")
+    parser.add_argument("--sync", metavar="TARGET", help="then upload the new bytes to a URL or directory")
+    parser.add_argument("--serve", metavar="DIR", help="run a local sync target storing into DIR")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.serve:
+        server = SyncServer(args.serve, args.host, args.port, verbose=True)
+        print(f"Sync target on {server.base_url}, storing into {server.root}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        return
+
+    out_dir = args.out or os.path.splitext(args.data_file)[0] + "_export"
+    started = time.perf_counter()
+    try:
+        exporter = Exporter(args.data_file, out_dir, args.backend, args.format, full=args.full)
+        count = exporter.run()
+    except (FileNotFoundError, ValueError) as e:
+        sys.exit(f"Export failed: {e}")
+    print(f"Exported {count} new records to {out_dir} in {time.perf_counter() - started:.2f}s "
+          f"({exporter.manifest['exported']} total, {len(exporter.manifest['files'])} files)")
+
+    if args.sync:
+        started = time.perf_counter()
+        target = open_target(args.sync)
+        try:
+            sent = sync(out_dir, target)
+        finally:
+            target.close()
+        print(f"Synced {sent} bytes to {args.sync} in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Sensor Fault Detection
+Online, O(1)-per-uplink quality checks between record building and storage
+"""
+
+import argparse
+import json
+import os
+import time
+
+from dedup_index import open_dedup_index, record_key
+from instrumentation import RECORDS_QUARANTINED
+from journal import atomic_write_json
+from record_store import open_store
+
+# Valid range of each decoded field; values outside are never real readings
+FIELD_RANGES = {
+    "Bat": (2.0, 4.2),
+    "TempC_DS18B20": (-55.0, 125.0),
+    "temp_SOIL": (-40.0, 85.0),
+    "water_SOIL": (0.0, 100.0),
+    "conduct_SOIL": (0.0, 20000.0),
+}
+SOIL_FIELDS = ("temp_SOIL", "water_SOIL", "conduct_SOIL")
+DS18B20_ABSENT = 327.6    # 0x7FFF / 100: the LSE01 reports this with no probe attached
+BATTERY_LOW = 3.3         # V
+BATTERY_DROOP = 0.1       # V below the battery's running average
+OUTLIER_Z = 6.0
+WARMUP = 20               # samples before a field's statistics are trusted
+ALPHA = 0.05              # EWMA weight of a new sample
+QUARANTINE_FLAGS = ("soil_sensor_absent",)
+
+
+class FieldStats:
+    """
+    Constant-size running statistics for one field of one device: EWMA mean
+    and variance, plus a streaming median and median absolute deviation
+    (each nudged toward the new sample) for a robust z-score that a burst
+    of bad values cannot drag along with it.
+    """
+
+    __slots__ = ("count", "mean", "var", "median", "mad")
+
+    def __init__(self, count=0, mean=0.0, var=0.0, median=0.0, mad=0.0):
+        self.count = count
+        self.mean = mean
+        self.var = var
+        self.median = median
+        self.mad = mad
+
+    def robust_z(self, value):
+        if self.count < WARMUP or self.mad <= 0:
+            return 0.0
+        return abs(value - self.median) / (1.4826 * self.mad)
+
+    def update(self, value):
+        if self.count == 0:
+            self.mean = self.median = value
+        else:
+            delta = value - self.mean
+            self.mean += ALPHA * delta
+            self.var = (1 - ALPHA) * (self.var + ALPHA * delta * delta)
+            step = max(self.mad, 1e-3) * ALPHA
+            if value > self.median:
+                self.median += step
+            elif value < self.median:
+                self.median -= step
+            self.mad += ALPHA * (abs(value - self.median) - self.mad)
+        self.count += 1
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class FaultDetector:
+    """
+    Checks each new collector record before it is stored:
+
+      - flag fields: Sensor_flag == 0 means no soil probe is answering, so
+        the soil fields are invalid; Hardware_flag is reported as a fault
+      - the DS18B20 "probe absent" value and out-of-range values
+      - battery below BATTERY_LOW or BATTERY_DROOP under its running mean
+      - robust z-score outliers against the device's own history
+
+    sensor_data is stored as received. Invalid values are listed in
+    record["quality"]["invalid"], and analytics, exports, prompts and
+    training data read through record_store.valid_readings(), so they
+    treat them as missing. Every finding is listed in
+    record["quality"]["flags"].
+    Records with a QUARANTINE_FLAGS finding go to a separate quarantine
+    store instead of the main one, with its own dedup index so an uplink a
+    backfill fetches again is quarantined only once. Per-device statistics are saved to
+    <data_file>.faults.json every save_interval seconds, so a restart does
+    not repeat the warm-up; losing the last few seconds of them is harmless.
+    """
+
+    def __init__(self, data_file, backend="segments", quarantine_flags=QUARANTINE_FLAGS,
+                 save_interval=30.0):
+        self.state_file = os.path.splitext(data_file)[0] + ".faults.json"
+        self.quarantine_file = os.path.splitext(data_file)[0] + "_quarantine.json"
+        self.backend = backend
+        self.quarantine_flags = set(quarantine_flags)
+        self.quarantine = None
+        self.quarantine_index = None
+        self.stats = {}
+        self.counts = {"checked": 0, "flagged": 0, "quarantined": 0}
+        self.dirty = False
+        self.save_interval = save_interval
+        self.saved_at = time.monotonic()
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.counts.update(state.get("counts", {}))
+            for device, fields in state.get("devices", {}).items():
+                self.stats[device] = {field: FieldStats(*values) for field, values in fields.items()}
+
+    def inspect(self, record):
+        """Tag record in place; returns its list of flags"""
+        sensor = record.get('sensor_data') or {}
+        device = record.get('application_id', '') + '/' + str(record.get('device_id'))
+        stats = self.stats.setdefault(device, {})
+        flags = []
+        invalid = {}
+
+        if sensor.get('Sensor_flag') == 0:
+            flags.append("soil_sensor_absent")
+            for field in SOIL_FIELDS:
+                if field in sensor:
+                    invalid[field] = sensor[field]
+        if sensor.get('Hardware_flag') == 1:
+            flags.append("hardware_fault")
+
+        for field, (low, high) in FIELD_RANGES.items():
+            if field not in sensor or field in invalid:
+                continue
+            value = to_number(sensor[field])
+            if field == "TempC_DS18B20" and value is not None and abs(value - DS18B20_ABSENT) < 0.005:
+                flags.append("probe_absent")
+                invalid[field] = sensor[field]
+                continue
+            if value is None or not low <= value <= high:
+                flags.append(f"out_of_range:{field}")
+                invalid[field] = sensor[field]
+                continue
+
+            field_stats = stats.get(field)
+            if field_stats is None:
+                field_stats = stats[field] = FieldStats()
+            if field == "Bat":
+                if value < BATTERY_LOW:
+                    flags.append("battery_low")
+                elif field_stats.count >= WARMUP and value < field_stats.mean - BATTERY_DROOP:
+                    flags.append("battery_droop")
+            if field_stats.robust_z(value) > OUTLIER_Z:
+                flags.append(f"outlier:{field}")
+            field_stats.update(value)
+
+        self.counts["checked"] += 1
+        self.dirty = True
+        if flags:
+            self.counts["flagged"] += 1
+            record["quality"] = {"flags": flags}
+            if invalid:
+                record["quality"]["invalid"] = invalid
+        return flags
+
+    def admit(self, record):
+        """
+        Inspect a record; returns True if the caller should store it, False
+        if it was routed to the quarantine store instead.
+        """
+        flags = self.inspect(record)
+        if not self.quarantine_flags.intersection(flags):
+            return True
+        if self.quarantine is None:
+            self.quarantine = open_store(self.quarantine_file, self.backend)
+            self.quarantine_index = open_dedup_index(self.quarantine_file, self.quarantine)
+        key = record_key(record)
+        if key in self.quarantine_index:
+            return False
+        self.quarantine.append(record)
+        self.quarantine_index.add(key)
+        self.counts["quarantined"] += 1
+        RECORDS_QUARANTINED.inc()
+        return False
+
+    def flush(self, force=False):
+        """Flush quarantined records; statistics are saved every save_interval"""
+        if self.quarantine is not None:
+            self.quarantine.flush()
+            self.quarantine_index.flush()
+        if not self.dirty or (not force and time.monotonic() - self.saved_at < self.save_interval):
+            return
+        devices = {
+            device: {field: [s.count, s.mean, s.var, s.median, s.mad] for field, s in fields.items()}
+            for device, fields in self.stats.items()
+        }
+        atomic_write_json(self.state_file, {"counts": self.counts, "devices": devices})
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def close(self):
+        self.flush(force=True)
+        if self.quarantine is not None:
+            self.quarantine.close()
+            self.quarantine_index.close()
+            self.quarantine = self.quarantine_index = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan stored records for sensor faults")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--show", type=int, default=10, help="flagged records to print")
+    args = parser.parse_args()
+
+    # A scratch detector: state and quarantine of the real collector are left alone
+    detector = FaultDetector(os.path.join(os.path.dirname(os.path.abspath(args.data_file)), ".fault-scan.json"),
+                             quarantine_flags=())
+    store = open_store(args.data_file, args.backend, read_only=True)
+    totals = {}
+    shown = 0
+    started = time.perf_counter()
+    for record in store.iter_records():
+        for flag in detector.inspect(record):
+            totals[flag] = totals.get(flag, 0) + 1
+        if record.get("quality") and shown < args.show:
+            print(f"{record.get('timestamp')} {record.get('device_id')}: {record['quality']}")
+            shown += 1
+    elapsed = time.perf_counter() - started
+    store.close()
+
+    checked = detector.counts["checked"]
+    print(f"\nChecked {checked} records in {elapsed:.2f}s "
+          f"({elapsed / max(checked, 1) * 1e6:.1f} us per record including reads)")
+    for flag, count in sorted(totals.items(), key=lambda item: -item[1]):
+        print(f"  {flag}: {count}")
+
+
+if __name__ == "__main__":
+    main()
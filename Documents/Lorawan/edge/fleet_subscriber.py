@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Fleet MQTT Subscriber
+Ingests uplinks for every application and device over wildcard and shared subscriptions
+"""
+
+import argparse
+import multiprocessing
+import os
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+from dedup_index import DedupIndex, index_file_for, open_dedup_index, uplink_key
+from dragino_codec import sensor_data_for
+from fault_detector import FaultDetector
+from ingest_queue import IngestQueue
+from instrumentation import (DEDUP_HITS, MESSAGE_SECONDS, RECORDS_STORED, SAVE_SECONDS,
+                             get_logger, instrumented, setup)
+from journal import atomic_write
+from record_store import open_store
+
+log = get_logger("fleet_subscriber")
+
+UPLINK_TOPIC = "v3/+/devices/+/up"
+SHARE_GROUP = "edge-ingest"
+
+
+def partition_dir(data_dir, application_id, device_id):
+    return os.path.join(data_dir, application_id, device_id)
+
+
+def iter_partition_records(data_dir, application_id, device_id):
+    """Iterate one device's records across the logs of every worker"""
+    yield from iter_directory_records(partition_dir(data_dir, application_id, device_id))
+
+
+def iter_directory_records(directory):
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if name.endswith("_log"):
+            store = open_store(os.path.join(directory, name[:-len("_log")] + ".json"), read_only=True)
+            yield from store.iter_records()
+            store.close()
+
+
+def read_owner(owner_file):
+    try:
+        with open(owner_file, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class Partition:
+    """
+    Record log and dedup index for one (application, device) pair.
+
+    With adopt=True the caller is the device's only writer (sharded
+    ingest). A device that was last written by another worker is taken
+    over: the dedup index is rebuilt from every worker's log in the device
+    directory, so uplinks the previous owner stored are still skipped.
+    """
+
+    def __init__(self, directory, worker_id, adopt=False):
+        os.makedirs(directory, exist_ok=True)
+        # Each worker owns its own log inside the device directory, so
+        # workers sharing a subscription never write to the same file.
+        data_file = os.path.join(directory, f"worker-{worker_id}.json")
+        owner_file = os.path.join(directory, "owner")
+        if adopt and read_owner(owner_file) != str(worker_id):
+            index = DedupIndex(index_file_for(data_file))
+            index.build(iter_directory_records(directory))
+            index.close()
+            atomic_write(owner_file, str(worker_id).encode())
+        self.store = open_store(data_file)
+        self.index = open_dedup_index(data_file, self.store)
+        self.dirty = False
+
+    def flush(self):
+        if self.dirty:
+            self.store.flush()
+            self.index.flush()
+            self.dirty = False
+
+    def close(self):
+        self.store.close()
+        self.index.close()
+
+
+class FleetCollector:
+    """Routes each uplink to its per-application/per-device partition"""
+
+    def __init__(self, data_dir="fleet_data", worker_id=0, adopt=False):
+        self.data_dir = data_dir
+        self.worker_id = worker_id
+        self.adopt = adopt
+        self.partitions = {}
+        self.count = 0
+        # Per-worker fault statistics and quarantine, beside the device tree
+        quality_dir = os.path.join(data_dir, "_quality")
+        os.makedirs(quality_dir, exist_ok=True)
+        self.detector = FaultDetector(os.path.join(quality_dir, f"worker-{worker_id}.json"))
+
+    def partition(self, application_id, device_id):
+        key = (application_id, device_id)
+        if key not in self.partitions:
+            directory = partition_dir(self.data_dir, application_id, device_id)
+            self.partitions[key] = Partition(directory, self.worker_id, self.adopt)
+        return self.partitions[key]
+
+    @instrumented(MESSAGE_SECONDS, source="mqtt")
+    def add_message(self, message):
+        """Store one uplink (bridged {"data": ...} or native TTN envelope)"""
+        uplink = message.get("data", message)
+        ids = uplink.get("end_device_ids", {})
+        application_id = ids.get("application_ids", {}).get("application_id", "unknown")
+        device_id = ids.get("device_id", "unknown")
+        partition = self.partition(application_id, device_id)
+
+        key = uplink_key(uplink)
+        if key in partition.index:
+            DEDUP_HITS.inc(source="mqtt")
+            log.debug("Duplicate uplink from %s/%s, skipping...", application_id, device_id)
+            return
+
+        data_point = {
+            "timestamp": uplink.get("received_at", datetime.now().isoformat()),
+            "device_id": device_id,
+            "application_id": application_id,
+            "sensor_data": sensor_data_for(uplink.get("uplink_message", {})),
+            "raw_message": {"data": uplink}
+        }
+        if not self.detector.admit(data_point):
+            return
+        partition.store.append(data_point)
+        partition.index.add(key)
+        partition.dirty = True
+        self.count += 1
+        RECORDS_STORED.inc()
+
+    @instrumented(SAVE_SECONDS)
+    def save_data(self):
+        for partition in self.partitions.values():
+            partition.flush()
+        self.detector.flush()
+
+    def close(self):
+        for partition in self.partitions.values():
+            partition.close()
+        self.partitions = {}
+        self.detector.close()
+
+
+class FleetWorker:
+    """MQTT userdata: the topic to subscribe to plus the ingest queue"""
+
+    def __init__(self, topic, ingest):
+        self.topic = topic
+        self.ingest = ingest
+
+    def put(self, payload):
+        return self.ingest.put(payload)
+
+
+def on_connect(client, userdata, flags, rc, properties=None):
+    if rc == 0:
+        client.subscribe(userdata.topic)
+        log.info("Connected to MQTT, subscribed to %s", userdata.topic)
+    else:
+        log.warning("Connection failed: %s", rc)
+
+
+def on_message(client, userdata, msg, properties=None):
+    userdata.put(msg.payload)
+
+
+def run_worker(worker_id, args):
+    """One broker connection feeding one ingest queue and its partitions"""
+    topic = UPLINK_TOPIC
+    if args.workers > 1:
+        topic = f"$share/{args.group}/{UPLINK_TOPIC}"
+
+    # One metrics port per worker process: COLLECTOR_METRICS_PORT + worker_id
+    setup(port_offset=worker_id)
+    collector = FleetCollector(args.data_dir, worker_id)
+    ingest = IngestQueue(collector.add_message, collector.save_data).start()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"{args.group}-{worker_id}")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.user_data_set(FleetWorker(topic, ingest))
+
+    try:
+        client.username_pw_set(args.username, args.password)
+        client.connect(args.host, args.port, 60)
+        client.loop_forever()
+    except KeyboardInterrupt:
+        client.disconnect()
+    finally:
+        ingest.stop()
+        collector.close()
+        log.info("Worker %d: stored %d uplinks, queue stats %s", worker_id, collector.count, ingest.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wildcard, multi-process fleet MQTT subscriber")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--username", default="soil-sensor-saranac@ttn")
+    parser.add_argument("--password", default="YOUR_MQTT_PASSWORD")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing one $share subscription")
+    parser.add_argument("--group", default=SHARE_GROUP)
+    parser.add_argument("--data-dir", default="fleet_data")
+    args = parser.parse_args()
+
+    print(f"Fleet subscriber: {args.workers} worker(s) on {args.host}:{args.port}")
+    if args.workers == 1:
+        run_worker(0, args)
+        return
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(worker_id, args), name=f"ingest-{worker_id}")
+        for worker_id in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("\nStopping fleet subscriber...")
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Uplink Gap Tracker
+Finds missed uplinks from frame counters and backfills only the time windows they fall in
+"""
+
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+from instrumentation import REGISTRY, get_logger
+from journal import atomic_write_json
+from record_store import open_store, to_ns
+
+SETTLE = 60.0               # seconds before a gap's closing uplink is trusted to be in storage
+RETENTION = 24 * 3600.0     # TTN Storage Integration keeps uplinks this long
+DISCONNECT_SLACK = 60.0     # seconds before a disconnect that a window also covers
+MAX_RANGES = 256            # per device; older gaps beyond this are written off
+
+log = get_logger("gap_tracker")
+GAP_FETCHES = REGISTRY.counter("collector_gap_fetches_total", "Time-bounded storage fetches, by kind")
+GAP_UPLINKS = REGISTRY.counter("collector_gap_uplinks_fetched_total", "Uplinks returned by gap fetches")
+UPLINKS_LOST = REGISTRY.counter("collector_uplinks_lost_total", "Missed uplinks that storage did not have either")
+
+
+def utc_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def format_ns(ns):
+    seconds, fraction = divmod(ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{fraction:09d}Z"
+
+
+def uplink_device(uplink):
+    """"<application_id>/<device_id>" of a TTN uplink envelope"""
+    ids = uplink.get('end_device_ids', {})
+    return f"{ids.get('application_ids', {}).get('application_id')}/{ids.get('device_id')}"
+
+
+class GapTracker:
+    """
+    Per device, the frame counters seen so far as sorted, merged ranges
+    [lo, hi, lo_received_at, hi_received_at]. A hole between two ranges is a
+    run of uplinks that was never received, and the received_at of the
+    uplinks on either side bounds when the network saw them, so one
+    Storage API request with after= and before= set fetches exactly those.
+
+    A frame counter that goes backwards on a newer uplink means the device
+    rejoined: the old session's holes become plain time windows and a new
+    session starts. MQTT disconnects are recorded the same way, as a window
+    from the disconnect to the reconnect for every known device, so uplinks
+    that arrive while disconnected are fetched without waiting for the
+    device's next frame. A hole that is still there after its fetch was
+    lost on the radio side too and is written off. Holes older than the
+    storage retention are written off without a request.
+
+    Safe to call from the MQTT, writer and backfill threads. State is kept
+    in <data_file>.gaps.json and saved with the collector's other state.
+    """
+
+    def __init__(self, state_file, settle=SETTLE, retention=RETENTION):
+        self.state_file = state_file
+        self.settle = settle
+        self.retention = retention
+        self.devices = {}
+        self.counts = {"gaps": 0, "recovered": 0, "lost": 0, "fetches": 0}
+        self.disconnected_at = None
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def load(self):
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+        self.devices = state["devices"]
+        self.counts.update(state.get("counts", {}))
+        self.disconnected_at = state.get("disconnected_at")
+        self.dirty = False
+
+    def build(self, records):
+        """Rebuild from stored records, in the order they were stored"""
+        self.devices = {}
+        for record in records:
+            self.observe(record.get('raw_message', {}).get('data', {}))
+        self.dirty = True
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {"counts": self.counts, "disconnected_at": self.disconnected_at, "devices": self.devices}
+            atomic_write_json(self.state_file, state)
+            self.dirty = False
+
+    def observe(self, uplink):
+        """Account for an uplink that was received, stored or not"""
+        received_at = uplink.get('received_at')
+        if not received_at:
+            return
+        # TTN omits zero-valued fields, so the first frame has no f_cnt
+        f_cnt = uplink.get('uplink_message', {}).get('f_cnt', 0)
+        key = uplink_device(uplink)
+        with self.lock:
+            self.dirty = True
+            state = self.devices.get(key)
+            if state is None:
+                self.devices[key] = {"ranges": [[f_cnt, f_cnt, received_at, received_at]],
+                                     "since": None, "windows": [], "lost": 0}
+                return
+            ranges = state["ranges"]
+            ns = to_ns(received_at)
+            if state["since"] and ns < to_ns(state["since"]):
+                return    # from an earlier session; only its time windows are tracked
+            last = ranges[-1]
+            last_ns = to_ns(last[3])
+            if f_cnt < last[1] and ns > last_ns:
+                self.new_session(key, state, f_cnt, received_at)
+                return
+            if f_cnt > last[1] and ns < last_ns:
+                return    # higher counter but older: an earlier session
+
+            if f_cnt > last[1]:
+                i = len(ranges)
+            else:
+                # A late uplink: bisect the range starts (bisect's key= needs Python 3.10)
+                i = bisect.bisect_right([r[0] for r in ranges], f_cnt)
+            previous = ranges[i - 1] if i else None
+            following = ranges[i] if i < len(ranges) else None
+            if previous is not None and f_cnt <= previous[1]:
+                return
+            after_previous = previous is not None and f_cnt == previous[1] + 1
+            before_following = following is not None and f_cnt == following[0] - 1
+            if after_previous and before_following:
+                previous[1], previous[3] = following[1], following[3]
+                del ranges[i]
+            elif after_previous:
+                previous[1], previous[3] = f_cnt, received_at
+            elif before_following:
+                following[0], following[2] = f_cnt, received_at
+            else:
+                ranges.insert(i, [f_cnt, f_cnt, received_at, received_at])
+            if previous is not None and following is not None:
+                self.counts["recovered"] += 1
+            elif previous is not None and not after_previous:
+                self.counts["gaps"] += 1
+                log.info("Missed %d uplink(s) from %s: f_cnt %d..%d", f_cnt - previous[1] - 1, key,
+                         previous[1] + 1, f_cnt - 1)
+            while len(ranges) > MAX_RANGES:
+                self.write_off(state, 0)
+
+    def new_session(self, key, state, f_cnt, received_at):
+        """Counter reset: keep the old session's holes as time windows"""
+        ranges = state["ranges"]
+        log.info("Frame counter of %s went from %d back to %d, new session", key, ranges[-1][1], f_cnt)
+        for left, right in zip(ranges, ranges[1:]):
+            state["windows"].append([left[3], right[2]])
+        if f_cnt > 0:
+            state["windows"].append([ranges[-1][3], received_at])
+        state["ranges"] = [[f_cnt, f_cnt, received_at, received_at]]
+        state["since"] = received_at
+
+    def write_off(self, state, i):
+        """Give up on the hole after ranges[i]: merge it into one range"""
+        ranges = state["ranges"]
+        missing = ranges[i + 1][0] - ranges[i][1] - 1
+        ranges[i][1], ranges[i][3] = ranges[i + 1][1], ranges[i + 1][3]
+        del ranges[i + 1]
+        state["lost"] += missing
+        self.counts["lost"] += missing
+        UPLINKS_LOST.inc(missing)
+
+    def disconnected(self):
+        """MQTT went down; uplinks from here on are only in storage"""
+        with self.lock:
+            if self.disconnected_at is None:
+                self.disconnected_at = utc_now()
+                self.dirty = True
+
+    def connected(self):
+        """MQTT is back: add the disconnected time as a window per known device"""
+        with self.lock:
+            if self.disconnected_at is None:
+                return
+            start = to_ns(self.disconnected_at) - int(DISCONNECT_SLACK * 1e9)
+            now = utc_now()
+            for state in self.devices.values():
+                last_seen = state["ranges"][-1][3]
+                after = last_seen if to_ns(last_seen) > start else format_ns(start)
+                state["windows"].append([after, now])
+            self.disconnected_at = None
+            self.dirty = True
+
+    def pending(self):
+        """(device key, after, before, missing) to fetch, writing off what storage no longer has"""
+        now = time.time_ns()
+        expired = now - int(self.retention * 1e9)
+        settled = now - int(self.settle * 1e9)
+        fetches = []
+        with self.lock:
+            for key, state in self.devices.items():
+                windows = [w for w in state["windows"] if to_ns(w[1]) > expired]
+                if len(windows) != len(state["windows"]):
+                    state["windows"] = windows
+                    self.dirty = True
+                fetches.extend((key, after, before, None) for after, before in windows)
+                ranges = state["ranges"]
+                i = 0
+                while i < len(ranges) - 1:
+                    left, right = ranges[i], ranges[i + 1]
+                    if to_ns(right[2]) <= expired:
+                        self.write_off(state, i)
+                        self.dirty = True
+                        continue
+                    if to_ns(right[2]) <= settled:
+                        fetches.append((key, left[3], right[2], right[0] - left[1] - 1))
+                    i += 1
+        return fetches
+
+    def resolve(self, key, after, before):
+        """After a fetch of (after, before): drop the window, write off holes still inside it"""
+        after_ns, before_ns = to_ns(after), to_ns(before)
+        with self.lock:
+            state = self.devices[key]
+            state["windows"] = [w for w in state["windows"] if w != [after, before]]
+            ranges = state["ranges"]
+            i = 0
+            while i < len(ranges) - 1:
+                if to_ns(ranges[i][3]) >= after_ns and to_ns(ranges[i + 1][2]) <= before_ns:
+                    log.info("Storage does not have %d missed uplink(s) from %s either",
+                             ranges[i + 1][0] - ranges[i][1] - 1, key)
+                    self.write_off(state, i)
+                else:
+                    i += 1
+            self.counts["fetches"] += 1
+            self.dirty = True
+
+    def fetch(self, client, before_request=None):
+        """
+        Yield the uplinks storage has for every pending gap, one time-bounded
+        request each. before_request(application_id) runs ahead of each
+        request, e.g. to rate-limit. A failed request leaves its gap for the
+        next call.
+        """
+        for key, after, before, missing in self.pending():
+            application_id, device_id = key.split('/', 1)
+            throttle = None if before_request is None else partial(before_request, application_id)
+            kind = "window" if missing is None else "f_cnt"
+            GAP_FETCHES.inc(kind=kind)
+            found = 0
+            try:
+                for uplink in client.iter_uplinks(application_id, device_id, after=after, before=before,
+                                                  before_request=throttle):
+                    self.observe(uplink)
+                    found += 1
+                    yield uplink
+            except Exception as e:
+                log.error("Gap fetch for %s (%s..%s) failed: %s", key, after, before, e)
+                continue
+            finally:
+                GAP_UPLINKS.inc(found)
+            log.info("Gap fetch for %s (%s..%s): %d uplink(s)%s", key, after, before, found,
+                     "" if missing is None else f" of {missing} missing")
+            self.resolve(key, after, before)
+
+    def report(self):
+        """Per device: frames received, pending holes and uplinks missing in them, written off"""
+        with self.lock:
+            report = {}
+            for key, state in self.devices.items():
+                ranges = state["ranges"]
+                missing = sum(right[0] - left[1] - 1 for left, right in zip(ranges, ranges[1:]))
+                report[key] = {
+                    "f_cnt": [ranges[0][0], ranges[-1][1]],
+                    "received": ranges[-1][1] - ranges[0][0] + 1 - missing - state["lost"],
+                    "gaps": len(ranges) - 1,
+                    "missing": missing,
+                    "windows": len(state["windows"]),
+                    "lost": state["lost"],
+                }
+            return report
+
+
+def gap_file_for(data_file):
+    """Path of the gap tracker state stored next to a collector data file"""
+    return os.path.splitext(data_file)[0] + ".gaps.json"
+
+
+def open_gap_tracker(data_file, store):
+    """Open the gap tracker for a data file, building it once if missing"""
+    tracker = GapTracker(gap_file_for(data_file))
+    try:
+        tracker.load()
+    except (OSError, ValueError, KeyError):
+        tracker.build(store.iter_records())
+        print(f"Built gap tracker for {len(tracker.devices)} devices")
+    return tracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report missed uplinks per device from frame counters")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the state from stored records")
+    args = parser.parse_args()
+
+    store = open_store(args.data_file, args.backend, read_only=True)
+    if args.rebuild and os.path.exists(gap_file_for(args.data_file)):
+        os.remove(gap_file_for(args.data_file))
+    tracker = open_gap_tracker(args.data_file, store)
+    store.close()
+
+    for key, device in sorted(tracker.report().items()):
+        total = device["received"] + device["missing"] + device["lost"]
+        print(f"{key}: f_cnt {device['f_cnt'][0]}..{device['f_cnt'][1]}, {device['received']} received, "
+              f"{device['missing']} missing in {device['gaps']} gap(s), {device['lost']} lost "
+              f"({(device['missing'] + device['lost']) / max(total, 1):.1%}), "
+              f"{device['windows']} time window(s) pending")
+    print(f"Totals: {tracker.counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""
+Soil Q&A Inference Server
+Local HTTP / Unix-socket front end with batched decoding and prefix caching
+"""
+
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+
+from soil_context import StubModel, build_prompt
+
+EOS = 256   # tokens are bytes 0..255 plus end-of-sequence
+PREFIX_BLOCK = 64
+
+
+class ReferenceBackend:
+    """
+    Tiny CPU reference model with fixed, seeded NumPy weights. Each byte
+    goes through an embedding and `depth` residual MLP layers; the state of
+    a sequence is an exponentially decayed sum of those features. As in a
+    transformer, prefill runs all prompt tokens through the layers in one
+    matrix product, while decoding is one token per step whose cost is
+    dominated by reading the weights, so batching sequences into one step
+    is nearly free. Output is greedy over printable ASCII and runs to
+    max_tokens; it is not meaningful text. States are never modified in
+    place, so cached prefix states can be shared between requests.
+    """
+
+    name = "reference"
+
+    def __init__(self, width=256, ff=1024, depth=2, decay=0.98, seed=0):
+        rng = np.random.default_rng(seed)
+        self.embed = rng.normal(0, 1.0, (EOS + 1, width)).astype(np.float32)
+        self.layers = [
+            (rng.normal(0, 1 / np.sqrt(width), (width, ff)).astype(np.float32),
+             rng.normal(0, 0.5 / np.sqrt(ff), (ff, width)).astype(np.float32))
+            for _ in range(depth)
+        ]
+        self.output = rng.normal(0, 1 / np.sqrt(width), (width, EOS + 1)).astype(np.float32)
+        self.mask = np.full(EOS + 1, -np.inf, dtype=np.float32)
+        self.mask[32:127] = 0.0
+        self.width = width
+        self.decay = np.float32(decay)
+
+    def initial_state(self):
+        return np.zeros(self.width, dtype=np.float32)
+
+    def features(self, tokens):
+        x = self.embed[tokens]
+        for up, down in self.layers:
+            x = x + np.maximum(x @ up, 0) @ down
+        return np.tanh(x)
+
+    def prefill(self, state, tokens):
+        """State after consuming tokens, starting from state"""
+        if not len(tokens):
+            return state
+        weights = self.decay ** np.arange(len(tokens) - 1, -1, -1, dtype=np.float32)
+        return state * self.decay ** len(tokens) + weights @ self.features(np.asarray(tokens))
+
+    def step(self, states):
+        """One decode step for a whole batch: (next tokens, new states)"""
+        states = np.stack(states)
+        tokens = np.argmax(states @ self.output + self.mask, axis=1)
+        states = states * self.decay + self.features(tokens)
+        return [int(token) for token in tokens], list(states)
+
+
+class StubBackend:
+    """
+    Deterministic stand-in built on soil_context.StubModel: the answer is
+    taken from the prompt's own context lines and emitted byte by byte.
+    """
+
+    name = "stub"
+
+    def __init__(self):
+        self.model = StubModel()
+
+    def initial_state(self):
+        return (b'', None)
+
+    def prefill(self, state, tokens):
+        return (state[0] + bytes(tokens), None)
+
+    def step(self, states):
+        tokens = []
+        new_states = []
+        for prompt, answer in states:
+            if answer is None:
+                answer = self.model.generate(prompt.decode('utf-8', 'replace')).encode()
+            tokens.append(answer[0] if answer else EOS)
+            new_states.append((prompt, answer[1:]))
+        return tokens, new_states
+
+
+BACKENDS = {
+    "reference": ReferenceBackend,
+    "stub": StubBackend,
+}
+
+
+class PrefixCache:
+    """
+    Model states after every full PREFIX_BLOCK-token block of a prompt,
+    keyed by a hash chained over the blocks (so a key identifies the whole
+    prefix, not just its last block). Prompts that share a preamble, such
+    as the system prompt and a device's sensor context, resume from the
+    longest cached block instead of prefilling it again. LRU-evicted.
+    """
+
+    def __init__(self, max_entries=4096, block=PREFIX_BLOCK):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.block = block
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def block_keys(self, tokens):
+        keys = []
+        digest = hashlib.blake2b(digest_size=16)
+        for start in range(0, len(tokens) - self.block + 1, self.block):
+            digest.update(bytes(tokens[start:start + self.block]))
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def prefill(self, backend, tokens):
+        """State after tokens, reusing and extending cached prefix states"""
+        keys = self.block_keys(tokens)
+        state = backend.initial_state()
+        done = 0
+        for count, key in enumerate(keys, 1):
+            if key not in self.entries:
+                break
+            self.entries.move_to_end(key)
+            state = self.entries[key]
+            done = count * self.block
+        if done:
+            self.hits += 1
+            self.reused_tokens += done
+        else:
+            self.misses += 1
+
+        for count in range(done // self.block, len(keys)):
+            state = backend.prefill(state, tokens[done:(count + 1) * self.block])
+            done = (count + 1) * self.block
+            self.entries[keys[count]] = state
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return backend.prefill(state, tokens[done:])
+
+
+class GenerationRequest:
+    """One prompt being decoded; tokens are streamed through self.tokens"""
+
+    def __init__(self, prompt, max_tokens):
+        self.prompt = prompt.encode()
+        self.max_tokens = max_tokens
+        self.tokens = queue.Queue()
+        self.generated = 0
+        self.submitted = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+        self.state = None
+        self.error = None
+
+    def fail(self, error):
+        """End the request without (more) output; stream() raises error"""
+        self.error = error
+        self.finished = time.perf_counter()
+        self.state = None
+        self.tokens.put(None)
+
+    def stream(self):
+        """Yield decoded text as it is produced; blocks between tokens"""
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            token = self.tokens.get()
+            chunk = bytearray()
+            # Send everything produced since the last read as one piece
+            while token is not None:
+                chunk.append(token)
+                try:
+                    token = self.tokens.get_nowait()
+                except queue.Empty:
+                    break
+            text = decoder.decode(bytes(chunk), final=token is None)
+            if text:
+                yield text
+            if token is None:
+                if self.error is not None:
+                    raise RuntimeError(self.error)
+                return
+
+
+class BatchScheduler:
+    """
+    Continuous batching: a single thread owns the model. Each iteration it
+    admits waiting requests (prefilling them through the prefix cache) up
+    to max_batch active sequences, then runs one decode step for all of
+    them together. Finished sequences leave the batch immediately, so a
+    long answer never holds up a short one behind it. When idle the thread
+    sleeps until a request arrives, then waits up to batch_wait seconds
+    for more to join it. When the thread stops, through stop() or a
+    backend error, every active and waiting request is failed so no
+    client waits on it forever, and later submissions fail at once.
+    """
+
+    def __init__(self, backend, max_batch=16, batch_wait=0.002, prefix_cache=None):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.prefix_cache = prefix_cache or PrefixCache()
+        self.waiting = queue.Queue()
+        self.active = []
+        self.stopping = False
+        self.closed = False
+        self.error = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.steps = 0
+        self.batched_tokens = 0
+        self.completed = 0
+        self.latencies = deque(maxlen=1000)
+        self.first_token_latencies = deque(maxlen=1000)
+
+    def submit(self, prompt, max_tokens=128):
+        request = GenerationRequest(prompt, max_tokens)
+        with self.lock:
+            if self.closed:
+                request.fail(self.error or "Inference server is stopped")
+            else:
+                self.waiting.put(request)
+        return request
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="inference", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.waiting.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def admit(self):
+        """Move waiting requests into the batch; blocks while there is no work"""
+        idle = not self.active
+        while len(self.active) < self.max_batch:
+            try:
+                if idle and not self.active:
+                    request = self.waiting.get()
+                elif idle:
+                    # Just woke up: give a burst of requests a moment to arrive
+                    request = self.waiting.get(timeout=self.batch_wait)
+                else:
+                    request = self.waiting.get_nowait()
+            except queue.Empty:
+                return
+            if request is None:
+                return
+            try:
+                request.state = self.prefix_cache.prefill(self.backend, list(request.prompt))
+            except Exception as e:
+                request.fail(f"Prefill failed: {e}")
+                continue
+            self.active.append(request)
+
+    def run(self):
+        try:
+            self.decode()
+        except Exception as e:
+            self.error = f"Model loop failed: {e}"
+            print(self.error)
+        finally:
+            self.close()
+
+    def close(self):
+        """Fail the active and waiting requests; no new ones are queued after this"""
+        with self.lock:
+            self.closed = True
+        error = self.error or "Inference server is stopping"
+        for request in self.active:
+            request.fail(error)
+        self.active = []
+        while True:
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.fail(error)
+
+    def decode(self):
+        while not self.stopping:
+            self.admit()
+            if not self.active:
+                continue
+            tokens, states = self.backend.step([request.state for request in self.active])
+            self.steps += 1
+            self.batched_tokens += len(tokens)
+            now = time.perf_counter()
+            still_active = []
+            for request, token, state in zip(self.active, tokens, states):
+                request.state = state
+                if token != EOS:
+                    if request.first_token is None:
+                        request.first_token = now
+                        self.first_token_latencies.append(now - request.submitted)
+                    request.tokens.put(token)
+                    request.generated += 1
+                if token == EOS or request.generated >= request.max_tokens:
+                    request.finished = now
+                    request.state = None
+                    request.tokens.put(None)
+                    self.latencies.append(now - request.submitted)
+                    self.completed += 1
+                else:
+                    still_active.append(request)
+            self.active = still_active
+
+    def stats(self):
+        def percentiles(values):
+            if not values:
+                return {}
+            ms = np.array(values) * 1000
+            return {f"p{q}": round(float(np.percentile(ms, q)), 2) for q in (50, 95, 99)}
+
+        cache = self.prefix_cache
+        return {
+            "backend": self.backend.name,
+            "error": self.error,
+            "completed": self.completed,
+            "active": len(self.active),
+            "waiting": self.waiting.qsize(),
+            "decode_steps": self.steps,
+            "mean_batch": round(self.batched_tokens / self.steps, 2) if self.steps else 0,
+            "prefix_hits": cache.hits,
+            "prefix_misses": cache.misses,
+            "prefix_reused_tokens": cache.reused_tokens,
+            "latency_ms": percentiles(self.latencies),
+            "first_token_ms": percentiles(self.first_token_latencies),
+        }
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    POST /generate {"prompt", "max_tokens", "stream"}
+    POST /ask      {"device", "question", "max_tokens", "stream"}
+    GET  /stats
+
+    Streaming responses are chunked text, flushed as tokens are produced.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.scheduler.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError("body must be a JSON object")
+            max_tokens = int(body.get("max_tokens", 128))
+            if self.path == "/generate":
+                prompt = body["prompt"]
+            elif self.path == "/ask":
+                if self.server.context_builder is None:
+                    self.send_error(404, "Server was started without a data file")
+                    return
+                device_id, question = body["device"], body["question"]
+                try:
+                    context = self.server.context_builder.context(device_id)
+                except Exception as e:
+                    # The request was fine; the store behind it was not (missing, unreadable, ...)
+                    self.log_error("Context for %s failed: %s", device_id, e)
+                    self.send_json(500, {"error": f"Could not build context: {e}"})
+                    return
+                prompt = build_prompt(context, question)
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_error(400, f"Bad request: {e}")
+            return
+
+        request = self.server.scheduler.submit(prompt, max_tokens)
+        if not body.get("stream", True):
+            try:
+                text = "".join(request.stream())
+            except RuntimeError as e:
+                self.send_json(503, {"error": str(e)})
+                return
+            self.send_json(200, {"text": text, "tokens": request.generated,
+                                 "latency_ms": round((request.finished - request.submitted) * 1000, 2)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for text in request.stream():
+                chunk = text.encode()
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.flush()
+        except RuntimeError as e:
+            # Headers are out; closing without the last chunk tells the client it was cut short
+            self.log_error("Generation failed: %s", e)
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+    def address_string(self):
+        # Unix socket peers have no host/port
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """HTTP front end; one handler thread per connection, one model thread"""
+
+    daemon_threads = True
+
+    def __init__(self, scheduler, host="127.0.0.1", port=8100, context_builder=None, verbose=False):
+        super().__init__((host, port), InferenceHandler)
+        self.scheduler = scheduler
+        self.context_builder = context_builder
+        self.verbose = verbose
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread, for use in-process or in tests"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class UnixInferenceServer(ThreadingMixIn, UnixStreamServer):
+    """Same protocol as InferenceServer over a Unix domain socket"""
+
+    daemon_threads = True
+
+    def __init__(self, scheduler, path, context_builder=None, verbose=False):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, InferenceHandler)
+        self.scheduler = scheduler
+        self.context_builder = context_builder
+        self.verbose = verbose
+
+
+def make_scheduler(backend="reference", max_batch=16, batch_wait=0.002):
+    return BatchScheduler(BACKENDS[backend](), max_batch=max_batch, batch_wait=batch_wait).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local soil Q&A inference service")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="reference")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--socket", help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--batch-wait", type=float, default=0.002, help="seconds to wait for a batch to form")
+    parser.add_argument("--data-file", help="collector data file; enables POST /ask")
+    parser.add_argument("--store-backend", default="segments")
+    args = parser.parse_args()
+
+    context_builder = None
+    if args.data_file:
+        from soil_context import ContextBuilder
+        context_builder = ContextBuilder(args.data_file, args.store_backend)
+
+    scheduler = make_scheduler(args.backend, args.max_batch, args.batch_wait)
+    if args.socket:
+        server = UnixInferenceServer(scheduler, args.socket, context_builder, verbose=True)
+        print(f"Serving {args.backend} backend on unix:{args.socket}")
+    else:
+        server = InferenceServer(scheduler, args.host, args.port, context_builder, verbose=True)
+        print(f"Serving {args.backend} backend at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping inference server...")
+    finally:
+        server.server_close()
+        scheduler.stop()
+        print(f"Inference stats: {scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+MQTT Ingest Queue
+Decouples the MQTT network thread from record building and persistence
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+from instrumentation import MESSAGES_RECEIVED, REGISTRY, get_logger
+
+log = get_logger("ingest_queue")
+INGEST_DROPPED = REGISTRY.counter("collector_ingest_dropped_total", "Payloads dropped by queue overflow")
+BATCH_SIZE = REGISTRY.histogram("collector_ingest_batch_size", "Payloads handled per flush",
+                                (1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+
+class IngestQueue:
+    """
+    Bounded producer/consumer queue of raw MQTT payloads.
+
+    The MQTT callback only calls put(), which appends the payload bytes
+    under a lock and returns. A writer thread drains the queue in batches of
+    up to batch_size (or whatever arrived within flush_interval seconds),
+    decodes each payload, hands it to handle_message and calls flush once
+    per batch. When the queue is full, overflow decides what happens:
+
+      drop_oldest - discard the oldest queued payload (default)
+      drop_newest - discard the incoming payload
+      block       - wait up to block_timeout for space, then drop it
+
+    Dropped uplinks are still in TTN storage and are recovered by the next
+    backfill. submit() queues a callable to run on the writer thread in
+    order with the payloads, so other work can share the one thread that
+    touches the collector.
+    """
+
+    def __init__(self, handle_message, flush, max_size=10000, batch_size=64,
+                 flush_interval=1.0, overflow="drop_oldest", block_timeout=1.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.handle_message = handle_message
+        self.flush = flush
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.stopping = False
+        self.tasks_queued = 0
+        self.thread = None
+
+        # Backpressure metrics
+        self.enqueued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    def put(self, payload):
+        """Enqueue raw payload bytes; returns False if it was dropped"""
+        MESSAGES_RECEIVED.inc(source="mqtt")
+        with self.lock:
+            if len(self.items) >= self.max_size:
+                if self.overflow == "drop_oldest":
+                    # Oldest payload, that is; submitted tasks are kept
+                    oldest = next((i for i, item in enumerate(self.items) if not callable(item)), None)
+                    self.dropped += 1
+                    INGEST_DROPPED.inc()
+                    if oldest is None:
+                        return False
+                    del self.items[oldest]
+                elif self.overflow == "drop_newest":
+                    self.dropped += 1
+                    INGEST_DROPPED.inc()
+                    return False
+                elif not self.not_full.wait_for(lambda: len(self.items) < self.max_size,
+                                                self.block_timeout):
+                    self.dropped += 1
+                    INGEST_DROPPED.inc()
+                    return False
+            self.items.append(payload)
+            self.enqueued += 1
+            depth = len(self.items)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            if depth >= self.batch_size:
+                self.not_empty.notify()
+        return True
+
+    def submit(self, task):
+        """Run task() on the writer thread after what is already queued; never dropped"""
+        with self.lock:
+            self.items.append(task)
+            self.tasks_queued += 1
+            self.not_empty.notify()
+
+    def next_batch(self):
+        """Wait until a full batch or a task is queued, flush_interval passes or stop()"""
+        with self.lock:
+            deadline = time.monotonic() + self.flush_interval
+            while len(self.items) < self.batch_size and not self.stopping and not self.tasks_queued:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            count = min(self.batch_size, len(self.items))
+            batch = [self.items.popleft() for _ in range(count)]
+            self.tasks_queued -= sum(1 for item in batch if callable(item))
+            done = self.stopping and not self.items
+            self.not_full.notify_all()
+        return batch, done
+
+    def run(self):
+        """Writer thread: decode, build records and persist batch by batch"""
+        while True:
+            batch, done = self.next_batch()
+            for payload in batch:
+                if callable(payload):
+                    try:
+                        payload()
+                    except Exception as e:
+                        log.exception("Error running queued task: %s", e)
+                    continue
+                try:
+                    self.handle_message(json.loads(payload))
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    log.error("Error processing queued message: %s", e)
+            if batch:
+                BATCH_SIZE.observe(len(batch))
+                try:
+                    self.flush()
+                except Exception as e:
+                    log.error("Error flushing batch: %s", e)
+                self.batches += 1
+            if done:
+                break
+
+    def start(self):
+        REGISTRY.gauge("collector_ingest_queue_depth", "Payloads waiting for the writer thread", self.depth)
+        self.thread = threading.Thread(target=self.run, name="ingest-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Drain everything still queued, then stop the writer thread"""
+        with self.lock:
+            self.stopping = True
+            self.not_empty.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "errors": self.errors,
+            "batches": self.batches,
+        }
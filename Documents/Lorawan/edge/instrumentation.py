@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Collector Instrumentation
+Counters and histograms on a Prometheus-style endpoint, a sampling profiler and rate-limited logging
+"""
+
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounts
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = os.environ.get("COLLECTOR_METRICS_PORT")
+METRICS_HOST = os.environ.get("COLLECTOR_METRICS_HOST", "127.0.0.1")
+PROFILE_INTERVAL = os.environ.get("COLLECTOR_PROFILE")   # seconds between samples, unset = off
+LOG_LEVEL = os.environ.get("COLLECTOR_LOG_LEVEL", "INFO")
+LOG_RATE = float(os.environ.get("COLLECTOR_LOG_RATE", "5"))   # lines per second per call site
+LOG_BURST = 20
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+class Counter:
+    """Monotonic total per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, key, value) for key, value in values]
+
+
+class Gauge:
+    """Current value per label set, or whatever function() returns at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[label_key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return [(self.name, key, value) for key, value in list(self.values.items())]
+
+
+class Histogram:
+    """Cumulative buckets, sum and count per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+        samples = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                samples.append((f"{self.name}_bucket", key + (("le", repr(bound)),), cumulative))
+            samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    """Metrics by name; declaring one twice returns the existing metric"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, **options):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **options)
+            elif options.get("function") is not None:
+                metric.function = options["function"]
+            return metric
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge, name, help, function=function)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Shared by every collector; a process runs one collector, so no collector label
+MESSAGES_RECEIVED = REGISTRY.counter("collector_messages_received_total", "Uplinks received, by source")
+DEDUP_HITS = REGISTRY.counter("collector_dedup_hits_total", "Uplinks skipped as already stored, by source")
+RECORDS_STORED = REGISTRY.counter("collector_records_stored_total", "Records appended to the store")
+RECORDS_QUARANTINED = REGISTRY.counter("collector_records_quarantined_total", "Records routed to quarantine")
+MESSAGE_SECONDS = REGISTRY.histogram("collector_message_seconds", "Time to build and store one record")
+SAVE_SECONDS = REGISTRY.histogram("collector_save_seconds", "Time to make appended records durable")
+BACKFILL_SECONDS = REGISTRY.histogram("collector_backfill_seconds", "Duration of one device's storage stream",
+                                      DURATION_BUCKETS)
+BYTES_FETCHED = REGISTRY.counter("collector_storage_bytes_fetched_total", "Response bytes read from the Storage API")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of threads that are inside an instrumented() hot
+    path every `interval` seconds. Counts are kept as collapsed stacks
+    ("section;file:function;..."), the input format of flamegraph tools.
+    Threads outside a hot path cost nothing; with the profiler off, a hot
+    path only pays for a dict store and delete.
+    """
+
+    def __init__(self, interval=0.005, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounts()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, section in list(ACTIVE_SECTIONS.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[section + ";" + ";".join(reversed(names))] += 1
+                self.samples += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self, top=None):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common(top))
+
+
+# thread id -> name of the hot path it is in, read by the profiler
+ACTIVE_SECTIONS = {}
+profiler = None
+
+
+def instrumented(histogram, section=None, **labels):
+    """Decorator for hot paths: time calls into histogram and expose them to the profiler"""
+    def decorate(function):
+        name = section or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            thread_id = threading.get_ident()
+            outer = ACTIVE_SECTIONS.get(thread_id)
+            ACTIVE_SECTIONS[thread_id] = name
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+                if outer is None:
+                    del ACTIVE_SECTIONS[thread_id]
+                else:
+                    ACTIVE_SECTIONS[thread_id] = outer
+        return wrapper
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = REGISTRY.render().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.startswith("/profile") and profiler is not None:
+            body = profiler.collapsed().encode()
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves GET /metrics, and GET /profile while the profiler runs"""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=9108):
+        super().__init__((host, port), MetricsHandler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site: at most `rate` lines per second after a
+    burst of `burst`. The next line let through reports how many were
+    suppressed in between. Warnings and errors are never dropped.
+    """
+
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, suppressed = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar lines suppressed)"
+        return True
+
+
+def get_logger(name):
+    return logging.getLogger(f"collector.{name}")
+
+
+def setup_logging(level=LOG_LEVEL, stream=None):
+    """Leveled, rate-limited lines on stdout, which run_soil_collector.sh appends to its log"""
+    logger = logging.getLogger("collector")
+    if logger.handlers:
+        return logger
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter())
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+
+def setup(port=METRICS_PORT, profile_interval=PROFILE_INTERVAL, port_offset=0):
+    """
+    Configure logging and, when COLLECTOR_METRICS_PORT is set, serve
+    metrics on it (plus port_offset, for one port per worker process).
+    COLLECTOR_PROFILE=<seconds> also starts the sampling profiler.
+    Returns the metrics server or None.
+    """
+    global profiler
+    log = setup_logging()
+    if profile_interval and profiler is None:
+        profiler = SamplingProfiler(float(profile_interval)).start()
+    if not port:
+        return None
+    try:
+        server = MetricsServer(METRICS_HOST, int(port) + port_offset).start()
+    except OSError as e:
+        log.warning("Metrics endpoint unavailable on port %s: %s", int(port) + port_offset, e)
+        return None
+    log.info("Serving metrics on http://%s:%d/metrics", *server.server_address[:2])
+    return server
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Write-Ahead Journal
+Checksummed append-only record journal and atomic file replacement
+"""
+
+import json
+import os
+import struct
+import zlib
+
+JOURNAL_MAGIC = b'LRJ3'
+# magic, generation of the snapshot this journal extends
+JOURNAL_HEADER = struct.Struct('<4sQ')
+# payload length, crc32 of payload
+ENTRY_HEADER = struct.Struct('<II')
+
+
+def atomic_write(path, data):
+    """
+    Replace path with data so a crash leaves either the old or the new
+    contents: write a temporary file, fsync it, rename it over path and
+    fsync the directory so the rename itself is durable.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def atomic_write_json(path, obj, **dump_options):
+    """atomic_write() for a JSON document"""
+    atomic_write(path, json.dumps(obj, **dump_options).encode())
+
+
+def sync_dir(directory):
+    """fsync a directory so renames and new files in it survive power loss"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # not supported on this platform
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def encode_entry(record):
+    payload = json.dumps(record, separators=(',', ':')).encode()
+    return ENTRY_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class Journal:
+    """
+    Write-ahead log of JSON records in <path>. Each entry is framed with
+    its length and a CRC32, so a write torn by power loss is detected and
+    cut off instead of being parsed. The header records the generation of
+    the snapshot the journal extends. Every rewrite of the snapshot bumps
+    its generation, so if the two no longer match the snapshot was
+    rewritten with the journal folded in and the journal is stale. That
+    makes compaction safe to interrupt at any step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.count = 0
+        self.file = None
+
+    def scan(self):
+        """
+        Return (generation, records, valid_end) for the journal on disk, with
+        generation that of its snapshot, or None if there is no journal.
+        Reading stops at the first short or corrupt entry; everything after
+        it was never acknowledged by a sync.
+        """
+        if not os.path.exists(self.path):
+            return None, [], 0
+        records = []
+        with open(self.path, 'rb') as f:
+            header = f.read(JOURNAL_HEADER.size)
+            if len(header) < JOURNAL_HEADER.size:
+                return None, [], 0
+            magic, generation = JOURNAL_HEADER.unpack(header)
+            if magic != JOURNAL_MAGIC:
+                raise ValueError(f"{self.path} is not a record journal")
+            end = f.tell()
+            while True:
+                entry_header = f.read(ENTRY_HEADER.size)
+                if len(entry_header) < ENTRY_HEADER.size:
+                    break
+                length, crc = ENTRY_HEADER.unpack(entry_header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                try:
+                    records.append(json.loads(payload))
+                except ValueError:
+                    break
+                end = f.tell()
+        return generation, records, end
+
+    def recover(self):
+        """
+        Cut a torn tail off the journal and return (generation, records) it holds.
+        Only the journal is read, so this costs the size of the journal
+        tail, not of the stored history.
+        """
+        generation, records, end = self.scan()
+        if generation is None:
+            return None, []
+        if end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+            print(f"Truncated torn journal entry at byte {end} of {self.path}")
+        self.generation = generation
+        self.count = len(records)
+        return generation, records
+
+    def append(self, record):
+        """Write one entry; durable after the next sync()"""
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(encode_entry(record))
+        self.file.flush()
+        self.count += 1
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def size_bytes(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def reset(self, generation):
+        """Start an empty journal on top of the snapshot of that generation"""
+        self.close()
+        atomic_write(self.path, JOURNAL_HEADER.pack(JOURNAL_MAGIC, generation))
+        self.generation = generation
+        self.count = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+LoRA Training Data
+Streams collector records into shuffled, memory-mappable token shards
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+
+from journal import atomic_write, atomic_write_json
+from record_store import iter_from, open_store, record_time, valid_readings
+from soil_context import FIELD_INFO, describe_trend
+
+EOS = 256   # byte-level tokens, shared with inference_server.py
+TOKEN_DTYPE = np.uint16
+EXAMPLE_DTYPE = np.dtype([("offset", "<i8"), ("length", "<i4"), ("prompt_length", "<i4")])
+MANIFEST = "manifest.json"
+WINDOW_FIELDS = ("temp_SOIL", "water_SOIL", "conduct_SOIL")
+
+
+def encode(text):
+    """Byte-level tokenizer; matches the inference server's reference model"""
+    return list(text.encode())
+
+
+def reading_row(ns, values):
+    when = datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).strftime("%m-%d %H:%M")
+    return when + " " + " ".join(f"{value:.2f}" for value in values)
+
+
+def window_examples(device_id, window, mode, rng):
+    """
+    (prompt, response) pairs for one window of (ns, values) readings. In
+    "sequence" mode the whole window is one unprompted text; in "instruct"
+    mode the last reading is either forecast or the window's trend described.
+    """
+    header = (f"Soil sensor {device_id} readings (UTC time, "
+              + ", ".join(f"{FIELD_INFO[field][0]} {FIELD_INFO[field][1]}" for field in WINDOW_FIELDS)
+              + "):\n")
+    if mode == "sequence":
+        return [("", header + "\n".join(reading_row(ns, values) for ns, values in window))]
+
+    history = "\n".join(reading_row(ns, values) for ns, values in window[:-1])
+    if rng.random() < 0.5:
+        return [(f"{header}{history}\nPredict the next reading.\n", reading_row(*window[-1]))]
+    field = rng.choice(WINDOW_FIELDS)
+    position = WINDOW_FIELDS.index(field)
+    name, unit, tolerance = FIELD_INFO[field]
+    change = window[-2][1][position] - window[0][1][position]
+    answer = f"{name.capitalize()} is {describe_trend(change, tolerance)} ({change:+.2f} {unit} over the window)."
+    return [(f"{header}{history}\nDescribe the trend in {name}.\n", answer)]
+
+
+class ShardWriter:
+    """
+    Writes examples as <n>.tokens (uint16 token ids) plus <n>.examples
+    (offset, length, prompt_length per example). Shards are written whole
+    and renamed into place, then listed in the manifest, so a build that
+    dies part way leaves the dataset as it was.
+    """
+
+    def __init__(self, out_dir, first_shard, shard_tokens):
+        self.out_dir = out_dir
+        self.number = first_shard
+        self.shard_tokens = shard_tokens
+        self.tokens = []
+        self.examples = []
+        self.size = 0
+        self.written = []
+
+    def add(self, prompt, response):
+        prompt_tokens = encode(prompt)
+        tokens = prompt_tokens + encode(response) + [EOS]
+        self.examples.append((self.size, len(tokens), len(prompt_tokens)))
+        self.tokens.append(np.array(tokens, dtype=TOKEN_DTYPE))
+        self.size += len(tokens)
+        if self.size >= self.shard_tokens:
+            self.close()
+
+    def close(self):
+        if not self.examples:
+            return
+        name = f"shard-{self.number:06d}"
+        atomic_write(os.path.join(self.out_dir, name + ".tokens"), np.concatenate(self.tokens).tobytes())
+        atomic_write(os.path.join(self.out_dir, name + ".examples"),
+                     np.array(self.examples, dtype=EXAMPLE_DTYPE).tobytes())
+        self.written.append({"name": name, "examples": len(self.examples), "tokens": self.size})
+        self.number += 1
+        self.tokens = []
+        self.examples = []
+        self.size = 0
+
+
+class DatasetBuilder:
+    """
+    One streaming pass over the store: records are grouped per device into
+    sliding windows (a deque per device), each window becomes training text,
+    and examples pass through a fixed-size shuffle buffer before being
+    written to shards. Memory is bounded by the buffer and the per-device
+    windows, not by history.
+
+    The manifest keeps the store position the last build reached, so an
+    incremental build reads only records stored since, including old
+    readings a gap backfill appended late. Those never join a device's
+    live window: readings not newer than the device's newest go to a
+    separate late window, restarted whenever they step back in time. Both
+    windows are saved, so windows continue exactly where the last build
+    stopped.
+    """
+
+    def __init__(self, store, out_dir, mode="instruct", window=12, stride=6,
+                 shuffle_buffer=4096, shard_tokens=1 << 22, seed=0):
+        self.store = store
+        self.out_dir = out_dir
+        self.mode = mode
+        self.window = window
+        self.stride = stride
+        self.shuffle_buffer = shuffle_buffer
+        self.shard_tokens = shard_tokens
+        self.seed = seed
+        self.manifest = self.load_manifest()
+        self.cursor = self.manifest["cursor"]
+
+    def load_manifest(self):
+        path = os.path.join(self.out_dir, MANIFEST)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {"mode": self.mode, "window": self.window, "stride": self.stride,
+                "shards": [], "devices": {}, "builds": 0, "cursor": {}}
+
+    def readings(self):
+        """(device, ns, values) for every record stored since the last build"""
+        for record, self.cursor in iter_from(self.store, self.cursor):
+            sensor = valid_readings(record)
+            try:
+                values = [float(sensor[field]) for field in WINDOW_FIELDS]
+            except (KeyError, TypeError, ValueError):
+                continue
+            yield record.get('device_id'), record_time(record), values
+
+    def build(self):
+        """Process new records; returns the number of examples written"""
+        if (self.manifest["mode"], self.manifest["window"], self.manifest["stride"]) != \
+                (self.mode, self.window, self.stride):
+            raise ValueError(f"{self.out_dir} was built with different mode/window/stride")
+        os.makedirs(self.out_dir, exist_ok=True)
+        build = self.manifest["builds"]
+        rng = random.Random(f"{self.seed}:{build}")
+        writer = ShardWriter(self.out_dir, len(self.manifest["shards"]) + 1, self.shard_tokens)
+        buffer = []
+
+        def emit(example):
+            # Reservoir-style shuffle: once full, a random buffered example leaves
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                return
+            index = rng.randrange(len(buffer))
+            writer.add(*buffer[index])
+            buffer[index] = example
+
+        windows = {}
+        for device_id, state in self.manifest["devices"].items():
+            windows[device_id, "live"] = (deque((tuple(r) for r in state["window"]), maxlen=self.window),
+                                          state["since_emit"])
+            windows[device_id, "late"] = (deque((tuple(r) for r in state.get("late_window", [])),
+                                                maxlen=self.window),
+                                          state.get("late_since_emit", self.stride))
+        devices = self.manifest["devices"]
+        for device_id, ns, values in self.readings():
+            device = devices.get(device_id)
+            if device is None or ns > device["high_water"]:
+                lane = "live"
+                devices.setdefault(device_id, {})["high_water"] = ns
+            else:
+                lane = "late"
+            window, since_emit = windows.get((device_id, lane), (deque(maxlen=self.window), self.stride))
+            if lane == "late" and window and ns <= window[-1][0]:
+                # A different stretch of history: start a fresh window
+                window, since_emit = deque(maxlen=self.window), self.stride
+            window.append((ns, values))
+            since_emit += 1
+            if len(window) == self.window and since_emit >= self.stride:
+                for example in window_examples(device_id, list(window), self.mode, rng):
+                    emit(example)
+                since_emit = 0
+            windows[device_id, lane] = (window, since_emit)
+
+        rng.shuffle(buffer)
+        for example in buffer:
+            writer.add(*example)
+        writer.close()
+
+        for (device_id, lane), (window, since_emit) in windows.items():
+            prefix = "" if lane == "live" else "late_"
+            devices[device_id][prefix + "window"] = [list(r) for r in window]
+            devices[device_id][prefix + "since_emit"] = since_emit
+        self.manifest["shards"].extend(writer.written)
+        self.manifest["builds"] = build + 1
+        self.manifest["cursor"] = self.cursor
+        atomic_write_json(os.path.join(self.out_dir, MANIFEST), self.manifest, indent=1)
+        return sum(shard["examples"] for shard in writer.written)
+
+
+class ShardDataset:
+    """
+    Read side: every shard is memory-mapped, so opening the dataset costs
+    the same however many examples it holds, and only sampled examples
+    are paged in.
+    """
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.tokens = []
+        self.examples = []
+        for shard in self.manifest["shards"]:
+            path = os.path.join(out_dir, shard["name"])
+            self.tokens.append(np.memmap(path + ".tokens", dtype=TOKEN_DTYPE, mode='r'))
+            self.examples.append(np.memmap(path + ".examples", dtype=EXAMPLE_DTYPE, mode='r'))
+        self.starts = np.cumsum([0] + [len(examples) for examples in self.examples])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def example(self, index):
+        """(tokens, prompt_length) of one example"""
+        shard = int(np.searchsorted(self.starts, index, side='right')) - 1
+        offset, length, prompt_length = self.examples[shard][index - self.starts[shard]]
+        return self.tokens[shard][offset:offset + length], int(prompt_length)
+
+    def batches(self, batch_size, seq_len, seed=0, epochs=1):
+        """
+        Yield (input_ids, loss_mask) int32/bool arrays of shape
+        (batch_size, seq_len) in a random order. Examples are truncated or
+        padded with EOS; prompt tokens and padding are masked out of the loss.
+        """
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(self))
+            for start in range(0, len(order) - batch_size + 1, batch_size):
+                input_ids = np.full((batch_size, seq_len), EOS, dtype=np.int32)
+                loss_mask = np.zeros((batch_size, seq_len), dtype=bool)
+                for row, index in enumerate(order[start:start + batch_size]):
+                    tokens, prompt_length = self.example(int(index))
+                    tokens = tokens[:seq_len]
+                    input_ids[row, :len(tokens)] = tokens
+                    loss_mask[row, prompt_length:len(tokens)] = True
+                yield input_ids, loss_mask
+
+    def prefetch(self, batches, depth=8):
+        """Build batches on a background thread, up to depth ahead of the trainer"""
+        ready = queue.Queue(maxsize=depth)
+
+        def worker():
+            for batch in batches:
+                ready.put(batch)
+            ready.put(None)
+
+        threading.Thread(target=worker, daemon=True).start()
+        while True:
+            batch = ready.get()
+            if batch is None:
+                return
+            yield batch
+
+
+def bench(out_dir, batch_size, seq_len, step_ms, steps):
+    """Feed a simulated trainer and report whether it ever waits on data"""
+    dataset = ShardDataset(out_dir)
+    print(f"{len(dataset)} examples in {len(dataset.tokens)} shards, "
+          f"{sum(len(t) for t in dataset.tokens)} tokens")
+    if len(dataset) < batch_size:
+        sys.exit(f"Not enough examples for a batch of {batch_size}; build more data first")
+    waited = 0.0
+    tokens = 0
+    started = time.perf_counter()
+    batches = dataset.prefetch(dataset.batches(batch_size, seq_len, epochs=1000))
+    for step in range(steps):
+        before = time.perf_counter()
+        input_ids, loss_mask = next(batches)
+        waited += time.perf_counter() - before
+        tokens += int(loss_mask.sum())
+        time.sleep(step_ms / 1000)  # the trainer's forward/backward pass
+    elapsed = time.perf_counter() - started
+    print(f"{steps} steps of {batch_size}x{seq_len}: {steps / elapsed:.1f} steps/s, "
+          f"{tokens / elapsed:.0f} trained tokens/s, trainer waited {waited / elapsed:.1%} of the time, "
+          f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build LoRA training shards from collected readings")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments", help="segments or columnar")
+    parser.add_argument("--out", help="output directory (default <data_file>_lora)")
+    parser.add_argument("--mode", choices=("instruct", "sequence"), default="instruct")
+    parser.add_argument("--window", type=int, default=12, help="readings per example")
+    parser.add_argument("--stride", type=int, default=6, help="readings between examples")
+    parser.add_argument("--shuffle-buffer", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bench", action="store_true", help="benchmark the dataloader instead")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--step-ms", type=float, default=20.0, help="simulated trainer step time")
+    parser.add_argument("--steps", type=int, default=500)
+    args = parser.parse_args()
+
+    out_dir = args.out or os.path.splitext(args.data_file)[0] + "_lora"
+    if args.bench:
+        bench(out_dir, args.batch_size, args.seq_len, args.step_ms, args.steps)
+        return
+
+    store = open_store(args.data_file, args.backend, read_only=True)
+    builder = DatasetBuilder(store, out_dir, args.mode, args.window, args.stride,
+                             args.shuffle_buffer, seed=args.seed)
+    started = time.perf_counter()
+    written = builder.build()
+    store.close()
+    print(f"Wrote {written} {args.mode} examples to {out_dir} in {time.perf_counter() - started:.1f}s "
+          f"(max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,102 +4,89 @@ Jetson Orin Soil Sensor Data Collector
 Fetches historical data, compares with local JSON, and reconciles
 """
 
-import json
-import os
-import subprocess
 from datetime import datetime
+from checkpoint import open_checkpoint
+from dedup_index import open_dedup_index, uplink_key
+from dragino_codec import sensor_data_for
+from fault_detector import FaultDetector
+from gap_tracker import open_gap_tracker
+from instrumentation import (DEDUP_HITS, MESSAGE_SECONDS, RECORDS_STORED, SAVE_SECONDS,
+                             get_logger, instrumented, setup)
+from record_store import open_store
+from ttn_storage import get_client, stream_uplinks
+
+log = get_logger("orin_soil_collector")
 
 class OrinSoilCollector:
-    def __init__(self, data_file="orin_soil_data.json"):
+    def __init__(self, data_file="orin_soil_data.json", backend="segments"):
         self.data_file = data_file
-        self.data = []
+        self.store = open_store(data_file, backend)
+        self.index = open_dedup_index(data_file, self.store)
+        self.checkpoint = open_checkpoint(data_file, self.store)
+        self.detector = FaultDetector(data_file, backend)
+        self.gaps = open_gap_tracker(data_file, self.store)
         self.load_data()
     
     def load_data(self):
-        """Load existing data from JSON file"""
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                self.data = json.load(f)
-            print(f"Loaded {len(self.data)} existing records from {self.data_file}")
+        """Report stored history from the checkpoint; records stay on disk"""
+        if self.checkpoint.count:
+            log.info("Loaded %d existing records from %s", self.checkpoint.count, self.data_file)
         else:
-            print(f"No existing data found, starting fresh")
+            log.info("No existing data found, starting fresh")
     
+    @instrumented(SAVE_SECONDS)
     def save_data(self):
-        """Save data to JSON file"""
-        with open(self.data_file, 'w') as f:
-            json.dump(self.data, f, indent=2)
-        print(f"Saved {len(self.data)} records to {self.data_file}")
+        """Make appended records durable"""
+        self.store.flush()
+        self.detector.flush()
+        # Index last: it must never cover records that are not on disk yet
+        self.index.flush()
+        self.checkpoint.save()
+        self.gaps.save()
+        log.info("Saved %d records to %s", self.checkpoint.count, self.data_file)
     
     def fetch_historical_data(self):
-        """Fetch historical data using curl"""
-        print("Fetching historical data from TTN...")
-        
-        curl_command = [
-            "curl", "-G",
-            "https://nam1.cloud.thethings.network/api/v3/as/applications/soil-sensor-saranac/devices/lestat-lives/packages/storage/uplink_message",
-            "-H", "Authorization: Bearer YOUR_TTN_API_KEY",
-            "-H", "Accept: text/event-stream",
-            "-d", "last=12h"
-        ]
+        """Stream historical data from TTN, yielding records as they arrive"""
+        log.info("Fetching historical data from TTN...")
         
         try:
-            result = subprocess.run(curl_command, capture_output=True, text=True, timeout=30)
-            
-            if result.returncode == 0 and result.stdout.strip():
-                # Parse multiple JSON objects (one per line)
-                lines = result.stdout.strip().split('\n')
-                print(f"Processing {len(lines)} lines from API response")
-                
-                new_records = []
-                for line in lines:
-                    if line.strip():
-                        try:
-                            json_data = json.loads(line.strip())
-                            if 'result' in json_data:
-                                result_data = json_data['result']
-                                new_records.append(result_data)
-                        except json.JSONDecodeError as e:
-                            print(f"Error parsing JSON line: {e}")
-                
-                print(f"Found {len(new_records)} records from API")
-                return new_records
-            else:
-                print("No historical data available from API")
-                return []
-                
+            yield from stream_uplinks(last="12h", after=self.high_water_mark())
         except Exception as e:
-            print(f"Error fetching historical data: {e}")
-            return []
+            log.error("Error fetching historical data: %s", e)
+        # Then only the time windows of uplinks missed before the high-water mark
+        yield from self.gaps.fetch(get_client())
     
     def compare_and_reconcile(self, api_records):
         """Compare API data with local data and reconcile"""
-        print("Comparing API data with local data...")
-        
-        # Get existing timestamps
-        existing_timestamps = set()
-        for record in self.data:
-            if 'raw_message' in record and 'data' in record['raw_message']:
-                received_at = record['raw_message']['data'].get('received_at', '')
-                if received_at:
-                    existing_timestamps.add(received_at)
+        log.info("Comparing API data with local data...")
         
-        print(f"Found {len(existing_timestamps)} existing timestamps")
+        log.info("Dedup index holds %d known uplinks", len(self.index))
         
         # Check each API record
         new_count = 0
         for api_record in api_records:
             received_at = api_record.get('received_at', '')
             
-            if received_at not in existing_timestamps:
-                print(f"New record found: {received_at}")
+            if not self.data_exists(api_record):
+                log.debug("New record found: %s", received_at)
                 self.add_new_record(api_record)
                 new_count += 1
             else:
-                print(f"Record already exists: {received_at}")
+                DEDUP_HITS.inc(source="storage")
+                log.debug("Record already exists: %s", received_at)
         
-        print(f"Added {new_count} new records")
+        log.info("Added %d new records", new_count)
         return new_count
     
+    def high_water_mark(self):
+        """Latest received_at already stored; backfills resume after it"""
+        return self.checkpoint.high_water_mark()
+    
+    def data_exists(self, api_record):
+        """Check the dedup index for this (device, f_cnt, received_at)"""
+        return uplink_key(api_record) in self.index
+    
+    @instrumented(MESSAGE_SECONDS, source="storage")
     def add_new_record(self, api_record):
         """Add a new record from API"""
         timestamp = api_record.get('received_at', datetime.now().isoformat())
@@ -108,20 +95,26 @@ class OrinSoilCollector:
         data_point = {
             "timestamp": timestamp,
             "device_id": api_record.get('end_device_ids', {}).get('device_id', 'lestat-lives'),
-            "sensor_data": api_record.get('uplink_message', {}).get('decoded_payload', {}),
+            "sensor_data": sensor_data_for(api_record.get('uplink_message', {})),
             "raw_message": {"data": api_record}
         }
         
-        self.data.append(data_point)
-        print(f"Added record #{len(self.data)}")
+        self.gaps.observe(api_record)
+        if not self.detector.admit(data_point):
+            log.info("Quarantined %s: %s", data_point['device_id'], data_point['quality']['flags'])
+            return
+        self.store.append(data_point)
+        self.index.add(uplink_key(api_record))
+        self.checkpoint.observe(data_point)
+        RECORDS_STORED.inc()
+        log.info("Added record #%d", self.checkpoint.count)
         
-        # Print sensor readings
+        # Log sensor readings
         sensor_data = data_point['sensor_data']
         if sensor_data:
-            print(f"  Battery: {sensor_data.get('Bat', 'N/A')}V")
-            print(f"  Soil Temp: {sensor_data.get('temp_SOIL', 'N/A')}C")
-            print(f"  Soil Moisture: {sensor_data.get('water_SOIL', 'N/A')}%")
-            print(f"  Conductivity: {sensor_data.get('conduct_SOIL', 'N/A')}")
+            log.debug("Battery: %sV, soil temp: %sC, soil moisture: %s%%, conductivity: %s",
+                      sensor_data.get('Bat', 'N/A'), sensor_data.get('temp_SOIL', 'N/A'),
+                      sensor_data.get('water_SOIL', 'N/A'), sensor_data.get('conduct_SOIL', 'N/A'))
     
     def run_collection(self):
         """Main collection process"""
@@ -129,17 +122,13 @@ class OrinSoilCollector:
         print("=" * 50)
         
         # Step 1: Load existing data
-        print(f"Step 1: Loaded {len(self.data)} existing records")
+        print(f"Step 1: Loaded {self.checkpoint.count} existing records")
         
         # Step 2: Fetch historical data from API
         print("\nStep 2: Fetching historical data from API...")
         api_records = self.fetch_historical_data()
         
-        if not api_records:
-            print("No new data available")
-            return
-        
-        # Step 3: Compare and reconcile
+        # Step 3: Compare and reconcile as records stream in
         print("\nStep 3: Comparing and reconciling data...")
         new_count = self.compare_and_reconcile(api_records)
         
@@ -151,12 +140,20 @@ class OrinSoilCollector:
             print("\nStep 4: No new records to save")
         
         print(f"\nFinal status:")
-        print(f"  Total records: {len(self.data)}")
+        print(f"  Total records: {self.checkpoint.count}")
         print(f"  New records added: {new_count}")
 
 def main():
+    setup()
     collector = OrinSoilCollector()
-    collector.run_collection()
+    try:
+        collector.run_collection()
+    finally:
+        collector.store.close()
+        collector.detector.close()
+        collector.index.close()
+        collector.checkpoint.save()
+        collector.gaps.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,693 @@
+#!/usr/bin/env python3
+"""
+Collector Record Storage
+Pluggable storage backends for collected soil sensor records
+"""
+
+import json
+import os
+import re
+import shutil
+import time
+import zlib
+from datetime import datetime, timezone
+
+from journal import Journal, atomic_write, sync_dir
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_FILE = "index.json"
+INDEX_STRIDE = 256
+# Start of a JSON backend snapshot: {"generation": n, "records": [...]}
+SNAPSHOT_HEAD = re.compile(rb'\s*\{\s*"generation":\s*(\d+)')
+
+
+def to_ns(timestamp):
+    """
+    RFC 3339 timestamp with up to nanosecond precision -> ns since epoch.
+    Explicit offsets are honoured; a timestamp without one is taken as UTC.
+    """
+    text = timestamp
+    fraction = ""
+    if '.' in text:
+        text, rest = text.split('.', 1)
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        fraction, text = rest[:digits], text + rest[digits:]
+    if text.endswith(('Z', 'z')):
+        text = text[:-1] + "+00:00"
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    seconds = moment.astimezone(timezone.utc).timestamp()
+    return int(seconds) * 1_000_000_000 + int(f"{fraction[:9]:0<9}")
+
+
+def encode_line(record):
+    """One segment line: compact JSON, a tab and the CRC32 of the JSON in hex"""
+    payload = json.dumps(record, separators=(',', ':')).encode()
+    return payload + b'\t%08x\n' % zlib.crc32(payload)
+
+
+def decode_line(line):
+    """Record of one segment line; ValueError if its checksum does not match"""
+    payload, _, crc = line.rstrip(b'\r\n').rpartition(b'\t')
+    if len(crc) != 8 or int(crc, 16) != zlib.crc32(payload):
+        raise ValueError("segment line checksum mismatch")
+    return json.loads(payload)
+
+
+def read_line(line, path):
+    """decode_line() for readers: a corrupt line is reported and skipped (None)"""
+    try:
+        return decode_line(line)
+    except ValueError:
+        print(f"Skipped corrupt record in {path}")
+        return None
+
+
+def record_time(record):
+    """Time of a stored record in ns: uplink received_at, else its timestamp"""
+    received_at = record.get('raw_message', {}).get('data', {}).get('received_at')
+    return to_ns(received_at or record.get('timestamp'))
+
+
+def valid_readings(record):
+    """sensor_data without the values the fault detector marked invalid"""
+    sensor = record.get('sensor_data') or {}
+    invalid = (record.get('quality') or {}).get('invalid')
+    if not invalid:
+        return sensor
+    return {field: value for field, value in sensor.items() if field not in invalid}
+
+
+class JsonFileStore:
+    """
+    Legacy backend: whole history kept as one JSON array, read on first use.
+
+    Appends go to a checksummed write-ahead journal (<data_file>.wal) and are
+    durable once flushed. The file itself is only rewritten when the journal
+    passes compact_bytes, and then atomically, as {"generation": n,
+    "records": [...]}, so a crash never leaves a truncated data file.
+    Recovery only reads the journal and the generation at the start of the
+    file.
+
+    read_only=True skips recovery and refuses appends, for viewers and
+    analysis tools reading while a collector writes.
+    """
+
+    def __init__(self, data_file, compact_bytes=1024 * 1024, read_only=False):
+        self.data_file = data_file
+        self.compact_bytes = compact_bytes
+        self.read_only = read_only
+        self.records = None
+        self.journal = Journal(journal_file_for(data_file))
+        if not read_only:
+            self.recover()
+
+    def recover(self):
+        """Cut a torn journal tail; drop a journal already folded into the snapshot"""
+        generation, records = self.journal.recover()
+        current = snapshot_generation(self.data_file)
+        if generation != current:
+            if records:
+                print(f"Discarded {len(records)} journal records already in {self.data_file}")
+            self.journal.reset(current)
+
+    def load(self):
+        if self.records is None:
+            self.records = read_json_records(self.data_file)
+        return self.records
+
+    def iter_records(self):
+        """Iterate over all stored records"""
+        return iter(list(self.load()))
+
+    def append(self, record):
+        """Journal a record; it is durable after the next flush"""
+        if self.read_only:
+            raise ValueError(f"{self.data_file} is open read-only")
+        self.journal.append(record)
+        if self.records is not None:
+            self.records.append(record)
+
+    def flush(self):
+        """fsync the journal, folding it into the JSON file once it is large"""
+        self.journal.sync()
+        if self.journal.size_bytes() >= self.compact_bytes:
+            self.compact()
+
+    def compact(self, key=None):
+        """
+        Atomically rewrite the JSON file with the journal folded in,
+        optionally dropping records whose key(record) was already seen.
+        Returns records dropped.
+        """
+        records = self.load()
+        dropped = 0
+        if key is not None:
+            seen = set()
+            kept = []
+            for record in records:
+                record_key = key(record)
+                if record_key in seen:
+                    dropped += 1
+                    continue
+                seen.add(record_key)
+                kept.append(record)
+            self.records = records = kept
+        if not self.journal.count and not dropped:
+            return 0
+        self.journal.sync()
+        generation = self.journal.generation + 1
+        atomic_write(self.data_file, json.dumps({"generation": generation, "records": records},
+                                                indent=2).encode())
+        self.journal.reset(generation)
+        return dropped
+
+    def close(self):
+        if not self.read_only:
+            self.flush()
+        self.journal.close()
+
+
+class SegmentLogStore:
+    """
+    Append-only, segmented JSON Lines record log. Each line carries the
+    CRC32 of its JSON, checked by recovery and by every reader.
+
+    Records are appended to the newest segment file; a new segment is
+    started once the active one grows past segment_bytes. Every append is
+    handed to the OS immediately, but fsync is batched (every fsync_every
+    records or fsync_interval seconds, whichever comes first), so the cost
+    of an append does not depend on how much history is stored.
+
+    read_only=True opens an existing log without recovering it or writing
+    its index, and readers stop at a line that is still being written, so
+    viewers never modify a log a collector is appending to.
+    """
+
+    def __init__(self, data_file, segment_bytes=4 * 1024 * 1024,
+                 fsync_every=32, fsync_interval=5.0, read_only=False):
+        self.data_file = data_file
+        self.log_dir = log_dir_for(data_file)
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.read_only = read_only
+        self.active = None
+        self.active_number = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+        if not os.path.isdir(self.log_dir):
+            if read_only:
+                raise FileNotFoundError(f"No record log at {self.log_dir}")
+            self.import_legacy_json()
+
+        segments = self.segment_numbers()
+        self.active_number = segments[-1] if segments else 1
+        if segments and not read_only:
+            self.recover()
+
+    def segment_path(self, number):
+        return os.path.join(self.log_dir, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+    def segment_numbers(self):
+        """Return the numbers of all segment files, oldest first"""
+        numbers = []
+        for name in os.listdir(self.log_dir):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+                if number.isdigit():
+                    numbers.append(int(number))
+        return sorted(numbers)
+
+    def import_legacy_json(self):
+        """
+        Create the log, seeded from an existing whole-file JSON array. The
+        import is written to a temporary directory that is renamed into
+        place once complete, so an interrupted import is redone from scratch.
+        """
+        log_dir = self.log_dir
+        import_dir = log_dir + ".import"
+        if os.path.isdir(import_dir):
+            shutil.rmtree(import_dir)
+        os.makedirs(import_dir)
+        records = read_json_records(self.data_file) if os.path.exists(self.data_file) else []
+        self.log_dir = import_dir
+        try:
+            self.active_number = 1
+            for record in records:
+                self.append(record)
+            self.close()
+        finally:
+            self.log_dir = log_dir
+        os.rename(import_dir, log_dir)
+        sync_dir(os.path.dirname(os.path.abspath(log_dir)))
+        if records:
+            print(f"Imported {len(records)} records from {self.data_file} into {log_dir}")
+
+    def recover(self, tail_bytes=64 * 1024):
+        """
+        Cut lines torn by a crash off the newest segment so appends start
+        on a clean line. Only the last tail_bytes of the log are read.
+        """
+        path = self.segment_path(self.active_number)
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            start = max(0, size - tail_bytes)
+            f.seek(start)
+            lines = f.read().split(b'\n')
+        # Bytes after the last newline were never completely written
+        end = size - len(lines.pop())
+        # A line cut by the start of the window cannot be checked; keep it
+        for line in reversed(lines[1:] if start > 0 else lines):
+            try:
+                if line.strip():
+                    decode_line(line)
+                break
+            except ValueError:
+                end -= len(line) + 1
+        if end < size:
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+            print(f"Truncated torn record at byte {end} of {path}")
+
+    def iter_records(self):
+        """Iterate over all stored records, oldest first"""
+        for number in self.segment_numbers():
+            path = self.segment_path(number)
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # still being written
+                    if line.strip():
+                        record = read_line(line, path)
+                        if record is not None:
+                            yield record
+
+    def open_active(self):
+        if self.read_only:
+            raise ValueError(f"{self.log_dir} is open read-only")
+        if self.active is None:
+            self.active = open(self.segment_path(self.active_number), 'ab')
+        return self.active
+
+    def append(self, record):
+        """Append one record; cost is independent of stored history"""
+        f = self.open_active()
+        f.write(encode_line(record))
+        f.flush()
+        self.pending += 1
+
+        if (self.pending >= self.fsync_every
+                or time.monotonic() - self.last_sync >= self.fsync_interval):
+            self.flush()
+        if f.tell() >= self.segment_bytes:
+            self.rotate()
+
+    def flush(self):
+        """fsync pending appends in the active segment"""
+        if self.active is not None and self.pending:
+            os.fsync(self.active.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def rotate(self):
+        """Close the active segment and start a new one"""
+        self.flush()
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+        self.active_number += 1
+        # Index the closed segment here, so read-only viewers find it indexed
+        self.segment_index()
+
+    def compact(self, key=None):
+        """
+        Merge all closed segments into one, optionally dropping records
+        whose key(record) was already seen. Returns records dropped.
+        """
+        if self.read_only:
+            raise ValueError(f"{self.log_dir} is open read-only")
+        closed = [n for n in self.segment_numbers() if n != self.active_number]
+        if not closed or (len(closed) < 2 and key is None):
+            return 0
+
+        target = self.segment_path(closed[0])
+        tmp_path = target + ".compact"
+        seen = set()
+        dropped = 0
+        with open(tmp_path, 'wb') as out:
+            for number in closed:
+                path = self.segment_path(number)
+                with open(path, 'rb') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        record = read_line(line, path)
+                        if record is None:
+                            continue
+                        if key is not None:
+                            record_key = key(record)
+                            if record_key in seen:
+                                dropped += 1
+                                continue
+                            seen.add(record_key)
+                        out.write(encode_line(record))
+            out.flush()
+            os.fsync(out.fileno())
+
+        os.replace(tmp_path, target)
+        for number in closed[1:]:
+            os.remove(self.segment_path(number))
+        # Rewritten segments invalidate the incremental segment index
+        index_path = os.path.join(self.log_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        print(f"Compacted {len(closed)} segments, dropped {dropped} duplicate records")
+        return dropped
+
+    def index_segment(self, number, entry=None):
+        """
+        Scan a segment into a sparse index entry: record count, time bounds,
+        devices, and a (time, byte offset) mark every INDEX_STRIDE records.
+        Segments only grow, so an existing entry is extended from its size.
+        """
+        path = self.segment_path(number)
+        size = os.path.getsize(path)
+        if entry is None or entry["size"] > size:
+            entry = {"size": 0, "count": 0, "min": None, "max": None, "last": None,
+                     "sorted": True, "devices": [], "marks": []}
+        devices = set(entry["devices"])
+
+        with open(path, 'rb') as f:
+            f.seek(entry["size"])
+            offset = entry["size"]
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # partially written tail; picked up next time
+                record = read_line(line, path) if line.strip() else None
+                if record is not None:
+                    ns = record_time(record)
+                    if entry["count"] % INDEX_STRIDE == 0:
+                        entry["marks"].append([ns, offset])
+                    if entry["last"] is not None and ns < entry["last"]:
+                        entry["sorted"] = False
+                    entry["min"] = ns if entry["min"] is None else min(entry["min"], ns)
+                    entry["max"] = ns if entry["max"] is None else max(entry["max"], ns)
+                    entry["last"] = ns
+                    entry["count"] += 1
+                    devices.add(record.get('device_id'))
+                offset += len(line)
+        entry["size"] = offset
+        entry["devices"] = sorted(d for d in devices if d)
+        return entry
+
+    def segment_index(self):
+        """Load the sparse segment index, refreshing entries that changed"""
+        index_path = os.path.join(self.log_dir, INDEX_FILE)
+        index = {}
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            except ValueError:
+                index = {}
+
+        changed = False
+        refreshed = {}
+        for number in self.segment_numbers():
+            entry = index.get(str(number))
+            size = os.path.getsize(self.segment_path(number))
+            if entry is None or entry["size"] != size:
+                entry = self.index_segment(number, entry)
+                changed = True
+            refreshed[str(number)] = entry
+        if (changed or set(refreshed) != set(index)) and not self.read_only:
+            try:
+                tmp_path = index_path + ".tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(refreshed, f)
+                os.replace(tmp_path, index_path)
+            except OSError:
+                pass  # the in-memory index still works
+        return refreshed
+
+    def iter_range(self, start=None, end=None, device_id=None):
+        """
+        Yield records with start <= time < end (ns), optionally for one
+        device. Segments outside the range or without the device are
+        skipped, and time-ordered segments are entered at the nearest mark.
+        """
+        index = self.segment_index()
+        for number in self.segment_numbers():
+            entry = index[str(number)]
+            if entry["count"] == 0:
+                continue
+            if start is not None and entry["max"] < start:
+                continue
+            if end is not None and entry["min"] >= end:
+                continue
+            if device_id and device_id not in entry["devices"]:
+                continue
+
+            offset = 0
+            if start is not None and entry["sorted"]:
+                for mark_ns, mark_offset in entry["marks"]:
+                    if mark_ns > start:
+                        break
+                    offset = mark_offset
+
+            path = self.segment_path(number)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # still being written
+                    record = read_line(line, path) if line.strip() else None
+                    if record is None:
+                        continue
+                    ns = record_time(record)
+                    if end is not None and ns >= end:
+                        if entry["sorted"]:
+                            break
+                        continue
+                    if start is not None and ns < start:
+                        continue
+                    if device_id and record.get('device_id') != device_id:
+                        continue
+                    yield record
+
+    def iter_from(self, cursor):
+        """
+        Yield (record, cursor after it) in append order, starting at
+        cursor {"segment": n, "offset": bytes} ({} is the beginning).
+        Stops at a line that is still being written, so a reader can keep
+        up with a collector that is appending.
+        """
+        numbers = self.segment_numbers()
+        segment, offset = cursor.get("segment", 0), cursor.get("offset", 0)
+        if segment and segment not in numbers:
+            raise ValueError(f"Segment {segment} of {self.log_dir} is gone (compacted?); "
+                             "read the log again from the start")
+        for number in numbers:
+            if number < segment:
+                continue
+            start = offset if number == segment else 0
+            path = self.segment_path(number)
+            with open(path, 'rb') as f:
+                if f.seek(0, os.SEEK_END) < start:
+                    raise ValueError(f"Segment {number} of {self.log_dir} is shorter than the cursor; "
+                                     "read the log again from the start")
+                f.seek(start)
+                position = start
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        return
+                    position += len(line)
+                    record = read_line(line, path) if line.strip() else None
+                    if record is not None:
+                        yield record, {"segment": number, "offset": position}
+
+    def tail(self, n, device_id=None, block_size=64 * 1024):
+        """Last n records (oldest first), read backwards from the end"""
+        found = []
+        for number in reversed(self.segment_numbers()):
+            path = self.segment_path(number)
+            with open(path, 'rb') as f:
+                position = f.seek(0, os.SEEK_END)
+                remainder = b''
+                last_block = True
+                while position > 0 and len(found) < n:
+                    step = min(block_size, position)
+                    position -= step
+                    f.seek(position)
+                    lines = (f.read(step) + remainder).split(b'\n')
+                    if last_block:
+                        # Whatever follows the last newline is still being written
+                        lines.pop()
+                        last_block = False
+                    # The first piece may be cut mid-line; keep it for the next block
+                    remainder = lines.pop(0) if position > 0 else b''
+                    for line in reversed(lines):
+                        record = read_line(line, path) if line.strip() else None
+                        if record is not None:
+                            if not device_id or record.get('device_id') == device_id:
+                                found.append(record)
+                                if len(found) == n:
+                                    break
+            if len(found) >= n:
+                break
+        return list(reversed(found))
+
+    def follow(self, interval=1.0):
+        """Yield records as they are appended, starting at the current end"""
+        numbers = self.segment_numbers()
+        number = numbers[-1] if numbers else self.active_number
+        path = self.segment_path(number)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        pending = b''
+        rotated = False
+        while True:
+            path = self.segment_path(number)
+            data = b''
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            if data:
+                offset += len(data)
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    record = read_line(line, path) if line.strip() else None
+                    if record is not None:
+                        yield record
+                continue
+            if os.path.exists(self.segment_path(number + 1)):
+                if rotated:
+                    number += 1
+                    offset = 0
+                    pending = b''
+                    rotated = False
+                else:
+                    # Writer moved on; read the old segment once more first
+                    rotated = True
+                continue
+            time.sleep(interval)
+
+    def close(self):
+        self.flush()
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+
+
+STORE_BACKENDS = {
+    "json": JsonFileStore,
+    "segments": SegmentLogStore,
+}
+
+
+def journal_file_for(data_file):
+    """Write-ahead journal of the JSON backend for a given data file"""
+    return data_file + ".wal"
+
+
+def read_json_records(data_file):
+    """
+    Records of a JSON backend data file including its journal, without
+    modifying either; safe for viewers while a collector is running.
+    """
+    generation, records = 0, []
+    if os.path.exists(data_file):
+        with open(data_file, 'rb') as f:
+            generation, records = parse_snapshot(f.read())
+    journaled_generation, journaled, _ = Journal(journal_file_for(data_file)).scan()
+    if journaled_generation == generation:
+        records.extend(journaled)
+    return records
+
+
+def parse_snapshot(data):
+    """
+    (generation, records) of a JSON backend data file. A plain array is a
+    file the backend never rewrote, generation 0.
+    """
+    snapshot = json.loads(data)
+    if isinstance(snapshot, list):
+        return 0, snapshot
+    if isinstance(snapshot, dict) and "records" in snapshot:
+        return snapshot.get("generation", 0), snapshot["records"]
+    raise ValueError("not a collector JSON data file")
+
+
+def snapshot_generation(data_file):
+    """Generation of a JSON backend data file, read from its first bytes"""
+    if not os.path.exists(data_file):
+        return 0
+    with open(data_file, 'rb') as f:
+        match = SNAPSHOT_HEAD.match(f.read(64))
+    return int(match.group(1)) if match else 0
+
+
+def log_dir_for(data_file):
+    """Directory holding the segmented log for a given data file"""
+    return os.path.splitext(data_file)[0] + "_log"
+
+
+def iter_from(store, cursor):
+    """
+    (record, cursor after it) for the records appended after a store
+    position. Backends with their own positions provide iter_from; for
+    the others the cursor is {"records": n}, the number already read.
+    """
+    if hasattr(store, "iter_from"):
+        yield from store.iter_from(cursor)
+        return
+    skip = cursor.get("records", 0)
+    for position, record in enumerate(store.iter_records(), 1):
+        if position > skip:
+            yield record, {"records": position}
+
+
+def iter_range(store, start=None, end=None, device_id=None):
+    """
+    Records with start <= time < end (ns), optionally for one device.
+    Backends with an index provide iter_range; the others are scanned.
+    """
+    if hasattr(store, "iter_range"):
+        yield from store.iter_range(start, end, device_id)
+        return
+    for record in store.iter_records():
+        if device_id and record.get('device_id') != device_id:
+            continue
+        if start is None and end is None:
+            yield record
+            continue
+        ns = record_time(record)
+        if (start is None or ns >= start) and (end is None or ns < end):
+            yield record
+
+
+def open_store(data_file, backend="segments", **options):
+    """
+    Open the storage backend used by the collectors. A read-only open of
+    a data file not yet imported into a segment log reads the JSON file.
+    """
+    if backend == "columnar":
+        # Imported lazily so the other backends do not need NumPy
+        from columnar_store import ColumnarStore
+        return ColumnarStore(data_file, **options)
+    if backend == "binary":
+        from binary_records import BinaryRecordStore
+        return BinaryRecordStore(data_file, **options)
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    if (backend == "segments" and options.get("read_only")
+            and not os.path.isdir(log_dir_for(data_file))
+            and (os.path.exists(data_file) or os.path.exists(journal_file_for(data_file)))):
+        return JsonFileStore(data_file, read_only=True)
+    return STORE_BACKENDS[backend](data_file, **options)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+TTN Storage API Replay Server
+Serves recorded uplinks over a local Storage Integration endpoint for offline testing
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from record_store import read_json_records, to_ns
+
+STORAGE_PATH = re.compile(
+    r"^/api/v3/as/applications/(?P<application_id>[^/]+)"
+    r"(?:/devices/(?P<device_id>[^/]+))?/packages/storage/uplink_message$"
+)
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def load_uplinks(path):
+    """Load uplinks from a collector JSON file or a JSON Lines recording"""
+    try:
+        records = read_json_records(path)
+    except ValueError:
+        with open(path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    uplinks = []
+    for record in records:
+        if 'raw_message' in record:
+            record = record['raw_message'].get('data', {})
+        elif 'result' in record:
+            record = record['result']
+        uplinks.append(record)
+    uplinks.sort(key=lambda uplink: to_ns(uplink['received_at']))
+    return uplinks
+
+
+def parse_duration(text):
+    """Parse a TTN duration such as 12h or 30m, in ns"""
+    match = re.fullmatch(r"(\d+)([smhd])", text)
+    if not match:
+        raise ValueError(f"Invalid duration: {text}")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)] * 1_000_000_000
+
+
+def select_uplinks(uplinks, application_id, device_id, params):
+    """
+    Apply the Storage API filters we use (after, before, last, limit).
+
+    'last' is measured back from the newest recorded uplink rather than the
+    wall clock, so a recording replays the same way on every run.
+    """
+    selected = [
+        uplink for uplink in uplinks
+        if uplink.get('end_device_ids', {}).get('application_ids', {}).get('application_id', application_id) == application_id
+        and (device_id is None or uplink.get('end_device_ids', {}).get('device_id') == device_id)
+    ]
+    if 'after' in params:
+        after = to_ns(params['after'])
+        selected = [u for u in selected if to_ns(u['received_at']) > after]
+    if 'before' in params:
+        before = to_ns(params['before'])
+        selected = [u for u in selected if to_ns(u['received_at']) < before]
+    if 'last' in params and uplinks:
+        since = to_ns(uplinks[-1]['received_at']) - parse_duration(params['last'])
+        selected = [u for u in selected if to_ns(u['received_at']) >= since]
+    if 'limit' in params:
+        selected = selected[:int(params['limit'])]
+    return selected
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = STORAGE_PATH.match(url.path)
+        if not match:
+            self.send_error(404)
+            return
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            uplinks = select_uplinks(self.server.uplinks, match.group('application_id'),
+                                     match.group('device_id'), params)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.server.request_count += 1
+
+        body = b''.join(
+            json.dumps({"result": uplink}).encode() + b'\n\n' for uplink in uplinks
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        # Trickle the body out in small chunks to exercise incremental parsing
+        chunk_size = self.server.chunk_size
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+            if self.server.chunk_delay:
+                time.sleep(self.server.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Local stand-in for the TTN Storage Integration API"""
+
+    daemon_threads = True
+
+    def __init__(self, uplinks, host="127.0.0.1", port=0, chunk_size=512,
+                 chunk_delay=0.0, verbose=False):
+        super().__init__((host, port), ReplayHandler)
+        self.uplinks = uplinks
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.verbose = verbose
+        self.request_count = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread, for use as a test fixture"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded uplinks as a local TTN Storage API")
+    parser.add_argument("recording", help="collector JSON file or JSON Lines of uplinks")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    uplinks = load_uplinks(args.recording)
+    server = ReplayServer(uplinks, port=args.port, chunk_size=args.chunk_size,
+                          chunk_delay=args.chunk_delay, verbose=True)
+    print(f"Replaying {len(uplinks)} uplinks at {server.base_url}")
+    print(f"Run a collector with TTN_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping replay server...")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
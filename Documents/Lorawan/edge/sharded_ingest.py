@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Sharded Fleet Ingest
+One front process routes uplinks by a consistent hash of the device to N worker processes
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+from fleet_subscriber import UPLINK_TOPIC, FleetCollector
+from instrumentation import MESSAGES_RECEIVED, REGISTRY, get_logger, setup
+from journal import atomic_write_json
+
+VNODES = 256            # points per shard on the hash ring
+ROUTE_BATCH = 64        # payloads per hand-off to a worker
+ROUTE_INTERVAL = 0.05   # seconds before a partial batch is handed off anyway
+INBOX_BATCHES = 256     # batches queued per worker before the front blocks
+PUT_TIMEOUT = 1.0       # seconds a blocking hand-off waits before checking the worker is alive
+STOP_RESTARTS = 3       # times a worker that dies while draining is restarted on stop
+
+log = get_logger("sharded_ingest")
+ROUTED = REGISTRY.counter("collector_shard_routed_total", "Uplinks handed to a shard worker, by shard")
+REBALANCES = REGISTRY.counter("collector_shard_rebalances_total", "Shard map changes applied")
+
+
+def shard_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big')
+
+
+class ShardMap:
+    """
+    Consistent-hash ring of "<application>/<device>" keys over shard ids.
+    Each shard owns VNODES points on the ring, so going from N to N+1
+    shards moves about 1/(N+1) of the devices and leaves the rest where
+    they are. Lookups are cached; a fleet has a bounded number of devices.
+    """
+
+    def __init__(self, shards, vnodes=VNODES, epoch=0):
+        self.shards = sorted(shards)
+        self.vnodes = vnodes
+        self.epoch = epoch
+        points = sorted((shard_hash(f"shard-{shard}/{v}"), shard) for shard in self.shards for v in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+        self.cache = {}
+
+    def shard_for(self, key):
+        shard = self.cache.get(key)
+        if shard is None:
+            i = bisect.bisect(self.points, shard_hash(key)) % len(self.points)
+            shard = self.cache[key] = self.owners[i]
+        return shard
+
+    def resized(self, count):
+        return ShardMap(range(count), self.vnodes, self.epoch + 1)
+
+    def save(self, path):
+        atomic_write_json(path, {"shards": self.shards, "vnodes": self.vnodes, "epoch": self.epoch}, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        return cls(state["shards"], state["vnodes"], state["epoch"])
+
+
+def map_file_for(data_dir):
+    return os.path.join(data_dir, "shard_map.json")
+
+
+def open_shard_map(data_dir, shards=None):
+    """The saved shard map, resized (and saved) if shards differs from it"""
+    path = map_file_for(data_dir)
+    try:
+        shard_map = ShardMap.load(path)
+    except (OSError, ValueError, KeyError):
+        shard_map = ShardMap(range(shards or 1))
+        os.makedirs(data_dir, exist_ok=True)
+        shard_map.save(path)
+        return shard_map
+    if shards and shards != len(shard_map.shards):
+        shard_map = shard_map.resized(shards)
+        shard_map.save(path)
+    return shard_map
+
+
+def stored_devices(data_dir):
+    """"<application>/<device>" of every device with a partition under data_dir"""
+    if not os.path.isdir(data_dir):
+        return []
+    keys = []
+    for application_id in sorted(os.listdir(data_dir)):
+        application_dir = os.path.join(data_dir, application_id)
+        if application_id.startswith('_') or not os.path.isdir(application_dir):
+            continue
+        keys.extend(f"{application_id}/{device_id}" for device_id in sorted(os.listdir(application_dir)))
+    return keys
+
+
+def topic_device_key(topic):
+    """"<application>/<device>" from v3/<application>@<tenant>/devices/<device>/up, or None"""
+    parts = topic.split('/')
+    if len(parts) != 5 or parts[2] != "devices":
+        return None
+    return parts[1].split('@', 1)[0] + "/" + parts[3]
+
+
+def payload_device_key(payload):
+    """Fallback for bridged topics: decode the payload for its device ids"""
+    message = json.loads(payload)
+    ids = message.get("data", message).get("end_device_ids", {})
+    return f"{ids.get('application_ids', {}).get('application_id', 'unknown')}/{ids.get('device_id', 'unknown')}"
+
+
+def run_shard(shard_id, inbox, stored, data_dir, batch_size):
+    """
+    Worker process: decode, build and store every uplink of the devices
+    hashed to this shard, in the order the front received them. Batches
+    that queued up while storing are taken together, one flush for all,
+    and counted in stored once that flush is done.
+    """
+    # Ctrl+C goes to the whole process group; the front decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup(port_offset=shard_id + 1)
+    collector = FleetCollector(data_dir, shard_id, adopt=True)
+    errors = 0
+    stopping = False
+    try:
+        while not stopping:
+            batch = inbox.get()
+            if batch is None:
+                break
+            payloads = list(batch)
+            batches = 1
+            while len(payloads) < batch_size:
+                try:
+                    batch = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    stopping = True
+                    break
+                payloads.extend(batch)
+                batches += 1
+            for payload in payloads:
+                try:
+                    collector.add_message(json.loads(payload))
+                except Exception as e:
+                    errors += 1
+                    log.error("Shard %d: error processing message: %s", shard_id, e)
+            collector.save_data()
+            stored.value += batches
+    finally:
+        collector.close()
+        log.info("Shard %d: stored %d uplinks, %d errors", shard_id, collector.count, errors)
+
+
+class ShardedIngest:
+    """
+    Front side of sharded ingest. put() runs on the MQTT network thread and
+    does no JSON decoding: the device comes from the topic, the shard from
+    the ring, and the payload bytes are appended to that shard's batch.
+    Full batches, and every ROUTE_INTERVAL the partial ones, are handed to
+    the worker's inbox queue. A device always maps to one worker and one
+    FIFO inbox, so its uplinks are stored in the order they arrived.
+
+    The lock is never held while waiting on a full inbox, so run() can
+    still restart a worker that died. Every batch stays in the shard's
+    pending queue until the worker reports it stored; a restarted worker
+    gets a fresh inbox and the pending batches replayed in order, so the
+    batches a dead worker had taken or left queued are not lost. An uplink
+    it stored before its dedup index was flushed can be stored again, as
+    after any collector crash; compaction with record_key removes it.
+
+    rebalance() holds incoming uplinks, drains and stops every worker, then
+    starts workers for the new map. Devices that changed shard are adopted
+    by their new worker with their history intact.
+    """
+
+    def __init__(self, data_dir, shard_map, batch_size=ROUTE_BATCH, flush_interval=ROUTE_INTERVAL,
+                 inbox_size=INBOX_BATCHES):
+        self.data_dir = data_dir
+        self.shard_map = shard_map
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.inbox_size = inbox_size
+        self.context = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.reload = threading.Event()
+        self.workers = {}
+        self.inboxes = {}
+        self.stored = {}      # shard -> batches its current worker has stored (shared value)
+        self.buffers = {}
+        self.pending = {}     # shard -> batches handed over but not stored yet, oldest first
+        self.queued = {}      # shard -> how many of pending are in the current inbox
+        self.trimmed = {}     # shard -> stored batches already removed from pending
+        self.routed = 0
+
+    def start(self):
+        """Start one worker process per shard in the map"""
+        for shard in self.shard_map.shards:
+            self.start_worker(shard)
+        log.info("Started %d shard workers (map epoch %d)", len(self.workers), self.shard_map.epoch)
+        return self
+
+    def start_worker(self, shard):
+        """Start a worker on a fresh inbox; pending batches are sent to it again"""
+        inbox = self.context.Queue(self.inbox_size)
+        stored = self.context.Value('q', 0, lock=False)
+        worker = self.context.Process(target=run_shard,
+                                      args=(shard, inbox, stored, self.data_dir, self.batch_size * 4),
+                                      name=f"shard-{shard}")
+        worker.start()
+        old = self.inboxes.get(shard)
+        if old is not None:
+            # Everything in it is still pending; never wait on its feeder thread
+            old.cancel_join_thread()
+            old.close()
+        self.inboxes[shard] = inbox
+        self.stored[shard] = stored
+        self.workers[shard] = worker
+        self.buffers.setdefault(shard, [])
+        self.pending.setdefault(shard, deque())
+        self.queued[shard] = 0
+        self.trimmed[shard] = 0
+
+    def restart_dead(self, shard):
+        """Restart a shard's worker if it died; caller holds the lock"""
+        worker = self.workers[shard]
+        if worker.is_alive():
+            return False
+        self.trim(shard)
+        log.error("Shard worker %d exited with %s, restarting with %d unstored batches",
+                  shard, worker.exitcode, len(self.pending[shard]))
+        self.start_worker(shard)
+        return True
+
+    def trim(self, shard):
+        """Drop the batches the worker has stored from pending; caller holds the lock"""
+        stored = self.stored[shard].value
+        for _ in range(stored - self.trimmed[shard]):
+            self.pending[shard].popleft()
+        self.queued[shard] -= stored - self.trimmed[shard]
+        self.trimmed[shard] = stored
+
+    def put(self, topic, payload):
+        """MQTT callback hook: route one raw payload to its device's shard"""
+        MESSAGES_RECEIVED.inc(source="mqtt")
+        key = topic_device_key(topic) or payload_device_key(payload)
+        with self.lock:
+            shard = self.shard_map.shard_for(key)
+            buffer = self.buffers[shard]
+            buffer.append(payload)
+            self.routed += 1
+            if len(buffer) < self.batch_size or self.send(shard):
+                return
+        # The worker is inbox_size batches behind: hold the network thread
+        # (backpressure to the broker), but not the lock
+        while not self.stopping.wait(self.flush_interval):
+            with self.lock:
+                if shard not in self.workers or self.send(shard) or self.restart_dead(shard):
+                    return
+
+    def send(self, shard, block=False):
+        """
+        Hand a shard its buffered batch and whatever is still pending;
+        caller holds the lock. Without block, returns False instead of
+        waiting when the inbox is full.
+        """
+        batch = self.buffers[shard]
+        if batch:
+            self.pending[shard].append(batch)
+            self.buffers[shard] = []
+            ROUTED.inc(len(batch), shard=shard)
+        self.trim(shard)
+        pending = self.pending[shard]
+        while self.queued[shard] < len(pending):
+            try:
+                self.inboxes[shard].put(pending[self.queued[shard]], block, PUT_TIMEOUT)
+            except queue.Full:
+                if not block:
+                    return False
+                self.restart_dead(shard)
+                continue
+            self.queued[shard] += 1
+        return True
+
+    def flush(self):
+        with self.lock:
+            for shard in self.shard_map.shards:
+                self.send(shard)
+
+    def stop_workers(self):
+        """Drain every inbox and wait for the workers; caller holds the lock"""
+        shards = self.shard_map.shards
+        for attempt in range(STOP_RESTARTS + 1):
+            for shard in shards:
+                self.send(shard, block=True)
+                while True:
+                    try:
+                        self.inboxes[shard].put(None, timeout=PUT_TIMEOUT)
+                        break
+                    except queue.Full:
+                        if self.restart_dead(shard):
+                            self.send(shard, block=True)
+            for shard in shards:
+                self.workers[shard].join()
+                self.trim(shard)
+            # A worker that died before storing everything is restarted on its pending batches
+            shards = [shard for shard in shards if self.pending[shard]]
+            if not shards or attempt == STOP_RESTARTS:
+                break
+            for shard in shards:
+                self.restart_dead(shard)
+        for shard in shards:
+            log.error("Shard worker %d kept failing: %d uplinks not stored", shard,
+                      sum(len(batch) for batch in self.pending[shard]))
+        for inbox in self.inboxes.values():
+            inbox.cancel_join_thread()
+            inbox.close()
+        self.workers, self.inboxes, self.stored, self.buffers = {}, {}, {}, {}
+        self.pending, self.queued, self.trimmed = {}, {}, {}
+
+    def rebalance(self, shard_map):
+        """Switch to a new shard map without reordering any device's uplinks"""
+        started = time.perf_counter()
+        moved = sum(1 for key in stored_devices(self.data_dir)
+                    if self.shard_map.shard_for(key) != shard_map.shard_for(key))
+        with self.lock:
+            self.stop_workers()
+            self.shard_map = shard_map
+            self.start()
+        REBALANCES.inc()
+        log.info("Rebalanced to %d shards: %d stored devices moved, %.2fs",
+                 len(shard_map.shards), moved, time.perf_counter() - started)
+
+    def run(self):
+        """
+        Front main loop until stop(): hand off partial batches, apply a
+        reloaded shard map and restart workers that died. close() after.
+        """
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+            if self.reload.is_set():
+                self.reload.clear()
+                shard_map = ShardMap.load(map_file_for(self.data_dir))
+                if shard_map.epoch != self.shard_map.epoch:
+                    self.rebalance(shard_map)
+            with self.lock:
+                for shard in list(self.workers):
+                    self.restart_dead(shard)
+
+    def stop(self):
+        self.stopping.set()
+
+    def close(self):
+        """Hand off what is buffered and wait for the workers to store it"""
+        with self.lock:
+            self.stop_workers()
+
+
+class FrontUserdata:
+    """MQTT userdata: the topic to subscribe to plus the router"""
+
+    def __init__(self, topic, ingest):
+        self.topic = topic
+        self.ingest = ingest
+
+
+def on_connect(client, userdata, flags, rc, properties=None):
+    if rc == 0:
+        client.subscribe(userdata.topic)
+        log.info("Connected to MQTT, subscribed to %s", userdata.topic)
+    else:
+        log.warning("Connection failed: %s", rc)
+
+
+def on_message(client, userdata, msg, properties=None):
+    userdata.ingest.put(msg.topic, msg.payload)
+
+
+def bench(counts, devices, messages, batch_size):
+    """Ingest the same synthetic uplinks with each shard count; msgs/s from first put to last flush"""
+    from bench_ingest import synthetic_uplinks, uplink_topic
+
+    uplinks = [(uplink_topic(uplink), json.dumps({"data": uplink}).encode())
+               for uplink in synthetic_uplinks(devices, messages)]
+    print(f"{messages} uplinks from {devices} devices, {os.cpu_count()} CPUs")
+    baseline = None
+    for count in counts:
+        data_dir = tempfile.mkdtemp(prefix="sharded-bench-")
+        try:
+            ingest = ShardedIngest(data_dir, ShardMap(range(count)), batch_size=batch_size).start()
+            # Let the workers finish importing before the clock starts
+            time.sleep(1.0)
+            started = time.perf_counter()
+            for topic, payload in uplinks:
+                ingest.put(topic, payload)
+            ingest.close()
+            rate = messages / (time.perf_counter() - started)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        baseline = baseline or rate
+        print(f"  {count:3d} shard(s): {rate:9.0f} msgs/s  x{rate / baseline:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded fleet ingest: one MQTT front, N worker processes")
+    parser.add_argument("--shards", type=int, help="worker processes; changing it rebalances the saved map")
+    parser.add_argument("--data-dir", default="fleet_data")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--username", default="soil-sensor-saranac@ttn")
+    parser.add_argument("--password", default="YOUR_MQTT_PASSWORD")
+    parser.add_argument("--topic", default=UPLINK_TOPIC)
+    parser.add_argument("--batch", type=int, default=ROUTE_BATCH, help="payloads per hand-off to a worker")
+    parser.add_argument("--rebalance", type=int, metavar="N",
+                        help="save an N-shard map, list the devices that move and exit; "
+                             "send SIGHUP to a running front to apply it")
+    parser.add_argument("--bench", metavar="COUNTS", help="compare throughput for shard counts, e.g. 1,2,4")
+    parser.add_argument("--devices", type=int, default=200, help="synthetic devices for --bench")
+    parser.add_argument("--messages", type=int, default=20000, help="synthetic uplinks for --bench")
+    args = parser.parse_args()
+
+    if args.bench:
+        bench([int(count) for count in args.bench.split(",")], args.devices, args.messages, args.batch)
+        return
+
+    if args.rebalance:
+        current = open_shard_map(args.data_dir)
+        resized = current.resized(args.rebalance)
+        keys = stored_devices(args.data_dir)
+        moves = [(key, current.shard_for(key), resized.shard_for(key)) for key in keys]
+        moves = [move for move in moves if move[1] != move[2]]
+        resized.save(map_file_for(args.data_dir))
+        for key, old, new in moves:
+            print(f"  {key}: shard {old} -> {new}")
+        print(f"{len(current.shards)} -> {args.rebalance} shards: {len(moves)} of {len(keys)} devices move "
+              f"(map epoch {resized.epoch})")
+        return
+
+    setup()
+    ingest = ShardedIngest(args.data_dir, open_shard_map(args.data_dir, args.shards), batch_size=args.batch).start()
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.user_data_set(FrontUserdata(args.topic, ingest))
+    client.username_pw_set(args.username, args.password)
+    client.connect_async(args.host, args.port, 60)
+    client.loop_start()
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: ingest.reload.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: ingest.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: ingest.stop())
+    try:
+        ingest.run()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        ingest.close()
+        log.info("Front: routed %d uplinks", ingest.routed)
+
+
+if __name__ == "__main__":
+    main()
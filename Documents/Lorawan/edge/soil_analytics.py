@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Soil Sensor Analytics
+Vectorized rolling statistics and incrementally maintained hourly/daily rollups
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from columnar_store import COLUMNS, missing_value
+from record_store import iter_range, open_store, record_time, valid_readings
+
+ANALYTIC_FIELDS = ("Bat", "temp_SOIL", "water_SOIL", "conduct_SOIL")
+SECOND_NS = 1_000_000_000
+HOUR_NS = 3600 * SECOND_NS
+TIERS = {
+    "hourly": HOUR_NS,
+    "daily": 24 * HOUR_NS,
+}
+BUCKET_STATS = ("mean", "min", "max", "p10", "p50", "p90", "rate")
+PERCENTILES = {"p10": 0.10, "p50": 0.50, "p90": 0.90}
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def load_readings(store, device_id, fields=ANALYTIC_FIELDS, start=None, end=None):
+    """
+    Decoded readings of one device as {"time": int64 ns, field: float64},
+    sorted by time. Missing values are NaN. Reads only the requested
+    columns from a ColumnarStore; falls back to a record scan otherwise.
+    """
+    if hasattr(store, "read"):
+        columns = store.read(device_id, fields, start, end)
+        readings = {"time": columns["time"].astype(np.int64)}
+        for field in fields:
+            values = columns[field].astype(np.float64)
+            if np.dtype(COLUMNS[field]).kind != 'f':
+                values[columns[field] == missing_value(COLUMNS[field])] = np.nan
+            readings[field] = values
+    else:
+        records = iter_range(store, start, end, device_id)
+        times = []
+        values = {field: [] for field in fields}
+        for record in records:
+            times.append(record_time(record))
+            sensor = valid_readings(record)
+            for field in fields:
+                values[field].append(to_float(sensor.get(field)))
+        readings = {"time": np.array(times, dtype=np.int64)}
+        for field in fields:
+            readings[field] = np.array(values[field], dtype=np.float64)
+
+    order = np.argsort(readings["time"], kind="stable")
+    return {name: array[order] for name, array in readings.items()}
+
+
+def range_reduce(values, left, right, op):
+    """
+    op-reduce values[left[i]:right[i]] for every i at once, using a sparse
+    table of op over power-of-two spans (O(n log n) numpy work, no Python
+    loop over windows). Every window must be non-empty.
+    """
+    table = [values]
+    span = 1
+    while span * 2 <= len(values):
+        previous = table[-1]
+        table.append(op(previous[:-span], previous[span:]))
+        span *= 2
+
+    lengths = right - left
+    levels = np.floor(np.log2(lengths)).astype(np.int64)
+    result = np.empty(len(left), dtype=values.dtype)
+    for level in np.unique(levels):
+        mask = levels == level
+        level_table = table[level]
+        result[mask] = op(level_table[left[mask]], level_table[right[mask] - (1 << level)])
+    return result
+
+
+def rolling(time, values, window_ns):
+    """
+    Rolling statistics over a trailing time window (t - window, t] ending
+    at every sample. Returns mean, min, max, std and rate (units per hour).
+    """
+    valid = ~np.isnan(values)
+    time, values = time[valid], values[valid]
+    if len(values) == 0:
+        empty = np.empty(0)
+        return {"time": time, "mean": empty, "min": empty, "max": empty, "std": empty, "rate": empty}
+
+    right = np.arange(1, len(values) + 1)
+    left = np.searchsorted(time, time - window_ns, side='right')
+    counts = right - left
+
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    cumsq = np.concatenate(([0.0], np.cumsum(values * values)))
+    mean = (cumsum[right] - cumsum[left]) / counts
+    variance = np.maximum((cumsq[right] - cumsq[left]) / counts - mean * mean, 0.0)
+
+    elapsed = time - time[left]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(elapsed > 0, (values - values[left]) / elapsed * HOUR_NS, np.nan)
+
+    return {
+        "time": time,
+        "mean": mean,
+        "min": range_reduce(values, left, right, np.minimum),
+        "max": range_reduce(values, left, right, np.maximum),
+        "std": np.sqrt(variance),
+        "rate": rate,
+    }
+
+
+def bucket_stats(time, values, bucket_ns):
+    """
+    Per-bucket count/mean/min/max/p10/p50/p90/rate for time-sorted samples,
+    computed for all buckets in one pass of sorts and reductions.
+    """
+    valid = ~np.isnan(values)
+    time, values = time[valid], values[valid]
+    if len(values) == 0:
+        stats = {name: np.empty(0) for name in BUCKET_STATS}
+        stats.update(bucket=np.empty(0, dtype=np.int64), count=np.empty(0, dtype=np.int64))
+        return stats
+
+    ids = time // bucket_ns
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    ends = np.concatenate((starts[1:], [len(values)]))
+    counts = ends - starts
+
+    # Sort values inside each bucket; buckets keep their time order
+    ordered = values[np.lexsort((values, ids))]
+    stats = {
+        "bucket": ids[starts] * bucket_ns,
+        "count": counts,
+        "mean": np.add.reduceat(values, starts) / counts,
+        "min": ordered[starts],
+        "max": ordered[ends - 1],
+    }
+    for name, q in PERCENTILES.items():
+        position = starts + q * (counts - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        stats[name] = ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    elapsed = time[ends - 1] - time[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats["rate"] = np.where(
+            elapsed > 0, (values[ends - 1] - values[starts]) / elapsed * HOUR_NS, np.nan)
+    return stats
+
+
+def rollup_dtype(fields):
+    columns = [("bucket", "<i8"), ("count", "<u4")]
+    for field in fields:
+        columns += [(f"{field}_{name}", "<f4") for name in BUCKET_STATS]
+    return np.dtype(columns)
+
+
+def rollup_rows(readings, bucket_ns, fields):
+    """Rollup rows for every bucket that has at least one reading"""
+    dtype = rollup_dtype(fields)
+    time = readings["time"]
+    if len(time) == 0:
+        return np.empty(0, dtype=dtype)
+
+    buckets, counts = np.unique(time // bucket_ns, return_counts=True)
+    rows = np.zeros(len(buckets), dtype=dtype)
+    rows["bucket"] = buckets * bucket_ns
+    rows["count"] = counts
+    for field in fields:
+        stats = bucket_stats(time, readings[field], bucket_ns)
+        positions = np.searchsorted(rows["bucket"], stats["bucket"])
+        for name in BUCKET_STATS:
+            column = np.full(len(rows), np.nan, dtype=np.float32)
+            column[positions] = stats[name]
+            rows[f"{field}_{name}"] = column
+    return rows
+
+
+class Rollups:
+    """
+    Downsampled hourly/daily tiers per device, stored as flat structured
+    arrays (<data_file>_rollups/<device>/<tier>.bin) that can be memmapped.
+    update() recomputes only the last stored bucket and anything newer, so
+    the cost follows new data rather than total history.
+    """
+
+    def __init__(self, data_file, fields=ANALYTIC_FIELDS):
+        self.root = os.path.splitext(data_file)[0] + "_rollups"
+        self.fields = tuple(fields)
+        self.dtype = rollup_dtype(self.fields)
+
+    def path(self, device_id, tier):
+        return os.path.join(self.root, device_id, f"{tier}.bin")
+
+    def read(self, device_id, tier="hourly", start=None, end=None):
+        """Rollup rows for a device and tier, optionally within [start, end)"""
+        path = self.path(device_id, tier)
+        if not os.path.exists(path) or os.path.getsize(path) < self.dtype.itemsize:
+            return np.empty(0, dtype=self.dtype)
+        rows = np.memmap(path, dtype=self.dtype, mode='r',
+                         shape=(os.path.getsize(path) // self.dtype.itemsize,))
+        low = 0 if start is None else np.searchsorted(rows["bucket"], start, side='right') - 1
+        high = len(rows) if end is None else np.searchsorted(rows["bucket"], end)
+        return rows[max(low, 0):high]
+
+    def update(self, store, device_id, since=None):
+        """
+        Bring every tier up to date. Pass since= (ns) when older readings
+        were backfilled so their buckets are recomputed too.
+        """
+        added = {}
+        for tier, bucket_ns in TIERS.items():
+            existing = self.read(device_id, tier)
+            resume = int(existing["bucket"][-1]) if len(existing) else None
+            if since is not None:
+                aligned = since // bucket_ns * bucket_ns
+                resume = aligned if resume is None else min(resume, aligned)
+
+            readings = load_readings(store, device_id, self.fields, start=resume)
+            rows = rollup_rows(readings, bucket_ns, self.fields)
+            keep = len(existing) if resume is None else int(np.searchsorted(existing["bucket"], resume))
+            del existing
+
+            path = self.path(device_id, tier)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                f.truncate(keep * self.dtype.itemsize)
+                f.write(rows.tobytes())
+            added[tier] = len(rows)
+        return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling statistics and rollups over soil readings")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments", help="segments or columnar")
+    parser.add_argument("--device", default="lestat-lives")
+    parser.add_argument("--window", type=float, default=24.0, help="rolling window in hours")
+    args = parser.parse_args()
+
+    store = open_store(args.data_file, args.backend, read_only=True)
+    readings = load_readings(store, args.device)
+    print(f"Soil Sensor Analytics: {args.device}, {len(readings['time'])} readings")
+    print("=" * 60)
+    if len(readings["time"]) == 0:
+        return
+
+    for field in ANALYTIC_FIELDS:
+        stats = rolling(readings["time"], readings[field], int(args.window * HOUR_NS))
+        if len(stats["mean"]) == 0:
+            continue
+        print(f"{field:>13}: last {args.window:g}h mean {stats['mean'][-1]:.3f}, "
+              f"min {stats['min'][-1]:.3f}, max {stats['max'][-1]:.3f}, "
+              f"rate {stats['rate'][-1]:+.4f}/h")
+
+    rollups = Rollups(args.data_file)
+    added = rollups.update(store, args.device)
+    print(f"\nRollups updated: {added}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,81 +5,65 @@ Collects soil sensor data from TTN and saves to JSON
 """
 
 import paho.mqtt.client as mqtt
-import json
-import os
-import subprocess
 from datetime import datetime
+from itertools import chain
+from checkpoint import open_checkpoint
+from dedup_index import open_dedup_index, uplink_key
+from dragino_codec import sensor_data_for
+from fault_detector import FaultDetector
+from gap_tracker import open_gap_tracker
+from ingest_queue import IngestQueue
+from instrumentation import (DEDUP_HITS, MESSAGE_SECONDS, RECORDS_STORED, SAVE_SECONDS,
+                             get_logger, instrumented, setup)
+from record_store import open_store
+from ttn_storage import get_client, stream_uplinks
+
+log = get_logger("soil_collector")
 
 class SoilCollector:
-    def __init__(self, data_file="soil_data.json"):
+    def __init__(self, data_file="soil_data.json", backend="segments"):
         self.data_file = data_file
-        self.data = []
+        self.store = open_store(data_file, backend)
+        self.index = open_dedup_index(data_file, self.store)
+        self.checkpoint = open_checkpoint(data_file, self.store)
+        self.detector = FaultDetector(data_file, backend)
+        self.gaps = open_gap_tracker(data_file, self.store)
         self.load_data()
     
     def load_data(self):
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                self.data = json.load(f)
-            print(f"Loaded {len(self.data)} existing records")
+        # History stays on disk; the checkpoint knows how much there is
+        if self.checkpoint.count:
+            log.info("Loaded %d existing records", self.checkpoint.count)
         else:
-            print("No existing data found")
+            log.info("No existing data found")
     
     def fetch_historical_data(self):
-        """Fetch historical data using curl"""
-        print("Fetching historical data...")
-        
-        curl_command = [
-            "curl", "-G",
-            "https://nam1.cloud.thethings.network/api/v3/as/applications/soil-sensor-saranac/devices/lestat-lives/packages/storage/uplink_message",
-            "-H", "Authorization: Bearer YOUR_TTN_API_KEY",
-            "-H", "Accept: text/event-stream",
-            "-d", "last=12h"
-        ]
+        """Stream historical data from the TTN Storage API"""
+        log.info("Fetching historical data...")
         
         try:
-            result = subprocess.run(curl_command, capture_output=True, text=True, timeout=30)
-            
-            if result.returncode == 0 and result.stdout.strip():
-                # Parse multiple JSON objects (one per line)
-                lines = result.stdout.strip().split('\n')
-                print(f"Processing {len(lines)} lines from curl response")
-                
-                for line in lines:
-                    if line.strip():
-                        try:
-                            json_data = json.loads(line.strip())
-                            if 'result' in json_data:
-                                result_data = json_data['result']
-                                
-                                # Check if this data already exists
-                                if not self.data_exists(result_data):
-                                    print("New historical data found, adding...")
-                                    self.add_historical_data(result_data)
-                                else:
-                                    print("Historical data already exists, skipping...")
-                            else:
-                                print("No result data in this line")
-                        except json.JSONDecodeError as e:
-                            print(f"Error parsing JSON line: {e}")
-                            print(f"Line content: {line[:100]}...")
-            else:
-                print("No historical data available")
-                
+            # New uplinks after the high-water mark, then the ones missed before it
+            uplinks = chain(stream_uplinks(last="12h", after=self.high_water_mark()),
+                            self.gaps.fetch(get_client()))
+            for result_data in uplinks:
+                # Check if this data already exists
+                if not self.data_exists(result_data):
+                    self.add_historical_data(result_data)
+                else:
+                    DEDUP_HITS.inc(source="storage")
+                    log.debug("Historical data already exists, skipping...")
         except Exception as e:
-            print(f"Error fetching historical data: {e}")
+            log.error("Error fetching historical data: %s", e)
+    
+    def high_water_mark(self):
+        """Latest received_at already stored; backfills resume after it"""
+        return self.checkpoint.high_water_mark()
     
     def data_exists(self, new_data):
-        """Check if data already exists based on received_at timestamp"""
-        new_timestamp = new_data.get('received_at', '')
-        
-        for existing in self.data:
-            if 'raw_message' in existing:
-                raw = existing['raw_message']
-                if 'data' in raw and 'received_at' in raw['data']:
-                    if raw['data']['received_at'] == new_timestamp:
-                        return True
-        return False
+        """Check the dedup index for this (device, f_cnt, received_at)"""
+        return uplink_key(new_data) in self.index
     
+    @instrumented(MESSAGE_SECONDS, source="storage")
     def add_historical_data(self, result_data):
         """Add historical data to collection"""
         timestamp = result_data.get('received_at', datetime.now().isoformat())
@@ -88,34 +72,52 @@ class SoilCollector:
         data_point = {
             "timestamp": timestamp,
             "device_id": result_data.get('end_device_ids', {}).get('device_id', 'lestat-lives'),
-            "sensor_data": result_data.get('uplink_message', {}).get('decoded_payload', {}),
+            "sensor_data": sensor_data_for(result_data.get('uplink_message', {})),
             "raw_message": {"data": result_data}
         }
         
-        self.data.append(data_point)
-        print(f"Added historical data point #{len(self.data)}")
+        self.gaps.observe(result_data)
+        if not self.detector.admit(data_point):
+            log.info("Quarantined %s: %s", data_point['device_id'], data_point['quality']['flags'])
+            return
+        self.store.append(data_point)
+        self.index.add(uplink_key(result_data))
+        self.checkpoint.observe(data_point)
+        RECORDS_STORED.inc()
+        log.info("Added historical data point #%d", self.checkpoint.count)
         
-        # Print sensor readings
+        # Log sensor readings
         sensor_data = data_point['sensor_data']
         if sensor_data:
-            print(f"Battery: {sensor_data.get('Bat', 'N/A')}V")
-            print(f"Soil Temp: {sensor_data.get('temp_SOIL', 'N/A')}C")
-            print(f"Soil Moisture: {sensor_data.get('water_SOIL', 'N/A')}%")
-            print(f"Conductivity: {sensor_data.get('conduct_SOIL', 'N/A')}")
-        
-        self.save_data()
+            log.debug("Battery: %sV, soil temp: %sC, soil moisture: %s%%, conductivity: %s",
+                      sensor_data.get('Bat', 'N/A'), sensor_data.get('temp_SOIL', 'N/A'),
+                      sensor_data.get('water_SOIL', 'N/A'), sensor_data.get('conduct_SOIL', 'N/A'))
     
+    @instrumented(SAVE_SECONDS)
     def save_data(self):
-        with open(self.data_file, 'w') as f:
-            json.dump(self.data, f, indent=2)
-        print(f"Saved {len(self.data)} records")
+        self.store.flush()
+        self.detector.flush()
+        # Index last: it must never cover records that are not on disk yet
+        self.index.flush()
+        self.checkpoint.save()
+        self.gaps.save()
+        log.info("Saved %d records", self.checkpoint.count)
     
+    @instrumented(MESSAGE_SECONDS, source="mqtt")
     def add_message(self, message):
         timestamp = datetime.now().isoformat()
         
+        # Skip uplinks already stored, e.g. by a storage API backfill
+        key = uplink_key(message["data"])
+        if key in self.index:
+            DEDUP_HITS.inc(source="mqtt")
+            log.debug("Duplicate uplink, skipping...")
+            return
+        self.gaps.observe(message["data"])
+        
         # Extract device info and sensor data (always in same format)
         device_id = message["data"]["end_device_ids"].get("device_id", "unknown")
-        sensor_data = message["data"]["uplink_message"].get("decoded_payload", {})
+        sensor_data = sensor_data_for(message["data"]["uplink_message"])
         
         # Create data point
         data_point = {
@@ -124,43 +126,61 @@ class SoilCollector:
             "sensor_data": sensor_data,
             "raw_message": message
         }
+        if not self.detector.admit(data_point):
+            log.info("Quarantined %s: %s", data_point['device_id'], data_point['quality']['flags'])
+            return
+        sensor_data = data_point['sensor_data']
         
-        self.data.append(data_point)
-        print(f"Added data point #{len(self.data)}")
+        self.store.append(data_point)
+        self.index.add(key)
+        self.checkpoint.observe(data_point)
+        RECORDS_STORED.inc()
+        log.info("Added data point #%d", self.checkpoint.count)
         
-        # Print sensor readings
+        # Log sensor readings
         if sensor_data:
-            print(f"Battery: {sensor_data.get('Bat', 'N/A')}V")
-            print(f"Soil Temp: {sensor_data.get('temp_SOIL', 'N/A')}C")
-            print(f"Soil Moisture: {sensor_data.get('water_SOIL', 'N/A')}%")
-            print(f"Conductivity: {sensor_data.get('conduct_SOIL', 'N/A')}")
-        
-        self.save_data()
+            log.debug("Battery: %sV, soil temp: %sC, soil moisture: %s%%, conductivity: %s",
+                      sensor_data.get('Bat', 'N/A'), sensor_data.get('temp_SOIL', 'N/A'),
+                      sensor_data.get('water_SOIL', 'N/A'), sensor_data.get('conduct_SOIL', 'N/A'))
+
+class MqttUserdata:
+    """MQTT userdata: the ingest queue plus the gap tracker told about disconnects"""
+
+    def __init__(self, ingest, gaps):
+        self.ingest = ingest
+        self.gaps = gaps
 
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        print("Connected to MQTT")
+        log.info("Connected to MQTT")
         client.subscribe("v3/soil-sensor-saranac/devices/lestat-lives/up")
-        print("Subscribed to lestat-lives")
+        log.info("Subscribed to lestat-lives")
+        # Uplinks published while we were away are only in TTN storage
+        userdata.gaps.connected()
     else:
-        print(f"Connection failed: {rc}")
+        log.warning("Connection failed: %s", rc)
 
 def on_message(client, userdata, msg, properties=None):
-    print(f"\nNew message received")
-    try:
-        data = json.loads(msg.payload.decode())
-        userdata.add_message(data)
-    except Exception as e:
-        print(f"Error processing message: {e}")
+    # Runs on paho's network thread: only enqueue, the writer thread does the rest
+    userdata.ingest.put(msg.payload)
+
+def on_disconnect(client, userdata, flags, rc, properties=None):
+    userdata.gaps.disconnected()
+    if rc != 0:
+        log.warning("Unexpected MQTT disconnection: %s", rc)
+    else:
+        log.info("Disconnected from MQTT")
 
 def main():
     print("Soil Sensor Data Collector")
     print("=" * 30)
     
+    setup()
     collector = SoilCollector()
     
     # Step 1: Fetch historical data
     collector.fetch_historical_data()
+    collector.save_data()
     
     # Step 2: Start MQTT collection
     print("\nStarting MQTT collection...")
@@ -168,7 +188,10 @@ def main():
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
-    client.user_data_set(collector)
+    client.on_disconnect = on_disconnect
+    # Decode and persist off the network thread, one flush per batch
+    ingest = IngestQueue(collector.add_message, collector.save_data).start()
+    client.user_data_set(MqttUserdata(ingest, collector.gaps))
     
     # MQTT settings
     mqtt_host = "localhost"
@@ -186,9 +209,18 @@ def main():
     except KeyboardInterrupt:
         print("\nStopping...")
         client.disconnect()
-        print(f"Final count: {len(collector.data)} records")
+        ingest.stop()
+        print(f"Final count: {collector.checkpoint.count} records")
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        ingest.stop()
+        print(f"Ingest queue stats: {ingest.stats()}")
+        collector.store.close()
+        collector.detector.close()
+        collector.index.close()
+        collector.checkpoint.save()
+        collector.gaps.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Soil Prompt Context
+Token-budgeted LLM prompt context built from rollups, trends and anomalies
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+
+from checkpoint import open_checkpoint
+from journal import atomic_write_json
+from record_store import open_store, to_ns
+from soil_analytics import ANALYTIC_FIELDS, HOUR_NS, Rollups, load_readings, rolling
+from window_index import WindowIndex
+
+# Display name, unit, and the 24h change below which a field counts as steady
+FIELD_INFO = {
+    "Bat": ("battery", "V", 0.02),
+    "temp_SOIL": ("soil temperature", "°C", 0.5),
+    "water_SOIL": ("soil moisture", "%", 1.0),
+    "conduct_SOIL": ("soil conductivity", "uS/cm", 5.0),
+}
+LOOKBACK_NS = 7 * 24 * HOUR_NS
+ANOMALY_Z = 3.0
+ANOMALY_MIN_SAMPLES = 6   # readings needed before the trailing spread is trusted
+SYSTEM_PROMPT = ("You are an agronomy assistant for a LoRaWAN soil sensor. "
+                 "Answer only from the sensor context below.")
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English/numbers)"""
+    return (len(text) + 3) // 4
+
+
+def format_time(ns):
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def describe_trend(change, tolerance):
+    if np.isnan(change) or abs(change) < tolerance:
+        return "steady"
+    return "rising" if change > 0 else "falling"
+
+
+def build_prompt(context, question):
+    """Full prompt for a question about the sensor described by context"""
+    return f"{SYSTEM_PROMPT}\n\n{context}\n\nQuestion: {question}\nAnswer:"
+
+
+class ContextBuilder:
+    """
+    Renders what is known about a device as compact text within a token
+    budget. Sections are filled in priority order (latest reading, trends,
+    anomalies, similar past periods, daily then hourly rollups, newest
+    first) until the budget runs out. Rendered contexts are cached in memory and under
+    <data_file>_context/, keyed by device, fields, budget and the device's
+    high-water mark, so repeated questions about unchanged data skip the
+    store entirely.
+    """
+
+    def __init__(self, data_file, backend="segments", store=None, checkpoint=None,
+                 token_budget=400, fields=ANALYTIC_FIELDS, count_tokens=estimate_tokens,
+                 cache_entries=64, similar=3):
+        self.data_file = data_file
+        self.store = store or open_store(data_file, backend, read_only=True)
+        # A checkpoint shared with an in-process collector is always current;
+        # one opened here is reloaded when a collector rewrites it
+        self.own_checkpoint = checkpoint is None
+        self.checkpoint = checkpoint or open_checkpoint(data_file, self.store)
+        self.checkpoint_mtime = self.mtime(self.checkpoint.checkpoint_file)
+        self.rollups = Rollups(data_file)
+        self.token_budget = token_budget
+        self.fields = tuple(field for field in fields if field in FIELD_INFO)
+        self.similar = similar
+        self.count_tokens = count_tokens
+        self.cache_dir = os.path.splitext(data_file)[0] + "_context"
+        self.cache = OrderedDict()
+        self.cache_entries = cache_entries
+        # context() rewrites rollup files and the caches; one caller at a time
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def mtime(path):
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    def cache_key(self, device_id, token_budget):
+        mtime = self.mtime(self.checkpoint.checkpoint_file)
+        if self.own_checkpoint and mtime != self.checkpoint_mtime:
+            self.checkpoint.load()
+            self.checkpoint_mtime = mtime
+        high_water = self.checkpoint.high_water_mark(device_id)
+        return [device_id, high_water, list(self.fields), token_budget]
+
+    def cache_path(self, device_id):
+        return os.path.join(self.cache_dir, f"{device_id}.json")
+
+    def context(self, device_id, token_budget=None):
+        """Context text for a device, rebuilt only when new data has arrived; thread-safe"""
+        with self.lock:
+            return self.locked_context(device_id, token_budget or self.token_budget)
+
+    def locked_context(self, device_id, token_budget):
+        key = self.cache_key(device_id, token_budget)
+        memory_key = json.dumps(key)
+        if memory_key in self.cache:
+            self.cache.move_to_end(memory_key)
+            self.hits += 1
+            return self.cache[memory_key]
+
+        path = self.cache_path(device_id)
+        text = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    cached = json.load(f)
+                if cached.get("key") == key:
+                    text = cached["context"]
+            except ValueError:
+                pass
+        if text is None:
+            self.misses += 1
+            text = self.render(device_id, token_budget)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write_json(path, {"key": key, "context": text})
+        else:
+            self.hits += 1
+
+        self.cache[memory_key] = text
+        if len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+        return text
+
+    def sections(self, device_id):
+        """(title, lines) in priority order; lines are most important first"""
+        high_water = self.checkpoint.high_water_mark(device_id)
+        if high_water is None:
+            return [("Sensor", [f"No readings stored for {device_id}."])]
+        end = to_ns(high_water)
+        readings = load_readings(self.store, device_id, self.fields,
+                                 start=end - LOOKBACK_NS, end=end + 1)
+        time = readings["time"]
+        if len(time) == 0:
+            return [("Sensor", [f"No readings stored for {device_id} in the last 7 days."])]
+
+        header = [f"Device {device_id}: {len(time)} readings from "
+                  f"{format_time(time[0])} to {format_time(time[-1])} UTC."]
+
+        latest = []
+        for field in self.fields:
+            name, unit, _ = FIELD_INFO[field]
+            values = readings[field]
+            valid = np.flatnonzero(~np.isnan(values))
+            if len(valid):
+                latest.append(f"{name}: {values[valid[-1]]:.2f} {unit} at {format_time(time[valid[-1]])}")
+
+        trends = []
+        anomalies = []
+        for field in self.fields:
+            name, unit, tolerance = FIELD_INFO[field]
+            stats = rolling(time, readings[field], 24 * HOUR_NS)
+            if len(stats["mean"]) == 0:
+                continue
+            change = stats["rate"][-1] * 24
+            trends.append(f"{name} {describe_trend(change, tolerance)} "
+                          f"({change:+.2f} {unit}/24h, 24h range {stats['min'][-1]:.2f}-{stats['max'][-1]:.2f})")
+
+            # Readings far from the trailing 24h mean of the samples before them
+            values = readings[field][~np.isnan(readings[field])]
+            mean, std = stats["mean"][:-1], stats["std"][:-1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = np.abs(values[1:] - mean) / std
+            flagged = np.flatnonzero((std > 0) & (z > ANOMALY_Z)) + 1
+            flagged = flagged[flagged >= ANOMALY_MIN_SAMPLES]
+            if len(flagged):
+                newest = flagged[-1]
+                anomalies.append(f"{name}: {len(flagged)} outliers in 7 days, latest "
+                                 f"{values[newest]:.2f} {unit} at {format_time(stats['time'][newest])}")
+
+        sections = [("Sensor", header), ("Latest", latest), ("Trends", trends), ("Anomalies", anomalies)]
+        self.rollups.update(self.store, device_id)
+
+        # Only devices someone has built a window index for (window_index.py)
+        index = WindowIndex(self.data_file, device_id)
+        if self.similar and len(index):
+            index.update(self.store, self.rollups)
+            lines = [f"{format_time(end - (index.hours - 1) * HOUR_NS)} to {format_time(end)} "
+                     f"(distance {distance:.2f})" for end, distance in index.similar_to(k=self.similar)]
+            sections.append(("Most similar past 24h periods", lines))
+        for tier in ("daily", "hourly"):
+            rows = self.rollups.read(device_id, tier, start=end - LOOKBACK_NS)
+            lines = []
+            for row in rows[::-1]:
+                parts = [f"{FIELD_INFO[field][0]} {row[f'{field}_mean']:.2f}"
+                         for field in self.fields if not np.isnan(row[f'{field}_mean'])]
+                lines.append(f"{format_time(int(row['bucket']))}: " + ", ".join(parts))
+            sections.append((f"{tier.capitalize()} means (newest first)", lines))
+        return sections
+
+    def render(self, device_id, token_budget):
+        """Fill sections in order, stopping at the first line that does not fit"""
+        out = []
+        used = 0
+        for title, lines in self.sections(device_id):
+            if not lines:
+                continue
+            heading = f"## {title}"
+            cost = self.count_tokens(heading + "\n") + self.count_tokens(lines[0] + "\n")
+            if used + cost > token_budget:
+                break
+            out.append(heading)
+            used += self.count_tokens(heading + "\n")
+            for line in lines:
+                cost = self.count_tokens(line + "\n")
+                if used + cost > token_budget:
+                    return "\n".join(out)
+                out.append(line)
+                used += cost
+        return "\n".join(out)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self.cache)}
+
+
+class StubModel:
+    """
+    Deterministic offline stand-in for an LLM. It answers with the context
+    lines that share the most words with the question, so prompts and
+    caching can be exercised without a model or network.
+    """
+
+    def __init__(self, max_lines=3):
+        self.max_lines = max_lines
+
+    def generate(self, prompt):
+        body, _, question = prompt.rpartition("\nQuestion: ")
+        question = question.split("\nAnswer:")[0]
+        words = set(re.findall(r"[a-z]+", question.lower()))
+        scored = []
+        for position, line in enumerate(body.splitlines()):
+            if not line or line.startswith("## ") or line == SYSTEM_PROMPT:
+                continue
+            overlap = len(words & set(re.findall(r"[a-z]+", line.lower())))
+            if overlap:
+                scored.append((-overlap, position, line))
+        if not scored:
+            return "The sensor context does not cover that."
+        return " ".join(line for _, _, line in sorted(scored)[:self.max_lines])
+
+
+def ask(builder, model, device_id, question):
+    """Answer a question about a device using its (cached) context"""
+    return model.generate(build_prompt(builder.context(device_id), question))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build token-budgeted LLM context from soil readings")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments", help="segments or columnar")
+    parser.add_argument("--device", default="lestat-lives")
+    parser.add_argument("--budget", type=int, default=400, help="context token budget")
+    parser.add_argument("--fields", default=",".join(ANALYTIC_FIELDS))
+    parser.add_argument("--ask", metavar="QUESTION", help="answer with the offline stub model")
+    args = parser.parse_args()
+
+    builder = ContextBuilder(args.data_file, args.backend, token_budget=args.budget,
+                             fields=args.fields.split(','))
+    context = builder.context(args.device)
+    print(context)
+    print(f"\n[{estimate_tokens(context)} of {args.budget} tokens, cache {builder.stats()}]")
+    if args.ask:
+        print(f"\nQ: {args.ask}\nA: {ask(builder, StubModel(), args.device, args.ask)}")
+    builder.store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Backfill scheduler: devices resume from the checkpoint, and rate 0 is unlimited"""
+
+import pytest
+
+import ttn_storage
+from backfill_scheduler import BackfillScheduler, RateLimiter
+from orin_soil_collector import OrinSoilCollector
+from record_store import to_ns
+
+
+def fleet(uplinks):
+    return sorted({(uplink["end_device_ids"]["application_ids"]["application_id"],
+                    uplink["end_device_ids"]["device_id"]) for uplink in uplinks})
+
+
+def backfill(data_file, devices):
+    """Run one backfill; returns (records added, after= sent per device)"""
+    collector = OrinSoilCollector(data_file)
+    scheduler = BackfillScheduler(collector, devices, {app: 0 for app, _ in devices}, max_workers=4)
+    sent = {}
+    iter_uplinks = scheduler.client.iter_uplinks
+
+    def spy(application_id, device_id, **options):
+        sent[application_id, device_id] = options.get("after")
+        return iter_uplinks(application_id, device_id, **options)
+
+    scheduler.client.iter_uplinks = spy
+    try:
+        return scheduler.run(), sent
+    finally:
+        scheduler.client.close()
+        collector.store.close()
+        collector.detector.close()
+        collector.index.close()
+        collector.checkpoint.save()
+        collector.gaps.save()
+
+
+def test_devices_resume_from_checkpoint(tmp_path, uplinks, replay_server, monkeypatch):
+    data_file = str(tmp_path / "orin_soil_data.json")
+    devices = fleet(uplinks)
+    server = replay_server(uplinks[:100])
+    monkeypatch.setattr(ttn_storage, "TTN_BASE_URL", server.base_url)
+    added, sent = backfill(data_file, devices)
+    assert added == 100
+    assert set(sent.values()) == {None}
+
+    server = replay_server(uplinks)
+    monkeypatch.setattr(ttn_storage, "TTN_BASE_URL", server.base_url)
+    added, sent = backfill(data_file, devices)
+    assert added == 100
+    for (app, dev), after in sent.items():
+        stored = [uplink["received_at"] for uplink in uplinks[:100]
+                  if uplink["end_device_ids"]["device_id"] == dev]
+        assert after == max(stored, key=to_ns)
+
+
+def test_rate_limiter_rate_zero_is_unlimited():
+    limiter = RateLimiter(0)
+    for _ in range(1000):
+        limiter.acquire()
+    with pytest.raises(ValueError):
+        RateLimiter(-1)
@@ -0,0 +1,21 @@
+"""Ingest benchmark: every scenario runs end to end on a few uplinks"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from bench_ingest import SCENARIOS
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_scenario_runs(tmp_path, scenario):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_ingest.py")
+    result = subprocess.run([sys.executable, script, "--scenarios", scenario, "--messages", "40",
+                             "--devices", "4", "--dir", str(tmp_path), "--no-record"],
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    rows = [line.split() for line in result.stdout.splitlines()]
+    assert [row[0] for row in rows if row and row[0] == scenario] == [scenario]
+    assert "dropped" not in result.stdout
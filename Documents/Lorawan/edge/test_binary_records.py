@@ -0,0 +1,18 @@
+"""Binary record store: records round trip, and a reopened store keeps appending"""
+
+from conftest import collector_record, read_records, write_records
+
+
+def test_records_round_trip(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "binary", records)
+    assert read_records(data_file, "binary") == records
+
+
+def test_reopened_store_keeps_appending(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "binary", records[:75])
+    write_records(data_file, "binary", records[75:])
+    assert read_records(data_file, "binary") == records
@@ -0,0 +1,195 @@
+"""Export resumes from its cursor, survives a crash part way, and syncs only new bytes"""
+
+import csv
+import gzip
+import json
+import os
+
+import pytest
+
+import export_sync
+from conftest import collector_record, write_records
+from record_store import open_store
+from export_sync import MANIFEST, DirectoryTarget, Exporter, HttpTarget, sync
+
+
+def exported_rows(out_dir):
+    rows = []
+    for root, _, names in os.walk(out_dir):
+        for name in names:
+            if name.endswith(".csv.gz"):
+                with gzip.open(os.path.join(root, name), 'rt', newline='') as f:
+                    rows.extend(csv.DictReader(f))
+    return rows
+
+
+def export_keys(rows):
+    return sorted((row["device_id"], int(row["f_cnt"])) for row in rows)
+
+
+def record_keys(records):
+    return sorted((record["device_id"], record["raw_message"]["data"]["uplink_message"]["f_cnt"])
+                  for record in records)
+
+
+def committed_files(out_dir):
+    with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+        return json.load(f)["files"]
+
+
+@pytest.mark.parametrize("backend", ("segments", "columnar", "binary"))
+def test_export_resumes_after_crash(tmp_path, uplinks, backend, monkeypatch):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, backend, records[:150])
+
+    export_row = export_sync.export_row
+    seen = []
+
+    def crash_part_way(record):
+        seen.append(record)
+        if len(seen) > 120:
+            raise RuntimeError("crash")
+        return export_row(record)
+
+    monkeypatch.setattr(export_sync, "export_row", crash_part_way)
+    with pytest.raises(RuntimeError):
+        Exporter(data_file, out_dir, backend, commit_rows=50).run()
+    monkeypatch.undo()
+
+    # Rows written after the last commit are cut away, then exported once
+    assert Exporter(data_file, out_dir, backend, commit_rows=50).run() == 50
+    assert export_keys(exported_rows(out_dir)) == record_keys(records[:150])
+
+    write_records(data_file, backend, records[150:])
+    assert Exporter(data_file, out_dir, backend).run() == 50
+    assert Exporter(data_file, out_dir, backend).run() == 0
+    assert export_keys(exported_rows(out_dir)) == record_keys(records)
+
+
+def test_export_bounds_buffered_rows(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "segments", records)
+    exporter = Exporter(data_file, out_dir, max_buffered=16)
+    buffered = []
+    add = exporter.add
+
+    def tracking_add(name, row):
+        add(name, row)
+        buffered.append(exporter.buffered)
+
+    exporter.add = tracking_add
+    assert exporter.run() == len(records)
+    assert max(buffered) <= 16
+    assert export_keys(exported_rows(out_dir)) == record_keys(records)
+
+
+def test_sync_sends_only_new_bytes(tmp_path, uplinks, sync_server):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "segments", records[:100])
+    Exporter(data_file, out_dir).run()
+    first = committed_files(out_dir)
+
+    target = HttpTarget(sync_server.base_url)
+    try:
+        assert sync(out_dir, target) == sum(first.values())
+        assert sync(out_dir, target) == 0
+
+        write_records(data_file, "segments", records[100:])
+        Exporter(data_file, out_dir).run()
+        second = committed_files(out_dir)
+        # CSV partitions grow by appended gzip members, so only those are sent
+        assert sync(out_dir, target) == sum(second.values()) - sum(first.values())
+    finally:
+        target.close()
+
+    for name in second:
+        with open(os.path.join(out_dir, name), 'rb') as f, open(os.path.join(sync_server.root, name), 'rb') as g:
+            assert f.read() == g.read()
+    assert sync_server.received == sum(second.values())
+
+
+def test_sync_resumes_without_state(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    write_records(data_file, "segments", [collector_record(uplink) for uplink in uplinks])
+    Exporter(data_file, out_dir).run()
+    target_dir = str(tmp_path / "target")
+    assert sync(out_dir, DirectoryTarget(target_dir)) == sum(committed_files(out_dir).values())
+    # A lost state file costs a CRC check per file, not a second upload
+    os.remove(os.path.join(out_dir, export_sync.SYNC_STATE))
+    assert sync(out_dir, DirectoryTarget(target_dir)) == 0
+
+
+def test_sync_skips_target_bytes_that_differ(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    write_records(data_file, "segments", [collector_record(uplink) for uplink in uplinks[:100]])
+    Exporter(data_file, out_dir).run()
+    target_dir = str(tmp_path / "target")
+    sync(out_dir, DirectoryTarget(target_dir))
+
+    name = sorted(committed_files(out_dir))[0]
+    with open(os.path.join(target_dir, name), 'r+b') as f:
+        f.write(b"X")
+    os.remove(os.path.join(out_dir, export_sync.SYNC_STATE))
+    write_records(data_file, "segments", [collector_record(uplink) for uplink in uplinks[100:]])
+    Exporter(data_file, out_dir).run()
+    before = os.path.getsize(os.path.join(target_dir, name))
+    sync(out_dir, DirectoryTarget(target_dir))
+    # Nothing is appended to bytes that are not the export's own
+    assert os.path.getsize(os.path.join(target_dir, name)) == before
+
+
+def test_full_export_syncs_under_new_names(tmp_path, uplinks, sync_server):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "segments", records)
+    Exporter(data_file, out_dir).run()
+    target = HttpTarget(sync_server.base_url)
+    try:
+        sync(out_dir, target)
+        first = committed_files(out_dir)
+
+        assert Exporter(data_file, out_dir, full=True).run() == len(records)
+        second = committed_files(out_dir)
+        assert all(name.startswith("epoch=2" + os.sep) for name in second)
+        assert not set(first) & set(second)
+        assert sync(out_dir, target) == sum(second.values())
+    finally:
+        target.close()
+
+    rows = []
+    for name in second:
+        with gzip.open(os.path.join(sync_server.root, name), 'rt', newline='') as f:
+            rows.extend(csv.DictReader(f))
+    assert export_keys(rows) == record_keys(records)
+
+
+def test_export_of_missing_store_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Exporter(str(tmp_path / "soil_data.json"), str(tmp_path / "export")).run()
+
+
+def test_export_after_compaction_asks_for_full(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "export")
+    records = [collector_record(uplink) for uplink in uplinks]
+    store = open_store(data_file, "segments", segment_bytes=4096)
+    for record in records[:100]:
+        store.append(record)
+    Exporter(data_file, out_dir).run()
+    for record in records[100:]:
+        store.append(record)
+    store.compact()
+    store.close()
+
+    with pytest.raises(ValueError, match="--full"):
+        Exporter(data_file, out_dir).run()
+    assert Exporter(data_file, out_dir, full=True).run() == len(records)
@@ -0,0 +1,38 @@
+"""Gap tracker: frame counter holes are fetched from a ReplayServer or written off"""
+
+from bench_ingest import FIRST_DEVICE
+from conftest import f_cnt
+from gap_tracker import GapTracker
+from ttn_storage import StorageClient
+
+FOREVER = 100 * 365 * 86400.0   # retention that never writes off the synthetic uplinks
+
+
+def device_uplinks(uplinks, device_id=FIRST_DEVICE):
+    return [uplink for uplink in uplinks if uplink["end_device_ids"]["device_id"] == device_id]
+
+
+def test_gap_fetch_recovers_holes_and_writes_off_lost_uplinks(tmp_path, uplinks, replay_server):
+    device = device_uplinks(uplinks)
+    key = f"{device[0]['end_device_ids']['application_ids']['application_id']}/{FIRST_DEVICE}"
+    # 10-12 and 30 were missed over MQTT; storage never got 40 either
+    server = replay_server([uplink for uplink in uplinks if uplink not in device or f_cnt(uplink) != 40])
+    tracker = GapTracker(str(tmp_path / "gaps.json"), settle=0, retention=FOREVER)
+    for uplink in device:
+        if f_cnt(uplink) not in (10, 11, 12, 30, 40):
+            tracker.observe(uplink)
+    report = tracker.report()[key]
+    assert (report["gaps"], report["missing"]) == (3, 5)
+
+    client = StorageClient(base_url=server.base_url)
+    try:
+        fetched = list(tracker.fetch(client))
+        # Nothing is left to fetch afterwards
+        assert list(tracker.fetch(client)) == []
+    finally:
+        client.close()
+
+    assert sorted(f_cnt(uplink) for uplink in fetched) == [10, 11, 12, 30]
+    report = tracker.report()[key]
+    assert (report["gaps"], report["missing"], report["lost"]) == (0, 0, 1)
+    assert report["f_cnt"] == [1, 50]
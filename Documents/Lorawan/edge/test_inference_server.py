@@ -0,0 +1,52 @@
+"""Inference service: malformed requests get 400, context failures 500, valid ones an answer"""
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from inference_server import InferenceServer, make_scheduler
+
+
+class BrokenContext:
+    """ContextBuilder stand-in whose store has gone away"""
+
+    def context(self, device_id):
+        raise FileNotFoundError(f"No record log for {device_id}")
+
+
+@pytest.fixture
+def server():
+    scheduler = make_scheduler("reference")
+    server = InferenceServer(scheduler, port=0, context_builder=BrokenContext()).start()
+    yield server
+    server.stop()
+    scheduler.stop()
+
+
+def post(server, path, body):
+    request = urllib.request.Request(server.base_url + path, data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_generate_answers(server):
+    status, body = post(server, "/generate", {"prompt": "Is it dry?", "max_tokens": 8, "stream": False})
+    assert status == 200
+    assert json.loads(body)["tokens"] <= 8
+
+
+@pytest.mark.parametrize("body", ({"prompt": "x", "max_tokens": "many"}, {"prompt": "x", "max_tokens": None},
+                                  {"max_tokens": 8}, ["not", "an", "object"]))
+def test_malformed_request_is_rejected(server, body):
+    assert post(server, "/generate", body)[0] == 400
+
+
+def test_context_failure_is_a_server_error(server):
+    status, body = post(server, "/ask", {"device": "lestat-lives", "question": "Is it dry?"})
+    assert status == 500
+    assert "No record log" in json.loads(body)["error"]
@@ -0,0 +1,40 @@
+"""LoRA dataset: builds resume from the store position, and the bench needs a full batch"""
+
+import pytest
+
+from conftest import collector_record, write_records
+from lora_dataset import DatasetBuilder, ShardDataset, bench
+from record_store import open_store
+
+
+def build(data_file, out_dir):
+    store = open_store(data_file, read_only=True)
+    try:
+        return DatasetBuilder(store, out_dir, "sequence", window=12, stride=6).build()
+    finally:
+        store.close()
+
+
+def test_build_resumes_from_store_position(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "lora")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "segments", records[:100])
+    first = build(data_file, out_dir)
+    assert first > 0
+    assert build(data_file, out_dir) == 0
+
+    write_records(data_file, "segments", records[100:])
+    assert build(data_file, out_dir) > 0
+    # Every device's 50 readings make (50 - 12) // 6 + 1 windows, once each
+    assert len(ShardDataset(out_dir)) == 4 * 7
+
+
+def test_bench_reports_too_few_examples(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    out_dir = str(tmp_path / "lora")
+    write_records(data_file, "segments", [collector_record(uplink) for uplink in uplinks[:100]])
+    build(data_file, out_dir)
+    assert len(ShardDataset(out_dir)) < 16
+    with pytest.raises(SystemExit, match="Not enough examples"):
+        bench(out_dir, batch_size=16, seq_len=64, step_ms=0, steps=1)
@@ -0,0 +1,77 @@
+"""Record store backends: records round trip, and iter_from resumes at a store position"""
+
+import os
+
+import pytest
+
+from conftest import collector_record, read_records, write_records
+from dedup_index import record_key
+from record_store import JsonFileStore, iter_from, log_dir_for, open_store
+
+
+@pytest.mark.parametrize("backend", ("segments", "json"))
+def test_records_round_trip(tmp_path, uplinks, backend):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, backend, records)
+    assert read_records(data_file, backend) == records
+
+
+@pytest.mark.parametrize("backend", ("segments", "json", "columnar", "binary"))
+def test_iter_from_resumes_after_cursor(tmp_path, uplinks, backend):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    # Stored late with older timestamps, as after a gap backfill
+    late = records[:40]
+    write_records(data_file, backend, records[40:])
+
+    store = open_store(data_file, backend, read_only=True)
+    cursor = {}
+    first = []
+    for record, cursor in iter_from(store, cursor):
+        first.append(record)
+    store.close()
+    assert len(first) == len(records) - len(late)
+
+    write_records(data_file, backend, late)
+    store = open_store(data_file, backend, read_only=True)
+    rest = [record for record, _ in iter_from(store, cursor)]
+    store.close()
+    assert sorted(rest, key=record_key) == sorted(late, key=record_key)
+
+
+def test_read_only_open_reads_legacy_json(tmp_path, uplinks):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    write_records(data_file, "json", records)
+    # Readers never import the file into a segment log
+    assert read_records(data_file, "segments") == records
+    assert not os.path.exists(log_dir_for(data_file))
+
+    with pytest.raises(FileNotFoundError):
+        open_store(str(tmp_path / "missing.json"), read_only=True)
+
+
+def test_json_compaction_interrupted_before_journal_reset(tmp_path, uplinks, monkeypatch):
+    data_file = str(tmp_path / "soil_data.json")
+    records = [collector_record(uplink) for uplink in uplinks]
+    store = JsonFileStore(data_file, compact_bytes=1 << 30)
+    for record in records:
+        store.append(record)
+    store.flush()
+
+    def crash(generation):
+        raise RuntimeError("crash")
+
+    # The data file is rewritten with the journal folded in, then the process dies
+    monkeypatch.setattr(store.journal, "reset", crash)
+    with pytest.raises(RuntimeError):
+        store.compact()
+    monkeypatch.undo()
+    store.journal.close()
+
+    # The stale journal is recognised from the generation alone and not replayed
+    assert read_records(data_file, "json") == records
+    store = JsonFileStore(data_file)
+    assert list(store.iter_records()) == records
+    store.close()
@@ -0,0 +1,58 @@
+"""Sharded ingest: the ring moves few devices, and a rebalance keeps every device's order"""
+
+import json
+import os
+
+from bench_ingest import synthetic_uplinks, uplink_topic
+from fleet_subscriber import partition_dir
+from record_store import open_store
+from sharded_ingest import ShardedIngest, ShardMap, stored_devices
+
+
+def test_resize_moves_about_one_shard_of_devices():
+    keys = [f"app/device-{n}" for n in range(2000)]
+    shard_map = ShardMap(range(4))
+    resized = shard_map.resized(5)
+    moved = sum(1 for key in keys if shard_map.shard_for(key) != resized.shard_for(key))
+    assert 0.1 < moved / len(keys) < 0.3
+    assert resized.epoch == shard_map.epoch + 1
+
+
+def device_runs(data_dir, key):
+    """f_cnt sequence of each worker log holding one device's records"""
+    runs = []
+    directory = partition_dir(data_dir, *key.split('/', 1))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith("_log"):
+            store = open_store(os.path.join(directory, name[:-len("_log")] + ".json"), read_only=True)
+            runs.append([record["raw_message"]["data"]["uplink_message"]["f_cnt"]
+                         for record in store.iter_records()])
+            store.close()
+    return runs
+
+
+def test_rebalance_keeps_each_device_in_order(tmp_path):
+    data_dir = str(tmp_path / "fleet_data")
+    uplinks = [(uplink_topic(uplink), json.dumps({"data": uplink}).encode())
+               for uplink in synthetic_uplinks(12, 1200)]
+    ingest = ShardedIngest(data_dir, ShardMap(range(2)), batch_size=8).start()
+    try:
+        for topic, payload in uplinks[:600]:
+            ingest.put(topic, payload)
+        old_map = ingest.shard_map
+        ingest.rebalance(old_map.resized(3))
+        for topic, payload in uplinks[600:]:
+            ingest.put(topic, payload)
+    finally:
+        ingest.close()
+
+    keys = stored_devices(data_dir)
+    assert len(keys) == 12
+    moved = [key for key in keys if old_map.shard_for(key) != ingest.shard_map.shard_for(key)]
+    assert moved
+    for key in keys:
+        runs = device_runs(data_dir, key)
+        assert len(runs) == (2 if key in moved else 1)
+        # Each worker stored its part in order, and the new owner's part follows the old one's
+        stored = [f_cnt for run in sorted(runs) for f_cnt in run]
+        assert stored == list(range(1, 101))
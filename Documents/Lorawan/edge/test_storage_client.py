@@ -0,0 +1,62 @@
+"""StorageClient streaming and resume against a ReplayServer"""
+
+from bench_ingest import FIRST_DEVICE
+from replay_server import ReplayHandler
+from ttn_storage import StorageClient
+
+
+class CutOff:
+    """wfile stand-in that drops the connection after limit bytes"""
+
+    def __init__(self, wfile, limit):
+        self.wfile = wfile
+        self.limit = limit
+        self.written = 0
+
+    def write(self, data):
+        if self.written + len(data) > self.limit:
+            raise ConnectionAbortedError("cut off by the test")
+        self.written += len(data)
+        return self.wfile.write(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class BreakingHandler(ReplayHandler):
+    def do_GET(self):
+        if self.server.breaks:
+            self.server.breaks -= 1
+            self.wfile = CutOff(self.wfile, self.server.cut_after)
+        super().do_GET()
+
+
+def device_uplinks(uplinks, device_id=FIRST_DEVICE):
+    return [uplink for uplink in uplinks if uplink["end_device_ids"]["device_id"] == device_id]
+
+
+def test_iter_uplinks_streams_one_device(uplinks, replay_server):
+    server = replay_server(uplinks, chunk_size=97)
+    client = StorageClient(base_url=server.base_url)
+    try:
+        got = list(client.iter_uplinks(device_id=FIRST_DEVICE, last="365d"))
+    finally:
+        client.close()
+    assert got == device_uplinks(uplinks)
+    assert server.request_count == 1
+
+
+def test_broken_stream_resumes_after_last_uplink(uplinks, replay_server):
+    server = replay_server(uplinks, chunk_size=256)
+    server.RequestHandlerClass = BreakingHandler
+    server.handle_error = lambda request, client_address: None
+    server.breaks = 1
+    server.cut_after = 4000
+    client = StorageClient(base_url=server.base_url, backoff=0)
+    try:
+        got = list(client.iter_uplinks(device_id=FIRST_DEVICE, last="365d"))
+    finally:
+        client.close()
+    # Every uplink exactly once, in order, over a second request with after=
+    assert got == device_uplinks(uplinks)
+    assert server.request_count == 2
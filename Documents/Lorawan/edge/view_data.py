@@ -4,20 +4,44 @@ Soil Sensor Data Viewer
 View collected soil sensor data
 """
 
-import json
+import argparse
 import os
-from datetime import datetime
+from collections import deque
+from record_store import log_dir_for, open_store, read_json_records, record_time, to_ns
+
+SENSOR_FIELDS = ["Bat", "TempC_DS18B20", "temp_SOIL", "water_SOIL", "conduct_SOIL"]
+
+def open_log(data_file):
+    """Open the segmented record log for a data file, or None if it has none"""
+    if os.path.isdir(log_dir_for(data_file)):
+        return open_store(data_file, read_only=True)
+    return None
+
+def load_json(data_file):
+    # Includes records still in the JSON backend's write-ahead journal
+    return read_json_records(data_file)
 
 def view_data(data_file="soil_data.json"):
     """View collected soil sensor data"""
     
-    if not os.path.exists(data_file):
+    log_dir = log_dir_for(data_file)
+    if not os.path.exists(data_file) and not os.path.isdir(log_dir):
         print(f"❌ Data file {data_file} not found")
         return
     
     try:
-        with open(data_file, 'r') as f:
-            data = json.load(f)
+        store = open_log(data_file)
+        if store is not None:
+            # Counts come from the segment index; only the ends of the log are read
+            total = sum(entry["count"] for entry in store.segment_index().values())
+            first = next(store.iter_records(), None)
+            recent = store.tail(5)
+            data = list(store.iter_records()) if total <= 10 else None
+        else:
+            data = load_json(data_file)
+            total = len(data)
+            first = data[0] if data else None
+            recent = data[-5:]
     except Exception as e:
         print(f"❌ Error loading data: {e}")
         return
@@ -25,27 +49,27 @@ def view_data(data_file="soil_data.json"):
     print(f"📊 Soil Sensor Data Viewer")
     print("=" * 60)
     print(f"📁 File: {data_file}")
-    print(f"📊 Total records: {len(data)}")
+    print(f"📊 Total records: {total}")
     print("=" * 60)
     
-    if not data:
+    if not total:
         print("📭 No data available")
         return
     
     # Show summary
     print("\n📈 Data Summary:")
-    print(f"   📅 First record: {data[0]['timestamp']}")
-    print(f"   📅 Last record: {data[-1]['timestamp']}")
-    print(f"   📱 Device: {data[0]['device_id']}")
-    if 'application_id' in data[0]:
-        print(f"   🏷️  Application: {data[0]['application_id']}")
+    print(f"   📅 First record: {first['timestamp']}")
+    print(f"   📅 Last record: {recent[-1]['timestamp']}")
+    print(f"   📱 Device: {first['device_id']}")
+    if 'application_id' in first:
+        print(f"   🏷️  Application: {first['application_id']}")
     else:
         print(f"   🏷️  Application: soil-sensor-saranac")
     
     # Show recent records
     print(f"\n📋 Recent Records (last 5):")
-    for i, record in enumerate(data[-5:], 1):
-        print(f"\n   Record #{len(data)-5+i}:")
+    for i, record in enumerate(recent, 1):
+        print(f"\n   Record #{total-len(recent)+i}:")
         print(f"   🕐 Time: {record['timestamp']}")
         
         if 'sensor_data' in record:
@@ -64,7 +88,7 @@ def view_data(data_file="soil_data.json"):
             print(f"   📶 SNR: {gateway.get('snr', 'N/A')} dB")
     
     # Show all records if requested
-    if len(data) <= 10:
+    if total <= 10:
         print(f"\n📋 All Records:")
         for i, record in enumerate(data, 1):
             print(f"\n   Record #{i}:")
@@ -75,23 +99,82 @@ def view_data(data_file="soil_data.json"):
                 print(f"   🌱 Soil Temp: {sensor.get('temp_SOIL', 'N/A')}°C")
                 print(f"   🌱 Soil Moisture: {sensor.get('water_SOIL', 'N/A')}%")
 
+def print_record(record, fields=None):
+    """Print one record on a single line"""
+    sensor = record.get('sensor_data', {})
+    values = " ".join(f"{field}={sensor.get(field, 'N/A')}" for field in (fields or SENSOR_FIELDS))
+    print(f"{record.get('timestamp')}  {record.get('device_id')}  {values}")
+
+def query_data(data_file, device=None, since=None, until=None, last=None, fields=None):
+    """Print records matching a device / time-range filter, optionally only the last N"""
+    start = to_ns(since) if since else None
+    end = to_ns(until) if until else None
+    
+    store = open_log(data_file)
+    if store is not None:
+        if last and start is None and end is None:
+            records = store.tail(last, device)
+        else:
+            records = store.iter_range(start, end, device)
+    else:
+        records = (
+            record for record in load_json(data_file)
+            if (not device or record.get('device_id') == device)
+            and (start is None or record_time(record) >= start)
+            and (end is None or record_time(record) < end)
+        )
+    if last:
+        records = deque(records, maxlen=last)
+    
+    count = 0
+    for record in records:
+        print_record(record, fields)
+        count += 1
+    print(f"📊 {count} matching records")
+
+def follow_data(data_file, device=None, fields=None, interval=1.0):
+    """Print new records as the collector appends them"""
+    store = open_log(data_file)
+    if store is None:
+        print(f"❌ --follow needs a record log ({log_dir_for(data_file)})")
+        return
+    print(f"👀 Following {store.log_dir} (Ctrl+C to stop)")
+    try:
+        for record in store.follow(interval):
+            if not device or record.get('device_id') == device:
+                print_record(record, fields)
+    except KeyboardInterrupt:
+        pass
+
 def main():
-    import sys
+    parser = argparse.ArgumentParser(description="View collected soil sensor data")
+    parser.add_argument("data_file", nargs="?", help="data file (default: soil_data.json)")
+    parser.add_argument("--device", help="only records from this device")
+    parser.add_argument("--since", help="start time, e.g. 2025-10-24T17:00:00Z")
+    parser.add_argument("--until", help="end time (exclusive)")
+    parser.add_argument("--last", type=int, help="only the last N matching records")
+    parser.add_argument("--fields", help="comma-separated sensor fields to print")
+    parser.add_argument("--follow", action="store_true", help="print new records as they arrive")
+    parser.add_argument("--interval", type=float, default=1.0, help="--follow poll interval (s)")
+    args = parser.parse_args()
     
     # Default to soil_data.json, but allow specifying others
-    data_file = "soil_data.json"
-    if len(sys.argv) > 1:
-        data_file = sys.argv[1]
-    else:
+    data_file = args.data_file or "soil_data.json"
+    if not args.data_file:
         # Check which files exist and show options
-        import os
         json_files = [f for f in os.listdir('.') if f.endswith('.json')]
         if len(json_files) > 1:
             print(f"Available JSON files: {', '.join(json_files)}")
             print(f"Using default: {data_file}")
             print(f"To view a specific file: python3 view_data.py <filename>")
     
-    view_data(data_file)
+    fields = args.fields.split(',') if args.fields else None
+    if args.follow:
+        follow_data(data_file, args.device, fields, args.interval)
+    elif args.device or args.since or args.until or args.last:
+        query_data(data_file, args.device, args.since, args.until, args.last, fields)
+    else:
+        view_data(data_file)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Sensor Window Similarity Index
+Approximate nearest-neighbour search over 24h windows of soil readings
+"""
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from journal import atomic_write, atomic_write_json
+from record_store import open_store, to_ns
+from soil_analytics import HOUR_NS, Rollups
+
+# Field and the change in it that counts as one unit of distance
+WINDOW_FIELDS = {
+    "temp_SOIL": 1.0,      # °C
+    "water_SOIL": 2.0,     # %
+    "conduct_SOIL": 20.0,  # uS/cm
+}
+WINDOW_HOURS = 24
+MAX_MISSING = 0.25     # fraction of hours in a window allowed to be interpolated
+RETRAIN_FACTOR = 0.5   # retrain once the unclustered tail is this share of the trained part
+MIN_TRAIN = 256
+
+
+def format_time(ns):
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def squared_distances(vectors, query):
+    difference = vectors - query
+    return np.einsum('ij,ij->i', difference, difference)
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Lloyd's k-means; returns float32 centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+def nearest_centroids(vectors, centroids, n=1):
+    scores = (centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T
+    if n == 1:
+        return np.argmin(scores, axis=1)
+    return np.argsort(scores, axis=1)[:, :n]
+
+
+class WindowIndex:
+    """
+    One device's windows, stored under <data_file>_windows/<device>/ as flat
+    arrays that are memory-mapped on open:
+
+      vectors.bin   float32 (n, WINDOW_HOURS * fields), scaled hourly means
+      ends.bin      int64 end time (ns) of each window's last hour
+      centroids.bin float32 (k, dim) IVF cluster centres
+      lists.bin     int32 window ids of the clustered prefix, grouped by cluster
+      offsets.bin   int64 (k + 1) start of each cluster in lists.bin
+
+    A query scans the nprobe closest clusters plus the windows appended since
+    the last training pass, then ranks the candidates exactly. update() only
+    appends windows that ended after the last indexed hour; clusters are
+    retrained when the unclustered tail grows past RETRAIN_FACTOR.
+    """
+
+    def __init__(self, data_file, device_id, fields=tuple(WINDOW_FIELDS), hours=WINDOW_HOURS):
+        self.data_file = data_file
+        self.device_id = device_id
+        self.fields = tuple(fields)
+        self.hours = hours
+        self.dim = hours * len(self.fields)
+        self.root = os.path.join(os.path.splitext(data_file)[0] + "_windows", device_id)
+        self.meta = {"fields": list(self.fields), "hours": hours, "count": 0,
+                     "trained": 0, "clusters": 0, "last_end": None}
+        self.open()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def mapped(self, name, dtype, shape):
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path(name), dtype=dtype, mode='r', shape=shape)
+
+    def open(self):
+        """Map the persisted arrays; costs the same for any index size"""
+        if os.path.exists(self.path("meta.json")):
+            with open(self.path("meta.json"), 'r') as f:
+                self.meta = json.load(f)
+            if self.meta["fields"] != list(self.fields) or self.meta["hours"] != self.hours:
+                raise ValueError(f"{self.root} was built for different fields or window length")
+        count, clusters = self.meta["count"], self.meta["clusters"]
+        self.vectors = self.mapped("vectors.bin", np.float32, (count, self.dim))
+        self.ends = self.mapped("ends.bin", np.int64, (count,))
+        self.centroids = self.mapped("centroids.bin", np.float32, (clusters, self.dim))
+        self.lists = self.mapped("lists.bin", np.int32, (self.meta["trained"],))
+        self.offsets = self.mapped("offsets.bin", np.int64, (clusters + 1 if clusters else 0,))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def windows_from(self, rows):
+        """(ends, vectors) of complete windows in a run of hourly rollup rows"""
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+        first, last = int(rows["bucket"][0]), int(rows["bucket"][-1])
+        hours = (last - first) // HOUR_NS + 1
+        slots = (rows["bucket"] - first) // HOUR_NS
+        grid = np.full((hours, len(self.fields)), np.nan)
+        for column, field in enumerate(self.fields):
+            grid[slots, column] = rows[f"{field}_mean"]
+
+        missing = np.isnan(grid).any(axis=1)
+        hour_index = np.arange(hours)
+        for column, (field, scale) in enumerate((f, WINDOW_FIELDS[f]) for f in self.fields):
+            valid = ~np.isnan(grid[:, column])
+            if valid.sum() < 2:
+                return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+            grid[:, column] = np.interp(hour_index, hour_index[valid], grid[valid, column]) / scale
+
+        if hours < self.hours:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+        # Every window of `hours` consecutive hours, flattened hour-major
+        windows = np.lib.stride_tricks.sliding_window_view(grid, self.hours, axis=0)
+        windows = windows.transpose(0, 2, 1).reshape(-1, self.dim)
+        missing_share = np.convolve(missing, np.ones(self.hours), 'valid') / self.hours
+        keep = missing_share <= MAX_MISSING
+        ends = first + (np.arange(self.hours - 1, hours) * HOUR_NS)
+        return ends[keep], windows[keep].astype(np.float32)
+
+    def update(self, store, rollups=None):
+        """Append windows that ended since the last update; returns how many"""
+        rollups = rollups or Rollups(self.data_file)
+        rollups.update(store, self.device_id)
+        last_end = self.meta["last_end"]
+        start = None if last_end is None else last_end - (self.hours - 1) * HOUR_NS
+        rows = rollups.read(self.device_id, "hourly", start=start)
+        # The newest hour may still be filling up; leave it for next time
+        rows = rows[:-1]
+        if last_end is not None:
+            rows = rows[rows["bucket"] > last_end - self.hours * HOUR_NS]
+        ends, vectors = self.windows_from(np.asarray(rows))
+        if last_end is not None:
+            keep = ends > last_end
+            ends, vectors = ends[keep], vectors[keep]
+        if len(rows):
+            self.meta["last_end"] = int(rows["bucket"][-1])
+        if len(ends) == 0:
+            self.save_meta()
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+        for name, array in (("vectors.bin", vectors), ("ends.bin", ends)):
+            with open(self.path(name), 'ab') as f:
+                # Drop rows a crashed update wrote but never counted in meta.json
+                f.truncate(self.meta["count"] * (array.nbytes // len(array)))
+                f.write(array.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self.meta["count"] += len(ends)
+        self.save_meta()
+        self.open()
+
+        tail = self.meta["count"] - self.meta["trained"]
+        if self.meta["count"] >= MIN_TRAIN and tail > RETRAIN_FACTOR * max(self.meta["trained"], MIN_TRAIN):
+            self.train()
+        return len(ends)
+
+    def train(self):
+        """Cluster all windows and rebuild the inverted lists"""
+        vectors = np.asarray(self.vectors)
+        clusters = max(1, int(np.sqrt(len(vectors))))
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), 50 * clusters), replace=False)]
+        centroids = kmeans(sample, clusters)
+        assign = np.concatenate([nearest_centroids(vectors[start:start + 65536], centroids)
+                                 for start in range(0, len(vectors), 65536)])
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.searchsorted(assign[order], np.arange(clusters + 1)).astype(np.int64)
+        atomic_write(self.path("centroids.bin"), centroids.astype(np.float32).tobytes())
+        atomic_write(self.path("lists.bin"), order.tobytes())
+        atomic_write(self.path("offsets.bin"), offsets.tobytes())
+        self.meta["trained"] = len(vectors)
+        self.meta["clusters"] = clusters
+        self.save_meta()
+        self.open()
+
+    def save_meta(self):
+        os.makedirs(self.root, exist_ok=True)
+        atomic_write_json(self.path("meta.json"), self.meta, indent=2)
+
+    def candidates(self, query, nprobe):
+        if not self.meta["clusters"]:
+            return np.arange(len(self))
+        probes = nearest_centroids(query[None, :], np.asarray(self.centroids), nprobe)[0]
+        parts = [self.lists[self.offsets[c]:self.offsets[c + 1]] for c in probes]
+        parts.append(np.arange(self.meta["trained"], len(self), dtype=np.int32))
+        return np.concatenate(parts)
+
+    def query(self, query, k=5, nprobe=8, exclude_end=None):
+        """
+        (end_ns, distance) of the k closest, non-overlapping windows to
+        query. Windows that overlap the one ending at exclude_end are
+        skipped, so a period is not reported as similar to itself.
+        """
+        if not len(self):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        ids = np.sort(self.candidates(query, nprobe))
+        ends = self.ends[ids]
+        if exclude_end is not None:
+            keep = np.abs(ends - exclude_end) >= self.hours * HOUR_NS
+            ids, ends = ids[keep], ends[keep]
+        distances = squared_distances(self.vectors[ids], query)
+        # Closest first, skipping windows that overlap one already chosen
+        found = []
+        for i in np.argsort(distances):
+            end = int(ends[i])
+            if all(abs(end - chosen) >= self.hours * HOUR_NS for chosen, _ in found):
+                # Distance per hour and field, in the units of WINDOW_FIELDS
+                found.append((end, float(np.sqrt(distances[i] / self.dim))))
+                if len(found) == k:
+                    break
+        return found
+
+    def similar_to(self, end_ns=None, k=5, nprobe=8):
+        """Periods most like the window ending at end_ns (default: the latest)"""
+        if not len(self):
+            return []
+        position = len(self) - 1 if end_ns is None else int(np.searchsorted(self.ends, end_ns))
+        position = min(position, len(self) - 1)
+        return self.query(np.asarray(self.vectors[position]), k, nprobe,
+                          exclude_end=int(self.ends[position]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find past periods similar to a window of soil readings")
+    parser.add_argument("data_file", nargs="?", default="soil_data.json")
+    parser.add_argument("--backend", default="segments", help="segments or columnar")
+    parser.add_argument("--device", default="lestat-lives")
+    parser.add_argument("--at", help="end of the window to match (RFC 3339), default latest")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    store = open_store(args.data_file, args.backend, read_only=True)
+    index = WindowIndex(args.data_file, args.device)
+    started = time.perf_counter()
+    added = index.update(store)
+    store.close()
+    print(f"Indexed {added} new windows in {time.perf_counter() - started:.2f}s "
+          f"({len(index)} total, {index.meta['clusters']} clusters)")
+
+    started = time.perf_counter()
+    matches = index.similar_to(to_ns(args.at) if args.at else None, args.k, args.nprobe)
+    elapsed = (time.perf_counter() - started) * 1000
+    for end, distance in matches:
+        print(f"  {format_time(end - (index.hours - 1) * HOUR_NS)} .. {format_time(end)}  distance {distance:.3f}")
+    print(f"Query took {elapsed:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()